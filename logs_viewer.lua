@@ -95,22 +95,52 @@
 
 <script>
 var tailInterval = null;
+var nextOffset = null;
+var generation = null;
+var logText = '';
 
-function loadLogs() {
+function formatEntries(entries) {
+    return entries.map(function(e) {
+        var ts = new Date(e.ts * 1000).toLocaleString();
+        return ts + ' - ' + e.component + ' - ' + e.level + ' - ' + e.msg;
+    }).join('\n');
+}
+
+function loadLogs(append) {
     var logFile = document.getElementById('log-file').value;
     var lines = document.getElementById('log-lines').value;
+    var level = document.getElementById('log-level').value;
     var search = document.getElementById('log-search').value;
     
     var contentDiv = document.getElementById('log-content');
-    contentDiv.innerHTML = '<div style="text-align: center; padding: 20px;">⏳ Загрузка...</div>';
+    var params = { file: logFile, lines: lines, level: level };
+    // При слежении запрашиваются только строки после последнего смещения;
+    // поколение индекса позволяет серверу распознать ротацию журнала
+    if (append === true && nextOffset !== null) {
+        params.since = nextOffset;
+        params.generation = generation;
+    } else {
+        contentDiv.innerHTML = '<div style="text-align: center; padding: 20px;">⏳ Загрузка...</div>';
+    }
     
-    XHR.get('<%=luci.dispatcher.build_url("admin/sentinel-kvm/logs/ajax")%>', {
-        file: logFile,
-        lines: lines
-    }, function(xhr, data) {
+    XHR.get('<%=luci.dispatcher.build_url("admin/sentinel-kvm/logs/ajax")%>', params, function(xhr, data) {
         try {
             var result = JSON.parse(data);
-            displayLogs(result.content, search);
+            if (result.entries) {
+                var text = formatEntries(result.entries);
+                // reset: журнал ротирован или усечен, пришел новый хвост
+                var appending = params.since !== undefined && !result.reset && logText;
+                logText = appending ? logText + (text ? '\n' + text : '') : text;
+                var kept = logText.split('\n');
+                if (kept.length > lines) logText = kept.slice(-lines).join('\n');
+                nextOffset = result.next_offset;
+                generation = result.generation;
+            } else {
+                logText = result.content;
+                nextOffset = null;
+                generation = null;
+            }
+            displayLogs(logText, search);
         } catch(e) {
             contentDiv.innerHTML = '<div style="color: red;">❌ Ошибка: ' + e + '</div>';
         }
@@ -161,7 +191,7 @@ function toggleTail() {
         btn.textContent = '▶ Следить';
         btn.classList.remove('tail-active');
     } else {
-        tailInterval = setInterval(loadLogs, 2000);
+        tailInterval = setInterval(function() { loadLogs(true); }, 2000);
         btn.textContent = '⏸ Остановить';
         btn.classList.add('tail-active');
     }
@@ -196,7 +226,8 @@ document.addEventListener('DOMContentLoaded', function() {
 <div class="logs-container">
     <div class="logs-controls">
         <select id="log-file" onchange="loadLogs()">
-            <option value="/var/log/sentinel-core.log">sentinel-core.log</option>
+            <option value="/var/run/sentinel/logs/sentinel-core.log">sentinel-core.log</option>
+            <option value="/var/run/sentinel/logs/sentinel-service.log">sentinel-service.log</option>
             <option value="/var/log/sentinel-dns.log">sentinel-dns.log</option>
             <option value="/var/log/sentinel-nftables.log">sentinel-nftables.log</option>
             <option value="/var/log/adguard-home.log">adguard-home.log</option>
@@ -211,7 +242,14 @@ document.addEventListener('DOMContentLoaded', function() {
             <option value="1000">1000 строк</option>
         </select>
         
-        <input type="text" id="log-search" placeholder="🔍 Поиск..." onkeyup="loadLogs()">
+        <select id="log-level" onchange="loadLogs()">
+            <option value="">Все уровни</option>
+            <option value="ERROR,CRITICAL">Ошибки</option>
+            <option value="WARNING,ERROR,CRITICAL">Предупреждения и ошибки</option>
+            <option value="INFO,WARNING,ERROR,CRITICAL">Без отладки</option>
+        </select>
+        
+        <input type="text" id="log-search" placeholder="🔍 Поиск..." onkeyup="displayLogs(logText, this.value)">
         
         <button onclick="loadLogs()">🔄 Обновить</button>
         <button id="tail-btn" onclick="toggleTail()">▶ Следить</button>
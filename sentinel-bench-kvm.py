@@ -0,0 +1,591 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+SENTINEL OS KVM - Network Namespace Benchmark
+=============================================
+Бенчмарк горячих путей роутера в одноразовых network namespace.
+Поднимает пару veth между двумя namespace (unshare, без реальных NIC),
+применяет ruleset KVMNFTablesRouter разного размера и измеряет
+задержку применения, память и пропускную способность UDP/TCP.
+Трафик генерируется в соседнем namespace и входит через prerouting,
+где цепочка classify проверяет geoip_direct.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import signal
+import platform
+import ipaddress
+import subprocess
+import logging
+from pathlib import Path
+from datetime import datetime
+from typing import Dict, Any, List, Optional
+
+# Настройка логирования
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger("sentinel-bench-kvm")
+
+# Соседние модули sentinel-*.py загружает общий загрузчик из того же каталога
+_SENTINEL_DIR = str(Path(__file__).resolve().parent)
+if _SENTINEL_DIR not in sys.path:
+    sys.path.insert(0, _SENTINEL_DIR)
+from sentinel_modules import load_sentinel_module as _load_sentinel_module
+
+BENCH_VERSION = "1.0.0"
+INNER_FLAG = "--inner"
+
+# Адресация тестовой пары veth
+VETH_LOCAL = "sb0"
+VETH_PEER = "sb1"
+ADDR_LOCAL = "10.203.0.1"
+ADDR_PEER = "10.203.0.2"
+VETH_PREFIX = 24
+
+# Размеры наборов geoip_direct и число правил обхода
+DEFAULT_SIZES = [10, 1000, 100000]
+DEFAULT_BYPASS_RULES = 100
+ELEMENTS_BASE = ipaddress.IPv4Address("100.64.0.0")
+BYPASS_BASE = ipaddress.IPv4Address("198.18.0.0")
+ELEMENT_CHUNK = 5000
+
+# Генератор трафика
+UDP_PORT = 5201
+TCP_PORT = 5202
+UDP_PAYLOAD = 64
+UDP_FLOWS = 16
+TCP_CHUNK = 65536
+DEFAULT_DURATION = 3.0
+
+# Бюджет импорта модулей: доля от эталона - импорта модулей стандартной
+# библиотеки в чистом интерпретаторе того же прогона (лучший из IMPORT_RUNS).
+# Абсолютные миллисекунды зависят от машины и ее загрузки; доля с запасом
+# ~50% над наблюдаемой ловит регрессии без ложных срабатываний.
+IMPORT_BUDGETS = {
+    "sentinel-core-kvm.py": 1.8,
+    "sentinel-parser-kvm.py": 0.7,
+    "sentinel-service-kvm.py": 1.1
+}
+IMPORT_BASELINE_MODULES = ["argparse", "subprocess", "dataclasses", "ipaddress", "socket",
+                           "threading", "email.message", "urllib.request"]
+IMPORT_RUNS = 5
+# Зависимости, которые не должны загружаться при импорте
+LAZY_DEPENDENCIES = ["yaml", "psutil", "netifaces"]
+
+# Пропускная способность KVMProtocolParser.parse_many
+PARSER_BENCH_KEYS = 20000
+
+# Замер в дочернем интерпретаторе: время exec_module, новые модули и
+# побочные эффекты (mkdir, открытие файлов на запись, обработчики логирования)
+IMPORT_PROBE = """
+import sys, json, time, logging, importlib.util
+path = sys.argv[1]
+effects = []
+def audit(event, args):
+    if "__pycache__" in str(args[0]):
+        return
+    if event == "os.mkdir" or (event == "open" and isinstance(args[1], str) and args[1][:1] in "wax"):
+        effects.append(f"{event} {args[0]}")
+before = set(sys.modules)
+spec = importlib.util.spec_from_file_location("probe", path)
+module = importlib.util.module_from_spec(spec)
+sys.addaudithook(audit)
+started = time.perf_counter()
+spec.loader.exec_module(module)
+elapsed = (time.perf_counter() - started) * 1000
+print(json.dumps({"ms": elapsed, "modules": sorted(set(sys.modules) - before),
+                  "effects": effects, "handlers": len(logging.getLogger().handlers)}))
+"""
+
+# Эталон: импорт IMPORT_BASELINE_MODULES в чистом интерпретаторе
+IMPORT_BASELINE_PROBE = """
+import sys, json, time, importlib
+started = time.perf_counter()
+for name in sys.argv[1:]:
+    importlib.import_module(name)
+print(json.dumps({"ms": (time.perf_counter() - started) * 1000}))
+"""
+
+
+def _load_router_class():
+    """Загрузка KVMNFTablesRouter из соседнего файла"""
+    return _load_sentinel_module("sentinel-nftables-kvm.py").KVMNFTablesRouter
+
+
+def _run(cmd: List[str], input_data: str = None, check: bool = True) -> subprocess.CompletedProcess:
+    """Запуск команды с проверкой кода возврата"""
+    result = subprocess.run(cmd, input=input_data, capture_output=True, text=True)
+    if check and result.returncode != 0:
+        raise RuntimeError(f"{' '.join(cmd)}: {result.stderr.strip()}")
+    return result
+
+
+def _slab_kb() -> int:
+    """Объем Slab из /proc/meminfo (кБ)"""
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("Slab:"):
+                    return int(line.split()[1])
+    except Exception:
+        pass
+    return 0
+
+
+# ============================================================================
+# ГЕНЕРАЦИЯ RULESET
+# ============================================================================
+
+def build_ruleset(router_cls, elements: int, bypass_rules: int) -> str:
+    """
+    Ruleset роутера с заданным числом элементов geoip_direct и правил обхода
+
+    Args:
+        router_cls: Класс KVMNFTablesRouter
+        elements: Количество /32 в geoip_direct (несмежные, без слияния интервалов)
+        bypass_rules: Количество правил обхода VPN
+
+    Returns:
+        Текст ruleset для nft -f
+    """
+    lines = [router_cls.build_base_ruleset()]
+
+    base = int(ELEMENTS_BASE)
+    for start in range(0, elements, ELEMENT_CHUNK):
+        chunk = [str(ipaddress.IPv4Address(base + 2 * i))
+                 for i in range(start, min(start + ELEMENT_CHUNK, elements))]
+        lines.append(f"add element inet sentinel geoip_direct {{ {', '.join(chunk)} }}")
+
+    base = int(BYPASS_BASE)
+    for i in range(bypass_rules):
+        lines.append(router_cls.build_bypass_rule(str(ipaddress.IPv4Address(base + i)), 443))
+
+    return "\n".join(lines) + "\n"
+
+
+# ============================================================================
+# ГЕНЕРАТОР И ПРИЕМНИК ТРАФИКА
+# ============================================================================
+
+def run_sink(proto: str, port: int, duration: float) -> Dict[str, Any]:
+    """Приемник трафика: считает пакеты/байты за окно измерения"""
+    packets = 0
+    received = 0
+    first = None
+
+    if proto == "udp":
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+        sock.bind(("0.0.0.0", port))
+        sock.settimeout(duration + 5)
+        print("ready", flush=True)
+        try:
+            while True:
+                data = sock.recv(65535)
+                now = time.monotonic()
+                if first is None:
+                    first = now
+                    sock.settimeout(0.5)
+                elif now - first > duration:
+                    break
+                packets += 1
+                received += len(data)
+        except socket.timeout:
+            pass
+        sock.close()
+    else:
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind(("0.0.0.0", port))
+        server.listen(1)
+        server.settimeout(duration + 5)
+        print("ready", flush=True)
+        conn, _ = server.accept()
+        first = time.monotonic()
+        while True:
+            data = conn.recv(TCP_CHUNK)
+            if not data:
+                break
+            packets += 1
+            received += len(data)
+        conn.close()
+        server.close()
+
+    elapsed = (time.monotonic() - first) if first else 0.0
+    return {"proto": proto, "packets": packets, "bytes": received, "elapsed": round(elapsed, 4)}
+
+
+def run_source(proto: str, port: int, duration: float) -> Dict[str, Any]:
+    """Генератор трафика (в соседнем namespace) к приемнику под ruleset"""
+    sent = 0
+    if proto == "udp":
+        # Несколько потоков с разными портами источника
+        sockets = []
+        for _ in range(UDP_FLOWS):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.connect((ADDR_LOCAL, port))
+            sockets.append(sock)
+
+        payload = b"\x00" * UDP_PAYLOAD
+        deadline = time.monotonic() + duration + 0.5
+        while time.monotonic() < deadline:
+            for sock in sockets:
+                try:
+                    sock.send(payload)
+                    sent += 1
+                except (BlockingIOError, ConnectionRefusedError):
+                    pass
+        for sock in sockets:
+            sock.close()
+    else:
+        sock = socket.create_connection((ADDR_LOCAL, port), timeout=5)
+        chunk = b"\x00" * TCP_CHUNK
+        deadline = time.monotonic() + duration
+        while time.monotonic() < deadline:
+            sock.sendall(chunk)
+            sent += 1
+        sock.close()
+    return {"proto": proto, "sent": sent}
+
+
+def _start_sink(proto: str, port: int, duration: float) -> subprocess.Popen:
+    """Запуск приемника в namespace с ruleset (трафик проходит prerouting/input)"""
+    proc = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), "--sink", proto, str(port), str(duration)],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True
+    )
+    proc.stdout.readline()  # ready
+    return proc
+
+
+def _finish_sink(proc: subprocess.Popen) -> Dict[str, Any]:
+    """Результат приемника"""
+    out, err = proc.communicate(timeout=30)
+    if proc.returncode != 0:
+        raise RuntimeError(f"sink: {err.strip()}")
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def _run_source(peer_pid: int, proto: str, port: int, duration: float) -> Dict[str, Any]:
+    """Генератор в соседнем namespace"""
+    result = _run(["nsenter", "-t", str(peer_pid), "-n", sys.executable, os.path.abspath(__file__),
+                   "--source", proto, str(port), str(duration)])
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def measure_udp(peer_pid: int, duration: float) -> Dict[str, Any]:
+    """UDP pps от соседа через prerouting"""
+    sink = _start_sink("udp", UDP_PORT, duration)
+    try:
+        sent = _run_source(peer_pid, "udp", UDP_PORT, duration)["sent"]
+    finally:
+        received = _finish_sink(sink)
+    pps = received["packets"] / received["elapsed"] if received["elapsed"] else 0.0
+    return {"sent": sent, "received": received["packets"], "pps": round(pps, 1)}
+
+
+def measure_tcp(peer_pid: int, duration: float) -> Dict[str, Any]:
+    """TCP throughput одного соединения от соседа через prerouting"""
+    sink = _start_sink("tcp", TCP_PORT, duration)
+    try:
+        _run_source(peer_pid, "tcp", TCP_PORT, duration)
+    finally:
+        received = _finish_sink(sink)
+    mbps = received["bytes"] * 8 / received["elapsed"] / 1e6 if received["elapsed"] else 0.0
+    return {"bytes": received["bytes"], "mbps": round(mbps, 1)}
+
+
+# ============================================================================
+# NAMESPACE И ПРОГОН
+# ============================================================================
+
+class NamespaceBench:
+    """Пара namespace с veth и прогон размеров ruleset"""
+
+    def __init__(self, duration: float = DEFAULT_DURATION):
+        self.duration = duration
+        self.peer: Optional[subprocess.Popen] = None
+        self.nft_bin = shutil.which("nft")
+
+    def setup(self):
+        """Создание соседнего namespace и veth пары"""
+        _run(["ip", "link", "set", "lo", "up"])
+        self.peer = subprocess.Popen(["unshare", "--net", "sleep", "infinity"])
+        time.sleep(0.2)
+        pid = str(self.peer.pid)
+
+        _run(["ip", "link", "add", VETH_LOCAL, "type", "veth", "peer", "name", VETH_PEER, "netns", pid])
+        _run(["ip", "addr", "add", f"{ADDR_LOCAL}/{VETH_PREFIX}", "dev", VETH_LOCAL])
+        _run(["ip", "link", "set", VETH_LOCAL, "up"])
+        _run(["nsenter", "-t", pid, "-n", "ip", "link", "set", "lo", "up"])
+        _run(["nsenter", "-t", pid, "-n", "ip", "addr", "add", f"{ADDR_PEER}/{VETH_PREFIX}", "dev", VETH_PEER])
+        _run(["nsenter", "-t", pid, "-n", "ip", "link", "set", VETH_PEER, "up"])
+        logger.info(f"✅ Namespace готовы: {VETH_LOCAL} {ADDR_LOCAL} <-> {VETH_PEER} {ADDR_PEER}")
+
+    def teardown(self):
+        """Удаление соседнего namespace"""
+        if self.peer:
+            self.peer.send_signal(signal.SIGTERM)
+            self.peer.wait(timeout=5)
+            self.peer = None
+
+    def apply(self, ruleset: str) -> Dict[str, Any]:
+        """Применение ruleset с замером времени и памяти"""
+        slab_before = _slab_kb()
+        start = time.perf_counter()
+        proc = subprocess.Popen([self.nft_bin, "-f", "-"], stdin=subprocess.PIPE,
+                                stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+        proc.stdin.write(ruleset)
+        proc.stdin.close()
+        error = proc.stderr.read()
+        # rusage самого nft: RUSAGE_CHILDREN - накопленный максимум всех детей, включая приемники
+        _, status, usage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        apply_ms = (time.perf_counter() - start) * 1000
+        if proc.returncode != 0:
+            raise RuntimeError(f"nft -f: {error.strip()}")
+        slab_after = _slab_kb()
+
+        return {
+            "apply_ms": round(apply_ms, 2),
+            "ruleset_bytes": len(ruleset),
+            "slab_delta_kb": slab_after - slab_before,
+            "nft_maxrss_kb": usage.ru_maxrss
+        }
+
+    def traffic(self) -> Dict[str, Any]:
+        """Замер UDP и TCP"""
+        return {
+            "udp": measure_udp(self.peer.pid, self.duration),
+            "tcp": measure_tcp(self.peer.pid, self.duration)
+        }
+
+    def flush(self):
+        """Очистка ruleset в тестовом namespace"""
+        if self.nft_bin:
+            _run([self.nft_bin, "flush", "ruleset"], check=False)
+
+    def run(self, sizes: List[int], bypass_rules: int) -> List[Dict[str, Any]]:
+        """
+        Прогон базовой линии и всех размеров
+
+        Returns:
+            Список результатов: baseline без правил, затем по размерам
+        """
+        router_cls = _load_router_class()
+        results = []
+
+        self.flush()
+        baseline = {"case": "baseline", "elements": 0, "bypass_rules": 0}
+        baseline.update(self.traffic())
+        results.append(baseline)
+        logger.info(f"📊 baseline: {baseline['udp']['pps']} pps, {baseline['tcp']['mbps']} Mbit/s")
+
+        for size in sizes:
+            case = {"case": f"geoip_{size}", "elements": size, "bypass_rules": bypass_rules}
+            if not self.nft_bin:
+                case["error"] = "nft не найден"
+                results.append(case)
+                continue
+
+            try:
+                self.flush()
+                case.update(self.apply(build_ruleset(router_cls, size, bypass_rules)))
+                case.update(self.traffic())
+                if baseline["udp"]["pps"] and case["udp"]["pps"]:
+                    case["udp"]["overhead_ns_per_packet"] = round(
+                        1e9 / case["udp"]["pps"] - 1e9 / baseline["udp"]["pps"], 1)
+                logger.info(f"📊 {case['case']}: apply {case['apply_ms']} ms, "
+                            f"{case['udp']['pps']} pps, {case['tcp']['mbps']} Mbit/s")
+            except Exception as e:
+                case["error"] = str(e)
+                logger.error(f"❌ {case['case']}: {e}")
+            results.append(case)
+
+        self.flush()
+        return results
+
+
+def measure_import(filename: str, runs: int = IMPORT_RUNS) -> Dict[str, Any]:
+    """Время импорта модуля (и эталона в тех же условиях) и его побочные эффекты"""
+    path = Path(__file__).resolve().parent / filename
+    samples = []
+    baseline = []
+    # Эталон и модуль чередуются, чтобы оба видели одну загрузку машины
+    for _ in range(runs):
+        proc = _run([sys.executable, "-c", IMPORT_BASELINE_PROBE, *IMPORT_BASELINE_MODULES])
+        baseline.append(json.loads(proc.stdout)["ms"])
+        proc = _run([sys.executable, "-c", IMPORT_PROBE, str(path)])
+        samples.append(json.loads(proc.stdout))
+    best = min(samples, key=lambda sample: sample["ms"])
+    baseline_ms = min(baseline)
+    return {
+        "ms": round(best["ms"], 2),
+        "baseline_ms": round(baseline_ms, 2),
+        "ratio": round(best["ms"] / baseline_ms, 2) if baseline_ms else 0.0,
+        "budget_ratio": IMPORT_BUDGETS.get(filename),
+        "eager_dependencies": [name for name in LAZY_DEPENDENCIES if name in best["modules"]],
+        "side_effects": best["effects"],
+        "log_handlers": best["handlers"],
+        "modules_loaded": len(best["modules"])
+    }
+
+
+def test_import_time() -> bool:
+    """Регрессионный тест времени импорта core/parser/service"""
+    print("=" * 60)
+    print("ТЕСТ ВРЕМЕНИ ИМПОРТА")
+    print("=" * 60)
+
+    passed = True
+    for filename, budget in IMPORT_BUDGETS.items():
+        result = measure_import(filename)
+        problems = []
+        if result["ratio"] > budget:
+            problems.append(f"x{result['ratio']} эталона > x{budget}")
+        if result["eager_dependencies"]:
+            problems.append(f"загружены {', '.join(result['eager_dependencies'])}")
+        if result["side_effects"]:
+            problems.append(f"побочные эффекты: {'; '.join(result['side_effects'][:3])}")
+        if result["log_handlers"]:
+            problems.append("настроено логирование")
+
+        status = "✅" if not problems else "❌"
+        print(f"{status} {filename}: {result['ms']} мс = x{result['ratio']} эталона "
+              f"{result['baseline_ms']} мс (бюджет x{budget}, "
+              f"модулей {result['modules_loaded']}) {'; '.join(problems)}")
+        passed = passed and not problems
+    return passed
+
+
+def generate_keys(protocol: str, count: int) -> List[str]:
+    """Синтетические ключи подписки"""
+    import base64
+    import uuid
+
+    keys = []
+    for i in range(count):
+        host = f"node{i}.example.net"
+        port = 443 + i % 1000
+        if protocol == "vless":
+            keys.append(f"vless://{uuid.uuid4()}@{host}:{port}?type=tcp&security=reality"
+                        f"&pbk=Z84J2IelR9ch3k8VtlVhhs5ycBUlXA7wHBWcBrjqnAw&sid={i:08x}&sni=www.example.com#node-{i}")
+        elif protocol == "vmess":
+            body = json.dumps({"v": "2", "ps": f"node-{i}", "add": host, "port": str(port),
+                               "id": str(uuid.uuid4()), "aid": "0", "net": "ws", "path": "/ws", "tls": "tls"})
+            keys.append("vmess://" + base64.b64encode(body.encode()).decode())
+        elif protocol == "ss":
+            auth = base64.b64encode(f"chacha20-ietf-poly1305:secret{i}".encode()).decode()
+            keys.append(f"ss://{auth}@{host}:{port}#node-{i}")
+        elif protocol == "trojan":
+            keys.append(f"trojan://secret{i}@{host}:{port}?sni={host}&type=tcp#node-{i}")
+    return keys
+
+
+def bench_parser(count: int = PARSER_BENCH_KEYS, workers: Optional[int] = None) -> Dict[str, Any]:
+    """Ключей в секунду по протоколам: в процессе и через пул"""
+    parser_module = _load_sentinel_module("sentinel-parser-kvm.py")
+    # Без кэша: иначе в пул попадают хэширование в родителе и попадания от inline-прогона
+    parser = parser_module.KVMProtocolParser(cache=False)
+    report = {"keys": count, "workers": workers or os.cpu_count(), "protocols": {}}
+
+    feeds = {name: generate_keys(name, count) for name in ("vless", "vmess", "ss", "trojan")}
+    mixed = [key for group in zip(*feeds.values()) for key in group][:count]
+    feeds["mixed"] = mixed
+
+    for name, keys in feeds.items():
+        row = {}
+        for backend in ("inline", "process"):
+            started = time.perf_counter()
+            results = list(parser.parse_many(keys, backend=backend, workers=workers))
+            elapsed = time.perf_counter() - started
+            parsed = sum(1 for r in results if r["parsed"])
+            row[backend] = {"keys_per_sec": round(len(keys) / elapsed), "parsed": parsed}
+        row["speedup"] = round(row["process"]["keys_per_sec"] / row["inline"]["keys_per_sec"], 2)
+        report["protocols"][name] = row
+        logger.info(f"📊 {name}: {row['inline']['keys_per_sec']} ключей/с в процессе, "
+                    f"{row['process']['keys_per_sec']} ключей/с в пуле (x{row['speedup']})")
+    return report
+
+
+def run_inner(sizes: List[int], bypass_rules: int, duration: float, output: str) -> int:
+    """Прогон внутри user+net namespace"""
+    bench = NamespaceBench(duration)
+    try:
+        bench.setup()
+        results = bench.run(sizes, bypass_rules)
+    finally:
+        bench.teardown()
+
+    report = {
+        "version": BENCH_VERSION,
+        "kernel": platform.release(),
+        "timestamp": datetime.now().isoformat(),
+        "duration": duration,
+        "results": results
+    }
+    Path(output).parent.mkdir(parents=True, exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    logger.info(f"✅ Результаты сохранены: {output}")
+    return 0 if not any("error" in r for r in results) else 1
+
+
+def main():
+    """Точка входа"""
+    import argparse
+
+    parser = argparse.ArgumentParser(description="SENTINEL OS KVM - бенчмарк nftables в network namespace")
+    parser.add_argument('--sizes', default=",".join(str(s) for s in DEFAULT_SIZES),
+                        help='Размеры geoip_direct через запятую')
+    parser.add_argument('--bypass', type=int, default=DEFAULT_BYPASS_RULES, help='Количество правил обхода')
+    parser.add_argument('--duration', type=float, default=DEFAULT_DURATION, help='Длительность замера трафика (с)')
+    parser.add_argument('--output', default='sentinel-bench.json', help='Файл результатов JSON')
+    parser.add_argument('--sink', nargs=3, metavar=('PROTO', 'PORT', 'DURATION'), help=argparse.SUPPRESS)
+    parser.add_argument('--source', nargs=3, metavar=('PROTO', 'PORT', 'DURATION'), help=argparse.SUPPRESS)
+    parser.add_argument('--import-time', action='store_true', help='Только тест времени импорта модулей')
+    parser.add_argument('--parser', type=int, nargs='?', const=PARSER_BENCH_KEYS, metavar='KEYS',
+                        help='Только пропускная способность парсера (ключей на протокол)')
+    parser.add_argument('--workers', type=int, help='Процессов пула парсера')
+    parser.add_argument(INNER_FLAG, action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.import_time:
+        return 0 if test_import_time() else 1
+
+    if args.parser:
+        report = bench_parser(args.parser, args.workers)
+        print(json.dumps(report, indent=2, ensure_ascii=False))
+        return 0
+
+    if args.sink:
+        proto, port, duration = args.sink
+        print(json.dumps(run_sink(proto, int(port), float(duration))))
+        return 0
+
+    if args.source:
+        proto, port, duration = args.source
+        print(json.dumps(run_source(proto, int(port), float(duration))))
+        return 0
+
+    sizes = [int(s) for s in args.sizes.split(",") if s]
+
+    if not args.inner:
+        # Перезапуск в собственных user+net namespace: реальные интерфейсы не затрагиваются
+        cmd = ["unshare", "--user", "--map-root-user", "--net",
+               sys.executable, os.path.abspath(__file__), INNER_FLAG] + sys.argv[1:]
+        return subprocess.call(cmd)
+
+    return run_inner(sizes, args.bypass, args.duration, os.path.abspath(args.output))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
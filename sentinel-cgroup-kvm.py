@@ -0,0 +1,952 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+SENTINEL OS KVM - cgroup v2 Resource Manager
+============================================
+Единый менеджер cgroup v2 для оркестратора и менеджера служб.
+Лимиты берутся из секции resources (общий бюджет Sentinel) и
+из секций protocols.<имя> (лимиты конкретного туннеля) sentinel.yaml.
+"""
+
+import os
+import re
+import time
+import ctypes
+import socket
+import select
+import statistics
+import logging
+import threading
+from contextlib import contextmanager
+from collections import deque
+from pathlib import Path
+from typing import Dict, Any, List, Optional, Callable
+
+# Настройка логирования
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger("sentinel-cgroup-kvm")
+
+CGROUP_ROOT = Path("/sys/fs/cgroup")
+SENTINEL_CGROUP = CGROUP_ROOT / "sentinel"
+MAIN_CONFIG = Path("/etc/sentinel/sentinel.yaml")
+
+# Контроллеры, которые включаются для дочерних групп
+CONTROLLERS = ["memory", "cpu", "io", "cpuset"]
+ORPHAN_GROUP = "_orphans"  # лист для процессов удаляемых групп
+REMOVE_TIMEOUT = 5.0  # ожидание завершения процессов перед rmdir
+
+CPU_PERIOD_US = 100000
+MEMORY_HIGH_RATIO = 0.9
+
+# Лимиты по умолчанию для протоколов без явных настроек в sentinel.yaml
+DEFAULT_PROTOCOL_LIMITS = {
+    "xray": {"memory_limit_mb": 512},
+    "adguardhome": {"memory_limit_mb": 512},
+    "hysteria2": {"memory_limit_mb": 512},
+    "tor": {"cpu_quota": 50}
+}
+
+LIMIT_KEYS = ["memory_limit_mb", "memory_high_mb", "swap_limit_mb", "cpu_quota", "cpu_weight", "io_weight"]
+
+# PSI (Pressure Stall Information)
+PROC_PRESSURE = Path("/proc/pressure")
+PSI_RESOURCES = ["cpu", "memory", "io"]
+# Пороги some avg10 (% времени, когда хотя бы одна задача ждет ресурс), выше - запуск откладывается
+PSI_DELAY_THRESHOLDS = {"memory": 10.0, "io": 20.0, "cpu": 40.0}
+# full avg10 памяти (все задачи стоят) - запуск отклоняется
+PSI_REJECT_MEMORY_FULL = 20.0
+# Триггеры poll(): <some|full> <порог стойки, мкс> <окно, мкс>; доля стойки в окне
+# совпадает с порогами задержки, окно кратно 2 с (требование ядра для непривилегированных триггеров)
+PSI_TRIGGERS = {
+    "memory": "some 200000 2000000",
+    "io": "some 400000 2000000",
+    "cpu": "some 800000 2000000"
+}
+PSI_ADMISSION_TIMEOUT = 60.0
+PSI_RELEASE_RATIO = 0.5
+# Приоритеты протоколов: ниже - раньше троттлится при давлении
+PROTOCOL_PRIORITY = {
+    "adguardhome": 90, "wireguard": 80, "amneziawg": 80, "xray": 70, "sing-box": 70,
+    "hysteria2": 60, "openvpn": 60, "trojan": 60, "shadowsocks": 50,
+    "zapret": 30, "byedpi": 30, "goodbyedpi": 30, "tor": 20
+}
+HIGH_PRIORITY = 80
+THROTTLE_PRIORITY = 50
+THROTTLE_MEMORY_RATIO = 0.9
+THROTTLE_CPU_WEIGHT = 25
+
+# CPU pinning
+SYSFS_CPU = Path("/sys/devices/system/cpu")
+PROC_INTERRUPTS = Path("/proc/interrupts")
+# Протоколы с интенсивной обработкой пакетов получают выделенные vCPU
+DATAPLANE_PROTOCOLS = ["wireguard", "amneziawg", "xray", "sing-box", "hysteria2", "openvpn", "trojan"]
+PINNING_BENCH_MESSAGES = 64
+
+# Память: THP, hugepages, virtio-balloon
+THP_DIR = Path("/sys/kernel/mm/transparent_hugepage")
+NR_HUGEPAGES = Path("/proc/sys/vm/nr_hugepages")
+BALLOON_DEBUGFS = Path("/sys/kernel/debug/virtio-balloon")
+PROC_MEMINFO = Path("/proc/meminfo")
+PR_SET_THP_DISABLE = 41
+PR_GET_THP_DISABLE = 42
+BALLOON_WINDOW = 6
+BALLOON_HORIZON = 60.0
+BALLOON_SAMPLE_INTERVAL = 10.0  # не чаще одного замера в окно за интервал
+BALLOON_MIN_SPAN = 10.0  # меньший промежуток не экстраполируется
+MIN_HEADROOM_MB = 256
+BALLOON_HIGH_RATIO = 0.9
+
+
+def load_resource_config(path: Path = MAIN_CONFIG) -> Dict[str, Any]:
+    """Чтение секций resources и protocols из sentinel.yaml"""
+    try:
+        import yaml
+        with open(path) as f:
+            config = yaml.safe_load(f) or {}
+    except Exception as e:
+        logger.warning(f"⚠️ Конфигурация ресурсов не загружена: {e}")
+        config = {}
+    return {"resources": config.get("resources", {}) or {}, "protocols": config.get("protocols", {}) or {}}
+
+
+def _group_name(name: str) -> str:
+    """Имя дочерней cgroup"""
+    return name.replace(".", "_").replace("/", "_")
+
+
+class CgroupManager:
+    """Управление cgroup v2 иерархией /sys/fs/cgroup/sentinel/<протокол>"""
+
+    def __init__(self, config: Dict[str, Any] = None, root: Path = SENTINEL_CGROUP):
+        self.config = config if config is not None else load_resource_config()
+        self.root = root
+        self.available = (root.parent / "cgroup.controllers").exists()
+        self.enabled: List[str] = []
+
+    def _write(self, path: Path, value: str) -> bool:
+        """Запись в интерфейсный файл cgroup"""
+        try:
+            path.write_text(value)
+            return True
+        except OSError as e:
+            logger.warning(f"⚠️ {path}: {e}")
+            return False
+
+    def _read(self, path: Path) -> Optional[str]:
+        """Чтение интерфейсного файла cgroup"""
+        try:
+            return path.read_text().strip()
+        except OSError:
+            return None
+
+    def setup(self) -> bool:
+        """Создание корневой группы Sentinel и включение контроллеров"""
+        if not self.available:
+            logger.warning("⚠️ cgroup v2 недоступен (нет cgroup.controllers)")
+            return False
+
+        try:
+            self.root.mkdir(exist_ok=True)
+        except OSError as e:
+            logger.warning(f"⚠️ Не удалось создать {self.root}: {e}")
+            return False
+
+        # Контроллер должен быть включен у родителя, чтобы появиться в дочерних группах
+        for parent in (self.root.parent, self.root):
+            present = (self._read(parent / "cgroup.controllers") or "").split()
+            wanted = [c for c in CONTROLLERS if c in present]
+            if wanted:
+                self._write(parent / "cgroup.subtree_control", " ".join(f"+{c}" for c in wanted))
+
+        self.enabled = (self._read(self.root / "cgroup.subtree_control") or "").split()
+        self.apply_limits(None, self.config.get("resources", {}))
+        logger.info(f"✅ cgroup v2 инициализирован: {self.root} ({', '.join(self.enabled) or 'без контроллеров'})")
+        return True
+
+    def limits_for(self, *names: str) -> Dict[str, Any]:
+        """
+        Лимиты протокола: значения по умолчанию, затем protocols.<имя> из конфига
+
+        Args:
+            names: Ключи поиска по возрастанию приоритета (тип протокола, имя службы)
+        """
+        limits: Dict[str, Any] = {}
+        protocols = self.config.get("protocols", {})
+        for name in names:
+            limits.update(DEFAULT_PROTOCOL_LIMITS.get(name, {}))
+        for name in names:
+            section = protocols.get(name) or {}
+            limits.update({k: section[k] for k in LIMIT_KEYS if section.get(k) is not None})
+        return limits
+
+    def path(self, name: Optional[str] = None) -> Path:
+        """Путь к группе протокола (None - корневая группа Sentinel)"""
+        return self.root / _group_name(name) if name else self.root
+
+    def create(self, name: str) -> Optional[Path]:
+        """Создание группы протокола"""
+        path = self.path(name)
+        try:
+            path.mkdir(parents=True, exist_ok=True)
+            return path
+        except OSError as e:
+            logger.warning(f"⚠️ Не удалось создать cgroup {path}: {e}")
+            return None
+
+    def apply_limits(self, name: Optional[str], limits: Dict[str, Any]) -> Dict[str, str]:
+        """
+        Применение лимитов к группе
+
+        Args:
+            name: Имя группы протокола (None - корневая группа Sentinel)
+            limits: memory_limit_mb, memory_high_mb, swap_limit_mb, cpu_quota (% одного CPU),
+                    cpu_weight (1-10000), io_weight (1-10000)
+
+        Returns:
+            Записанные значения по файлам
+        """
+        path = self.path(name)
+        files: Dict[str, str] = {}
+
+        if limits.get("memory_limit_mb"):
+            limit = int(limits["memory_limit_mb"]) * 1024 * 1024
+            files["memory.max"] = str(limit)
+            # memory.high задерживает (reclaim/throttle) раньше, чем memory.max вызовет OOM
+            high = limits.get("memory_high_mb")
+            files["memory.high"] = str(int(high) * 1024 * 1024 if high else int(limit * MEMORY_HIGH_RATIO))
+        elif limits.get("memory_high_mb"):
+            files["memory.high"] = str(int(limits["memory_high_mb"]) * 1024 * 1024)
+
+        if limits.get("swap_limit_mb") is not None:
+            files["memory.swap.max"] = str(int(limits["swap_limit_mb"]) * 1024 * 1024)
+
+        if limits.get("cpu_quota"):
+            quota = int(CPU_PERIOD_US * float(limits["cpu_quota"]) / 100)
+            files["cpu.max"] = f"{quota} {CPU_PERIOD_US}"
+        if limits.get("cpu_weight"):
+            files["cpu.weight"] = str(max(1, min(int(limits["cpu_weight"]), 10000)))
+
+        if limits.get("io_weight"):
+            files["io.weight"] = f"default {max(1, min(int(limits['io_weight']), 10000))}"
+
+        applied = {}
+        for filename, value in files.items():
+            if (path / filename).exists() and self._write(path / filename, value):
+                applied[filename] = value
+
+        if applied:
+            logger.info(f"✅ Лимиты cgroup {path.name}: {applied}")
+        return applied
+
+    def attach(self, name: str, pid: int) -> bool:
+        """Перенос процесса в группу протокола"""
+        return self._write(self.path(name) / "cgroup.procs", str(pid))
+
+    def setup_protocol(self, name: str, pid: int, *limit_names: str) -> Dict[str, str]:
+        """Создание группы, применение лимитов из конфига и перенос процесса"""
+        if not self.available or not self.create(name):
+            return {}
+        applied = self.apply_limits(name, self.limits_for(*(limit_names or (name,))))
+        if pid:
+            self.attach(name, pid)
+        return applied
+
+    def remove(self, name: str, timeout: float = REMOVE_TIMEOUT) -> bool:
+        """
+        Удаление группы протокола
+
+        Сначала ждем завершения процессов. Оставшиеся переносятся в лист
+        ORPHAN_GROUP: в корневую группу Sentinel писать нельзя, пока у нее
+        включены контроллеры в subtree_control (правило no internal
+        processes, EBUSY).
+        """
+        path = self.path(name)
+        if not path.exists():
+            return True
+
+        deadline = time.monotonic() + timeout
+        pids = (self._read(path / "cgroup.procs") or "").split()
+        while pids and time.monotonic() < deadline:
+            time.sleep(0.1)
+            pids = (self._read(path / "cgroup.procs") or "").split()
+
+        if pids:
+            orphans = self.create(ORPHAN_GROUP)
+            if orphans is None:
+                return False
+            for pid in pids:
+                self._write(orphans / "cgroup.procs", pid)
+            logger.warning(f"⚠️ Процессы {', '.join(pids)} перенесены из {path.name} в {ORPHAN_GROUP}")
+
+        try:
+            path.rmdir()
+            return True
+        except OSError as e:
+            logger.warning(f"⚠️ Не удалось удалить cgroup {path}: {e}")
+            return False
+
+    def get_value(self, name: Optional[str], filename: str) -> Optional[str]:
+        """Чтение интерфейсного файла группы"""
+        return self._read(self.path(name) / filename)
+
+    def set_value(self, name: Optional[str], filename: str, value: str) -> bool:
+        """Запись интерфейсного файла группы"""
+        return self._write(self.path(name) / filename, value)
+
+    def stats(self, name: Optional[str] = None) -> Dict[str, Any]:
+        """Текущее потребление группы"""
+        path = self.path(name)
+        stats: Dict[str, Any] = {}
+        memory = self._read(path / "memory.current")
+        if memory is not None:
+            stats["memory_mb"] = round(int(memory) / (1024 * 1024), 1)
+        for filename in ("cpu.stat", "memory.events"):
+            for line in (self._read(path / filename) or "").splitlines():
+                key, _, value = line.partition(" ")
+                if key in ("usage_usec", "nr_throttled", "throttled_usec", "high", "max", "oom_kill"):
+                    stats[f"{filename.split('.')[0]}_{key}"] = int(value)
+        return stats
+
+
+# ============================================================================
+# PSI: КОНТРОЛЬ ДОПУСКА И ТРОТТЛИНГ
+# ============================================================================
+
+def read_pressure(path: Path) -> Dict[str, Dict[str, float]]:
+    """Разбор файла PSI: {"some": {"avg10", "avg60", "avg300", "total"}, "full": {...}}"""
+    pressure: Dict[str, Dict[str, float]] = {}
+    try:
+        for line in path.read_text().splitlines():
+            kind, *fields = line.split()
+            pressure[kind] = {k: float(v) for k, v in (f.split("=") for f in fields)}
+    except (OSError, ValueError):
+        pass
+    return pressure
+
+
+class PressureMonitor:
+    """
+    Решения о запуске и троттлинге по Linux PSI.
+
+    admit() откладывает или отклоняет запуск протокола по avg10 системного
+    давления; триггеры poll() на /proc/pressure/* (и *.pressure групп)
+    срабатывают в момент стойки и ужесточают memory.high/cpu.weight
+    низкоприоритетных протоколов, пока давление не спадет.
+    """
+
+    def __init__(self, cgroups: CgroupManager = None, memory: "MemoryTuner" = None):
+        self.cgroups = cgroups
+        self.memory = memory
+        self.available = (PROC_PRESSURE / "memory").exists()
+        self.running = False
+        self.monitor_thread = None
+        self.poller = select.poll()
+        self.triggers: Dict[int, Dict[str, Any]] = {}
+        self.throttled: Dict[str, Dict[str, Optional[str]]] = {}
+        self.priorities: Dict[str, int] = {}
+        self.events = 0
+
+    @staticmethod
+    def priority_of(protocol: str) -> int:
+        """Приоритет протокола"""
+        return PROTOCOL_PRIORITY.get(protocol, THROTTLE_PRIORITY)
+
+    def snapshot(self, group: Optional[str] = None) -> Dict[str, Dict[str, Dict[str, float]]]:
+        """Давление по ресурсам: системное или группы"""
+        if group is not None and self.cgroups:
+            base = self.cgroups.path(group)
+            return {r: read_pressure(base / f"{r}.pressure") for r in PSI_RESOURCES}
+        return {r: read_pressure(PROC_PRESSURE / r) for r in PSI_RESOURCES}
+
+    def admit(self, protocol: str, priority: int = None) -> Dict[str, Any]:
+        """
+        Решение о запуске протокола
+
+        Returns:
+            {"decision": "admit" | "delay" | "reject", "reason", "pressure"}
+        """
+        priority = self.priority_of(protocol) if priority is None else priority
+        snapshot = self.snapshot()
+        pressure = {r: snapshot[r].get("some", {}).get("avg10", 0.0) for r in PSI_RESOURCES}
+        pressure["memory_full"] = snapshot["memory"].get("full", {}).get("avg10", 0.0)
+
+        if pressure["memory_full"] >= PSI_REJECT_MEMORY_FULL:
+            return {"decision": "reject", "pressure": pressure,
+                    "reason": f"memory full avg10={pressure['memory_full']}%"}
+
+        # Запас памяти с учетом прогнозируемого раздувания balloon
+        if self.memory is not None:
+            headroom = self.memory.headroom_mb()
+            pressure["headroom_mb"] = headroom
+            if headroom < MIN_HEADROOM_MB:
+                return {"decision": "delay", "pressure": pressure,
+                        "reason": f"headroom {headroom}MB с учетом balloon"}
+
+        # Высокоприоритетные протоколы допускаются при вдвое большем давлении
+        scale = 2.0 if priority >= HIGH_PRIORITY else 1.0
+        for resource, threshold in PSI_DELAY_THRESHOLDS.items():
+            if pressure[resource] >= threshold * scale:
+                return {"decision": "delay", "pressure": pressure,
+                        "reason": f"{resource} some avg10={pressure[resource]}%"}
+
+        return {"decision": "admit", "pressure": pressure, "reason": None}
+
+    def wait_for_admission(self, protocol: str, priority: int = None,
+                           timeout: float = PSI_ADMISSION_TIMEOUT, interval: float = 2.0) -> Dict[str, Any]:
+        """Ожидание допуска: запуск откладывается, пока давление выше порогов"""
+        deadline = time.monotonic() + timeout
+        while True:
+            result = self.admit(protocol, priority)
+            if result["decision"] != "delay" or time.monotonic() >= deadline:
+                return result
+            # Повторяется на каждой попытке допуска: выборка sentinel-logging-kvm
+            logger.info(f"⏳ Запуск {protocol} отложен: {result['reason']}", extra={"rate_limit": True})
+            time.sleep(interval)
+
+    # ------------------------------------------------------------------------
+    # Триггеры и троттлинг
+    # ------------------------------------------------------------------------
+
+    def add_trigger(self, resource: str, callback: Callable[[str, Dict[str, Any]], None],
+                    spec: str = None, group: Optional[str] = None) -> bool:
+        """Регистрация PSI триггера (poll POLLPRI)"""
+        if group is not None and self.cgroups:
+            path = self.cgroups.path(group) / f"{resource}.pressure"
+        else:
+            path = PROC_PRESSURE / resource
+        try:
+            fd = os.open(path, os.O_RDWR | os.O_NONBLOCK)
+            os.write(fd, (spec or PSI_TRIGGERS[resource]).encode() + b"\x00")
+        except OSError as e:
+            logger.warning(f"⚠️ PSI триггер {path}: {e}")
+            return False
+        self.poller.register(fd, select.POLLPRI)
+        self.triggers[fd] = {"resource": resource, "group": group, "callback": callback, "path": path}
+        return True
+
+    def register(self, name: str, protocol: str):
+        """Учет запущенного протокола для троттлинга"""
+        self.priorities[name] = self.priority_of(protocol)
+
+    def unregister(self, name: str):
+        """Снятие протокола с учета"""
+        self.priorities.pop(name, None)
+        self.throttled.pop(name, None)
+
+    def throttle(self, resource: str, snapshot: Dict[str, Any] = None):
+        """Ужесточение лимитов низкоприоритетных протоколов"""
+        if not self.cgroups:
+            return
+        for name, priority in sorted(self.priorities.items(), key=lambda item: item[1]):
+            if priority >= THROTTLE_PRIORITY or name in self.throttled:
+                continue
+            saved = {f: self.cgroups.get_value(name, f) for f in ("memory.high", "cpu.weight")}
+            current = self.cgroups.get_value(name, "memory.current")
+            if resource == "memory" and current:
+                self.cgroups.set_value(name, "memory.high", str(int(int(current) * THROTTLE_MEMORY_RATIO)))
+            self.cgroups.set_value(name, "cpu.weight", str(THROTTLE_CPU_WEIGHT))
+            self.throttled[name] = saved
+            logger.warning(f"⚠️ Давление {resource}: {name} ограничен (приоритет {priority})")
+
+    def release(self):
+        """Снятие троттлинга, когда давление спало"""
+        if not self.throttled or not self.cgroups:
+            return
+        snapshot = self.snapshot()
+        for resource, threshold in PSI_DELAY_THRESHOLDS.items():
+            if snapshot[resource].get("some", {}).get("avg10", 0.0) >= threshold * PSI_RELEASE_RATIO:
+                return
+        for name, saved in self.throttled.items():
+            for filename, value in saved.items():
+                if value:
+                    self.cgroups.set_value(name, filename, value)
+            logger.info(f"✅ Ограничения {name} сняты", extra={"rate_limit": True})
+        self.throttled = {}
+
+    def _on_pressure(self, resource: str, snapshot: Dict[str, Any]):
+        """Обработчик триггера по умолчанию"""
+        self.throttle(resource, snapshot)
+
+    def start_monitoring(self):
+        """Регистрация системных триггеров и запуск потока"""
+        if not self.available:
+            logger.warning("⚠️ PSI недоступен (/proc/pressure)")
+            return
+        for resource in PSI_RESOURCES:
+            self.add_trigger(resource, self._on_pressure)
+        self.running = True
+        self.monitor_thread = threading.Thread(target=self._monitor_loop)
+        self.monitor_thread.daemon = True
+        self.monitor_thread.start()
+        logger.info(f"✅ PSI мониторинг запущен ({len(self.triggers)} триггеров)")
+
+    def stop(self):
+        """Остановка мониторинга"""
+        self.running = False
+        for fd in list(self.triggers):
+            self.poller.unregister(fd)
+            os.close(fd)
+        self.triggers = {}
+
+    def _monitor_loop(self):
+        """Ожидание событий PSI; между событиями - проверка снятия троттлинга"""
+        while self.running:
+            for fd, event in self.poller.poll(1000):
+                trigger = self.triggers.get(fd)
+                if not trigger:
+                    continue
+                if event & select.POLLERR:
+                    logger.error(f"❌ PSI триггер {trigger['path']} недействителен")
+                    self.poller.unregister(fd)
+                    os.close(fd)
+                    self.triggers.pop(fd)
+                    continue
+                if event & select.POLLPRI:
+                    self.events += 1
+                    trigger["callback"](trigger["resource"], self.snapshot(trigger["group"]))
+            self.release()
+
+
+# ============================================================================
+# ПЛАНИРОВЩИК ПРИВЯЗКИ К CPU
+# ============================================================================
+
+def parse_cpu_list(text: str) -> List[int]:
+    """Разбор списка CPU вида 0-3,6,8-9"""
+    cpus: List[int] = []
+    for part in (text or "").strip().split(","):
+        if "-" in part:
+            start, end = part.split("-")
+            cpus.extend(range(int(start), int(end) + 1))
+        elif part:
+            cpus.append(int(part))
+    return cpus
+
+
+def format_cpu_list(cpus: List[int]) -> str:
+    """Список CPU в формате cpuset.cpus"""
+    cpus = sorted(set(cpus))
+    ranges = []
+    for cpu in cpus:
+        if ranges and cpu == ranges[-1][1] + 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ",".join(f"{a}-{b}" if a != b else str(a) for a, b in ranges)
+
+
+class CPUPinningPlanner:
+    """
+    План cpuset для протоколов по топологии vCPU и раскладке IRQ очередей.
+
+    CPU0 остается под служебные задачи. Протоколы передачи данных получают
+    выделенные vCPU (режим "dedicated", по возможности вне CPU входных IRQ
+    virtio, но в том же LLC), остальные делят служебный набор. Если vCPU не
+    хватает на всех, протоколы передачи данных делят общий пул ("shared").
+
+    Выделение не изолирует CPU: раздел cpuset (cpuset.cpus.partition) не
+    создается, поэтому процессы вне Sentinel и потоки ядра по-прежнему
+    работают на этих vCPU. План только разводит протоколы Sentinel между
+    собой; изоляция требует isolcpus/nohz_full или раздела cpuset хоста.
+    """
+
+    def __init__(self, cgroups: CgroupManager = None):
+        self.cgroups = cgroups
+
+    def topology(self) -> Dict[str, Any]:
+        """Карта vCPU: ядра, SMT-соседи, общий LLC и CPU входных IRQ"""
+        online = parse_cpu_list(_read_file(SYSFS_CPU / "online") or "0")
+        cpus = {}
+        for cpu in online:
+            base = SYSFS_CPU / f"cpu{cpu}"
+            llc = None
+            for index in sorted((base / "cache").glob("index*"), reverse=True):
+                llc = _read_file(index / "shared_cpu_list")
+                if llc:
+                    break
+            cpus[cpu] = {
+                "package": int(_read_file(base / "topology" / "physical_package_id") or 0),
+                "core": int(_read_file(base / "topology" / "core_id") or cpu),
+                "siblings": parse_cpu_list(_read_file(base / "topology" / "thread_siblings_list") or str(cpu)),
+                "llc": parse_cpu_list(llc or str(cpu))
+            }
+        return {"cpus": cpus, "irq_cpus": self.irq_cpus()}
+
+    def irq_cpus(self) -> Dict[str, List[int]]:
+        """CPU, обрабатывающие IRQ входных очередей virtio"""
+        layout = {}
+        for line in (_read_file(PROC_INTERRUPTS) or "").splitlines():
+            match = re.match(r"^\s*(\d+):.*\b(virtio\d+-input\.\d+)\s*$", line)
+            if match:
+                affinity = _read_file(Path("/proc/irq") / match.group(1) / "smp_affinity_list")
+                layout[match.group(2)] = parse_cpu_list(affinity or "")
+        return layout
+
+    def plan(self, protocols: List[str]) -> Dict[str, Any]:
+        """
+        Расчет cpuset для протоколов
+
+        Returns:
+            {"protocols": {имя: {"cpus", "mode"}}, "housekeeping", "irq_cpus"}
+        """
+        topo = self.topology()
+        online = sorted(topo["cpus"])
+        housekeeping = online[:1] if len(online) > 2 else online
+        irq = sorted({c for cpus in topo["irq_cpus"].values() if len(cpus) == 1 for c in cpus})
+
+        dataplane = sorted([p for p in protocols if p in DATAPLANE_PROTOCOLS],
+                           key=lambda p: -PROTOCOL_PRIORITY.get(p, THROTTLE_PRIORITY))
+        pool = [c for c in online if c not in housekeeping and c not in irq] or \
+               [c for c in online if c not in housekeeping] or online
+
+        # Предпочитаем CPU, делящие LLC с CPU входных IRQ (данные пакета уже в кэше)
+        irq_llc = {c for i in irq for c in topo["cpus"].get(i, {}).get("llc", [])}
+        pool.sort(key=lambda c: (c not in irq_llc, c))
+
+        result: Dict[str, Dict[str, Any]] = {}
+        if dataplane and len(pool) >= len(dataplane):
+            per = len(pool) // len(dataplane)
+            for i, protocol in enumerate(dataplane):
+                cpus = pool[i * per:(i + 1) * per] if i < len(dataplane) - 1 else pool[i * per:]
+                result[protocol] = {"cpus": format_cpu_list(cpus), "mode": "dedicated"}
+        else:
+            for protocol in dataplane:
+                result[protocol] = {"cpus": format_cpu_list(pool), "mode": "shared"}
+
+        for protocol in protocols:
+            if protocol not in result:
+                result[protocol] = {"cpus": format_cpu_list(housekeeping), "mode": "housekeeping"}
+
+        return {"protocols": result, "housekeeping": format_cpu_list(housekeeping),
+                "irq_cpus": topo["irq_cpus"], "online": format_cpu_list(online)}
+
+    def apply(self, name: str, cpus: str, pid: int = None) -> str:
+        """
+        Применение cpuset: через cgroup cpuset.cpus, иначе sched_setaffinity всех потоков
+
+        Returns:
+            Использованный механизм ("cpuset", "affinity" или "none")
+        """
+        if self.cgroups and "cpuset" in " ".join(self.cgroups.enabled) and self.cgroups.path(name).exists():
+            if self.cgroups.set_value(name, "cpuset.cpus", cpus):
+                return "cpuset"
+
+        if pid:
+            cpu_set = set(parse_cpu_list(cpus))
+            tasks = [int(t.name) for t in Path(f"/proc/{pid}/task").glob("*")] or [pid]
+            for tid in tasks:
+                try:
+                    os.sched_setaffinity(tid, cpu_set)
+                except OSError as e:
+                    logger.warning(f"⚠️ sched_setaffinity {tid}: {e}")
+            return "affinity"
+        return "none"
+
+    # ------------------------------------------------------------------------
+    # Бенчмарк
+    # ------------------------------------------------------------------------
+
+    @staticmethod
+    def _echo_round(cpus: Optional[set], duration: float) -> Dict[str, float]:
+        """
+        UDP echo через loopback между двумя процессами с заданной привязкой.
+        Синтетическая нагрузка: ни туннеля, ни virtio, ни IRQ сетевой карты.
+        """
+        server_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        server_sock.bind(("127.0.0.1", 0))
+        address = server_sock.getsockname()
+
+        pid = os.fork()
+        if pid == 0:
+            try:
+                if cpus:
+                    os.sched_setaffinity(0, cpus)
+                while True:
+                    data, peer = server_sock.recvfrom(2048)
+                    if data == b"stop":
+                        break
+                    server_sock.sendto(data, peer)
+            finally:
+                os._exit(0)
+
+        server_sock.close()
+        previous = os.sched_getaffinity(0)
+        if cpus:
+            os.sched_setaffinity(0, cpus)
+
+        client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        client.settimeout(1.0)
+        payload = b"\x00" * PINNING_BENCH_MESSAGES
+        latencies = []
+        deadline = time.perf_counter() + duration
+        try:
+            while time.perf_counter() < deadline:
+                start = time.perf_counter()
+                client.sendto(payload, address)
+                client.recv(2048)
+                latencies.append((time.perf_counter() - start) * 1e6)
+        finally:
+            client.sendto(b"stop", address)
+            client.close()
+            os.waitpid(pid, 0)
+            os.sched_setaffinity(0, previous)
+
+        latencies.sort()
+        return {
+            "messages_per_sec": round(len(latencies) / duration, 1),
+            "p50_us": round(statistics.median(latencies), 1) if latencies else 0.0,
+            "p99_us": round(latencies[int(len(latencies) * 0.99) - 1], 1) if latencies else 0.0
+        }
+
+    def benchmark(self, protocol: str = "wireguard", duration: float = 3.0) -> Dict[str, Any]:
+        """
+        Синтетическая оценка влияния привязки на пропускную способность и
+        хвостовую задержку: UDP echo через loopback на vCPU из плана протокола.
+        Сам протокол не запускается, реальный выигрыш для туннеля может отличаться.
+        """
+        plan = self.plan([protocol])
+        cpus = set(parse_cpu_list(plan["protocols"][protocol]["cpus"]))
+        result = {
+            "protocol": protocol,
+            "cpus": plan["protocols"][protocol]["cpus"],
+            "synthetic": True,
+            "method": "loopback UDP echo (синтетическая оценка, не трафик протокола)",
+            "unpinned": self._echo_round(None, duration),
+            "pinned": self._echo_round(cpus, duration)
+        }
+        logger.info(f"📊 Pinning {protocol} (синтетическая оценка, loopback UDP echo): "
+                    f"{result['unpinned']} -> {result['pinned']}")
+        return result
+
+
+def _read_file(path: Path) -> Optional[str]:
+    """Чтение sysfs/procfs файла"""
+    try:
+        return path.read_text().strip()
+    except OSError:
+        return None
+
+
+# ============================================================================
+# ПАМЯТЬ: THP, HUGEPAGES, VIRTIO-BALLOON
+# ============================================================================
+
+def read_meminfo() -> Dict[str, int]:
+    """Значения /proc/meminfo (кБ или штуки для HugePages_*)"""
+    info = {}
+    for line in (_read_file(PROC_MEMINFO) or "").splitlines():
+        key, _, value = line.partition(":")
+        try:
+            info[key] = int(value.split()[0])
+        except (IndexError, ValueError):
+            continue
+    return info
+
+
+class MemoryTuner:
+    """
+    Настройка памяти гостя под kvm.hugepages и kvm.balloon_driver.
+
+    THP: системный режим и политика для отдельных служб (PR_SET_THP_DISABLE
+    наследуется запускаемыми процессами). Hugepages: резерв пула hugetlb.
+    Balloon: по серии замеров inflated_kb (debugfs) или падения MemTotal
+    прогнозируется, сколько памяти хост заберет в ближайшем горизонте;
+    прогноз уменьшает запас для допуска и ужесточает memory.high Sentinel.
+    """
+
+    def __init__(self, balloon: bool = True):
+        self.balloon = balloon
+        self.samples: deque = deque(maxlen=BALLOON_WINDOW)
+        self._libc = None
+
+    # ------------------------------------------------------------------------
+    # THP и hugepages
+    # ------------------------------------------------------------------------
+
+    def apply_thp(self, mode: str = "madvise", defrag: str = "defer+madvise") -> Dict[str, Optional[str]]:
+        """Системный режим THP (always/madvise/never) и defrag"""
+        result = {}
+        for name, value in (("enabled", mode), ("defrag", defrag)):
+            try:
+                (THP_DIR / name).write_text(value)
+            except OSError as e:
+                logger.warning(f"⚠️ THP {name}={value}: {e}")
+            current = _read_file(THP_DIR / name) or ""
+            selected = re.search(r"\[([^\]]+)\]", current)
+            result[name] = selected.group(1) if selected else None
+        logger.info(f"✅ THP: {result}")
+        return result
+
+    def _prctl(self, option: int, arg: int = 0) -> int:
+        """Вызов prctl(2)"""
+        if self._libc is None:
+            self._libc = ctypes.CDLL(None, use_errno=True)
+        return self._libc.prctl(option, arg, 0, 0, 0)
+
+    @contextmanager
+    def thp_policy(self, policy: Optional[str]):
+        """
+        Политика THP для процессов, запущенных внутри блока.
+
+        policy "never" выставляет PR_SET_THP_DISABLE: флаг наследуется через
+        fork/exec, поэтому служба и ее потомки работают без THP; после
+        запуска флаг текущего процесса восстанавливается. Включить THP
+        одной службе (always/madvise) ядро не позволяет: такие значения
+        игнорируются, действует системный режим (kvm.thp).
+        """
+        if policy != "never":
+            if policy:
+                logger.warning(f"⚠️ THP {policy} для службы не поддерживается "
+                               f"(только never), действует системный режим")
+            yield
+            return
+        previous = self._prctl(PR_GET_THP_DISABLE)
+        self._prctl(PR_SET_THP_DISABLE, 1)
+        try:
+            yield
+        finally:
+            self._prctl(PR_SET_THP_DISABLE, max(previous, 0))
+
+    def reserve_hugepages(self, size_mb: int) -> Dict[str, int]:
+        """Резервирование пула hugepages заданного объема"""
+        page_kb = read_meminfo().get("Hugepagesize", 2048)
+        wanted = size_mb * 1024 // page_kb
+        try:
+            NR_HUGEPAGES.write_text(str(wanted))
+        except OSError as e:
+            logger.warning(f"⚠️ Не удалось зарезервировать hugepages: {e}")
+        meminfo = read_meminfo()
+        result = {"requested": wanted, "total": meminfo.get("HugePages_Total", 0),
+                  "free": meminfo.get("HugePages_Free", 0), "page_kb": page_kb}
+        if result["total"] < wanted:
+            logger.warning(f"⚠️ Hugepages: получено {result['total']} из {wanted} (фрагментация памяти)")
+        else:
+            logger.info(f"✅ Hugepages: {result['total']} x {page_kb}kB")
+        return result
+
+    # ------------------------------------------------------------------------
+    # Balloon
+    # ------------------------------------------------------------------------
+
+    def _inflated_kb(self) -> Optional[int]:
+        """Раздутие balloon из debugfs (inflated_kb), если доступно"""
+        for line in (_read_file(BALLOON_DEBUGFS) or "").splitlines():
+            key, _, value = line.partition(":")
+            if key.strip() == "inflated_kb":
+                return int(value.split()[0])
+        return None
+
+    def sample(self) -> Dict[str, Any]:
+        """
+        Замер памяти и balloon
+
+        В окно прогноза замер попадает не чаще BALLOON_SAMPLE_INTERVAL:
+        частые вызовы (допуск, CLI) не сжимают окно до миллисекунд.
+        """
+        meminfo = read_meminfo()
+        sample = {
+            "time": time.monotonic(),
+            "mem_total_kb": meminfo.get("MemTotal", 0),
+            "mem_available_kb": meminfo.get("MemAvailable", 0),
+            "inflated_kb": self._inflated_kb() if self.balloon else None,
+            "hugepages_total": meminfo.get("HugePages_Total", 0),
+            "hugepages_free": meminfo.get("HugePages_Free", 0)
+        }
+        if not self.samples or sample["time"] - self.samples[-1]["time"] >= BALLOON_SAMPLE_INTERVAL:
+            self.samples.append(sample)
+        return sample
+
+    def predict(self, horizon: float = BALLOON_HORIZON) -> Dict[str, Any]:
+        """
+        Прогноз изъятия памяти balloon на горизонт
+
+        Returns:
+            Скорость раздутия (кБ/с), прогноз изъятия и эффективный запас (МБ)
+        """
+        current = self.sample()
+        rate = 0.0
+        if self.balloon and self.samples:
+            first = self.samples[0]
+            elapsed = current["time"] - first["time"]
+            # Один шаг balloon за миллисекунды дал бы прогноз в десятки ГБ
+            if elapsed >= BALLOON_MIN_SPAN:
+                if current["inflated_kb"] is not None and first["inflated_kb"] is not None:
+                    growth = current["inflated_kb"] - first["inflated_kb"]
+                else:
+                    # Без debugfs: раздувание видно как уменьшение MemTotal
+                    growth = first["mem_total_kb"] - current["mem_total_kb"]
+                rate = max(growth / elapsed, 0.0)
+
+        reclaim_mb = int(rate * horizon / 1024)
+        available_mb = current["mem_available_kb"] // 1024
+        return {
+            "inflated_mb": (current["inflated_kb"] or 0) // 1024,
+            "inflation_rate_kb_s": round(rate, 1),
+            "predicted_reclaim_mb": reclaim_mb,
+            "available_mb": available_mb,
+            "effective_available_mb": max(available_mb - reclaim_mb, 0),
+            "effective_total_mb": max(current["mem_total_kb"] // 1024 - reclaim_mb, 0)
+        }
+
+    def headroom_mb(self) -> int:
+        """Доступная память за вычетом прогнозируемого изъятия"""
+        return self.predict()["effective_available_mb"]
+
+    def protect(self, cgroups: CgroupManager) -> Optional[str]:
+        """
+        Ужесточение memory.high Sentinel при раздувании balloon
+
+        Сжатие через memory.high (reclaim/throttle) идет до того, как хост
+        заберет память и ядро начнет OOM-kill.
+        """
+        prediction = self.predict()
+        if not prediction["predicted_reclaim_mb"]:
+            return None
+        high = int(prediction["effective_total_mb"] * BALLOON_HIGH_RATIO) * 1024 * 1024
+        configured = cgroups.config.get("resources", {}).get("memory_limit_mb")
+        if configured:
+            high = min(high, int(configured) * 1024 * 1024)
+        if cgroups.set_value(None, "memory.high", str(high)):
+            logger.warning(f"⚠️ Balloon раздувается ({prediction['inflation_rate_kb_s']} кБ/с): "
+                           f"memory.high Sentinel = {high // (1024 * 1024)}MB")
+            return str(high)
+        return None
+
+
+# ============================================================================
+# ТЕСТИРОВАНИЕ
+# ============================================================================
+
+def test_cgroup_manager():
+    """Тестирование менеджера cgroup"""
+    import json
+
+    manager = CgroupManager(config={
+        "resources": {"memory_limit_mb": 2048, "swap_limit_mb": 1024, "cpu_quota": 100, "io_weight": 500},
+        "protocols": {"xray": {"memory_limit_mb": 768, "cpu_weight": 200}}
+    })
+    print(json.dumps({"xray": manager.limits_for("xray"), "tor": manager.limits_for("tor")}, indent=2))
+
+    if manager.setup():
+        manager.setup_protocol("xray", os.getpid())
+        print(json.dumps(manager.stats("xray"), indent=2))
+        manager.remove("xray")
+
+    monitor = PressureMonitor(manager)
+    print(json.dumps({p: monitor.admit(p) for p in ("xray", "tor")}, indent=2))
+
+    memory = MemoryTuner()
+    memory.sample()
+    print(json.dumps(memory.predict(), indent=2))
+
+    planner = CPUPinningPlanner(manager)
+    print(json.dumps(planner.plan(["wireguard", "xray", "tor"]), indent=2))
+    print(json.dumps(planner.benchmark("wireguard", duration=1.0), indent=2))
+
+
+if __name__ == "__main__":
+    test_cgroup_manager()
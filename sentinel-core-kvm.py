@@ -11,25 +11,24 @@ SENTINEL OS v2.0 KVM EDITION - CENTRAL ORCHESTRATOR
 import os
 import sys
 import json
-import yaml
 import time
+import fcntl
 import signal
 import logging
 import subprocess
-import ipaddress
 import re
-import psutil
-import netifaces
 from pathlib import Path
 from typing import Dict, Any, List, Optional, Tuple, Union
 from dataclasses import dataclass, field, asdict
 from enum import Enum
 from datetime import datetime
 import threading
-import fcntl
-import struct
+import contextlib
 import socket
 
+# yaml и psutil импортируются в методах при первом использовании: импорт модуля
+# (--help, клиентские команды) не платит за них и не трогает файловую систему
+
 # ============================================================================
 # KVM-СПЕЦИФИЧНЫЕ КОНСТАНТЫ
 # ============================================================================
@@ -41,35 +40,163 @@ SENTINEL_CODENAME = "KVM ULTIMATE PRIVACY EDITION"
 BASE_DIR = Path("/etc/sentinel")
 CONFIG_DIR = BASE_DIR / "configs"
 PROTOCOLS_DIR = BASE_DIR / "protocols"
-LOGS_DIR = BASE_DIR / "logs"
 STATE_DIR = Path("/var/run/sentinel")
 KVM_STATE_DIR = STATE_DIR / "kvm"
 
 # Файлы
 MAIN_CONFIG = BASE_DIR / "sentinel.yaml"
 STATE_FILE = STATE_DIR / "state.json"
-LOG_FILE = LOGS_DIR / "sentinel-core.log"
 KVM_METRICS = KVM_STATE_DIR / "metrics.json"
+# Общий с sentinel-nftables-kvm.py: чтение-изменение-запись метрик под flock
+KVM_METRICS_LOCK = KVM_STATE_DIR / "metrics.json.lock"
+KSM_STATE = KVM_STATE_DIR / "ksm.json"
 
-# VirtIO интерфейсы
-VIRTIO_NET_DEVS = ["eth0", "eth1", "eth2", "eth3"]
+# VirtIO интерфейсы (сетевые определяются через rtnetlink, см. sentinel-netlink-kvm.py)
 VIRTIO_BLK_DEVS = ["vda", "vdb", "vdc", "vdd"]
 
-# Создаем необходимые директории
-for dir_path in [BASE_DIR, CONFIG_DIR, PROTOCOLS_DIR, LOGS_DIR, STATE_DIR, KVM_STATE_DIR]:
-    dir_path.mkdir(parents=True, exist_ok=True)
-
-# Настройка логирования
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler(LOG_FILE),
-        logging.StreamHandler()
-    ]
-)
+# KSM: границы регулирования и бюджет CPU ksmd (% одного vCPU)
+KSM_DIR = Path("/sys/kernel/mm/ksm")
+KSM_PAGES_TO_SCAN_MIN = 100
+KSM_PAGES_TO_SCAN_MAX = 4000
+KSM_SLEEP_MS_MIN = 10
+KSM_SLEEP_MS_MAX = 200
+KSM_CPU_BUDGET = 5.0
+KSM_MIN_EFFICIENCY = 1000  # сэкономленных страниц на секунду CPU ksmd
+KSM_INTERVAL = 30
+KSM_MIN_INTERVAL = 10  # короче - дельты счетчиков не информативны
+KSM_MAX_UNSHARED_RATIO = 10  # pages_unshared / pages_sharing: сканирование впустую
+
+# conntrack: пороги заполнения таблицы (общие с sentinel-nftables-kvm.py)
+CONNTRACK_WARN_USAGE = 0.80
+CONNTRACK_CRIT_USAGE = 0.95
+
+# ============================================================================
+# ПРОФИЛИРОВАНИЕ ЗАПУСКА
+# ============================================================================
+
+class PhaseProfiler:
+    """
+    Таймер фаз запуска оркестратора.
+    
+    Для каждой фазы (вложенные через "/") считает wall- и CPU-время,
+    CPU дочерних процессов и число запущенных внешних команд. Команды
+    учитываются audit-хуком subprocess.Popen после enable().
+    """
+    
+    MAX_COMMANDS = 20
+    
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.preamble_cpu = time.process_time()
+        self.phases: List[Dict[str, Any]] = []
+        self.stack: List[Dict[str, Any]] = []
+        self.subprocesses = 0
+        self.enabled = False
+    
+    def enable(self):
+        """Учет внешних команд (audit-хук нельзя снять, поэтому только по --profile)"""
+        if not self.enabled:
+            self.enabled = True
+            sys.addaudithook(self._audit)
+    
+    def _audit(self, event: str, args: tuple):
+        if event != "subprocess.Popen":
+            return
+        self.subprocesses += 1
+        for phase in self.stack:
+            phase["subprocesses"] += 1
+        if self.stack and len(self.stack[-1]["commands"]) < self.MAX_COMMANDS:
+            command = args[1] if isinstance(args[1], str) else " ".join(map(str, args[1] or []))
+            self.stack[-1]["commands"].append(command[:120])
+    
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        """Замер фазы"""
+        full_name = "/".join([p["name"] for p in self.stack[-1:]] + [name])
+        record = {"name": full_name, "depth": len(self.stack), "subprocesses": 0, "commands": []}
+        self.phases.append(record)
+        self.stack.append(record)
+        wall, cpu, children = time.perf_counter(), time.process_time(), os.times()
+        try:
+            yield record
+        finally:
+            after = os.times()
+            record["wall_ms"] = round((time.perf_counter() - wall) * 1000, 2)
+            record["cpu_ms"] = round((time.process_time() - cpu) * 1000, 2)
+            record["children_cpu_ms"] = round(
+                (after.children_user + after.children_system
+                 - children.children_user - children.children_system) * 1000, 2)
+            self.stack.pop()
+    
+    def report(self) -> Dict[str, Any]:
+        """Разбивка по фазам"""
+        top = [p for p in self.phases if p["depth"] == 0 and "wall_ms" in p]
+        return {
+            "total_wall_ms": round((time.perf_counter() - self.started) * 1000, 2),
+            "preamble_cpu_ms": round(self.preamble_cpu * 1000, 2),
+            "phases_wall_ms": round(sum(p["wall_ms"] for p in top), 2),
+            "subprocesses": self.subprocesses,
+            "phases": [{k: v for k, v in p.items() if k != "depth"} for p in self.phases],
+            "slowest": [p["name"] for p in sorted(
+                (p for p in self.phases if "wall_ms" in p), key=lambda p: p["wall_ms"], reverse=True)[:5]]
+        }
+    
+    def format_table(self) -> str:
+        """Таблица фаз для терминала"""
+        report = self.report()
+        lines = [f"{'Фаза':<44} {'wall, мс':>10} {'CPU, мс':>10} {'дети, мс':>10} {'команд':>7}"]
+        for p in self.phases:
+            if "wall_ms" not in p:
+                continue
+            name = "  " * p["depth"] + p["name"].rsplit("/", 1)[-1]
+            lines.append(f"{name:<44} {p['wall_ms']:>10.1f} {p['cpu_ms']:>10.1f} "
+                         f"{p['children_cpu_ms']:>10.1f} {p['subprocesses']:>7}")
+        lines.append(f"Всего {report['total_wall_ms']:.1f} мс, до профайлера (импорты) "
+                     f"{report['preamble_cpu_ms']:.1f} мс CPU, внешних команд {report['subprocesses']}")
+        return "\n".join(lines)
+
+
+PROFILER = PhaseProfiler()
+
 logger = logging.getLogger("sentinel-core-kvm")
 
+
+# Соседние модули sentinel-*.py загружает общий загрузчик из того же каталога
+_SENTINEL_DIR = str(Path(__file__).resolve().parent)
+if _SENTINEL_DIR not in sys.path:
+    sys.path.insert(0, _SENTINEL_DIR)
+from sentinel_modules import load_sentinel_module as _load_sentinel_module
+
+
+LOG_FILE: Optional[Path] = None
+
+
+def init_runtime(console: Optional[bool] = None, daemon: bool = False) -> Path:
+    """
+    Каталоги и логирование (однократно, при запуске оркестратора)
+
+    Args:
+        console: Дублирование журнала в stderr (None - из секции logging)
+        daemon: Процесс службы - единственный владелец ротации sentinel-core.log;
+            команды CLI пишут в тот же файл без ротации
+
+    Returns:
+        Путь к журналу JSON lines
+    """
+    global LOG_FILE
+    if LOG_FILE is None:
+        # Создаем необходимые директории
+        with PROFILER.phase("runtime_dirs"):
+            for dir_path in [BASE_DIR, CONFIG_DIR, PROTOCOLS_DIR, STATE_DIR, KVM_STATE_DIR]:
+                dir_path.mkdir(parents=True, exist_ok=True)
+        # Настройка логирования: очередь + JSON lines на tmpfs (секция logging в sentinel.yaml)
+        with PROFILER.phase("runtime_logging"):
+            overrides = {"rotate": daemon}
+            if console is not None:
+                overrides["console"] = console
+            LOG_FILE = _load_sentinel_module("sentinel-logging-kvm.py").setup_logging("sentinel-core", **overrides)
+    return LOG_FILE
+
 # ============================================================================
 # ENUM И ДАТАКЛАССЫ
 # ============================================================================
@@ -143,7 +270,225 @@ class KVMResources:
     virtio_net_count: int = 0
     virtio_blk_count: int = 0
     balloon_size: int = 0
+    balloon_reclaim_mb: int = 0
+    hugepages_total: int = 0
     ksm_sharing: float = 0.0
+    ksm_saved_mb: float = 0.0
+    ksm_cpu_percent: float = 0.0
+    conntrack_count: int = 0
+    conntrack_max: int = 0
+    conntrack_usage: float = 0.0
+
+# ============================================================================
+# РЕГУЛЯТОР KSM
+# ============================================================================
+
+class KSMController:
+    """
+    Замкнутый контур управления KSM.
+    
+    Наращивает pages_to_scan/уменьшает sleep_millisecs, пока слияние
+    страниц окупается (сэкономленные страницы на секунду CPU ksmd),
+    и отступает, когда ksmd выходит за бюджет CPU или полные проходы
+    перестают давать прирост. Предыдущий замер хранится в KSM_STATE:
+    цикл шагов ведет служба (start_monitoring), разовый ksm-tune берет
+    сохраненный замер и не шагает чаще KSM_MIN_INTERVAL.
+    """
+    
+    def __init__(self, cpu_budget: float = KSM_CPU_BUDGET):
+        self.cpu_budget = cpu_budget
+        self.page_size = os.sysconf("SC_PAGE_SIZE")
+        self.clock_ticks = os.sysconf("SC_CLK_TCK")
+        self.running = False
+        self.monitor_thread = None
+        self.last: Dict[str, Any] = {}
+    
+    def _read(self, name: str) -> int:
+        """Чтение параметра KSM"""
+        return int((KSM_DIR / name).read_text().strip())
+    
+    def _write(self, name: str, value: int):
+        """Запись параметра KSM"""
+        (KSM_DIR / name).write_text(str(value))
+    
+    def _ksmd_cpu_seconds(self) -> float:
+        """Суммарное время CPU потока ksmd"""
+        for stat in Path("/proc").glob("[0-9]*/stat"):
+            try:
+                data = stat.read_text()
+            except OSError:
+                continue
+            if "(ksmd)" in data:
+                fields = data.rsplit(")", 1)[1].split()
+                return (int(fields[11]) + int(fields[12])) / self.clock_ticks
+        return 0.0
+    
+    def sample(self) -> Dict[str, Any]:
+        """Снимок счетчиков KSM"""
+        sample = {name: self._read(name) for name in (
+            "pages_shared", "pages_sharing", "pages_unshared", "full_scans",
+            "pages_to_scan", "sleep_millisecs"
+        )}
+        sample["ksmd_cpu_seconds"] = self._ksmd_cpu_seconds()
+        sample["time"] = time.time()
+        return sample
+    
+    def _load_previous(self) -> Optional[Dict[str, Any]]:
+        """Предыдущий снимок"""
+        try:
+            return json.loads(KSM_STATE.read_text())
+        except (OSError, ValueError):
+            return None
+    
+    def decide(self, previous: Dict[str, Any], current: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Решение регулятора по двум снимкам
+        
+        Returns:
+            Метрики интервала и новые pages_to_scan/sleep_millisecs
+        """
+        elapsed = max(current["time"] - previous["time"], 1e-3)
+        cpu_delta = max(current["ksmd_cpu_seconds"] - previous["ksmd_cpu_seconds"], 0.0)
+        sharing_delta = current["pages_sharing"] - previous["pages_sharing"]
+        scans_delta = current["full_scans"] - previous["full_scans"]
+        # Много уникальных просканированных страниц на одну общую - ksmd работает впустую
+        unshared_ratio = current["pages_unshared"] / max(current["pages_sharing"], 1)
+        
+        cpu_percent = cpu_delta / elapsed * 100
+        efficiency = sharing_delta / cpu_delta if cpu_delta > 0 else 0.0
+        pages_to_scan = current["pages_to_scan"]
+        sleep_ms = current["sleep_millisecs"]
+        
+        if cpu_percent > self.cpu_budget:
+            action = "backoff_cpu"
+        elif sharing_delta <= 0 and scans_delta > 0:
+            # Полный проход без прироста - сканирование впустую
+            action = "backoff_no_gain"
+        elif sharing_delta <= 0 and unshared_ratio > KSM_MAX_UNSHARED_RATIO:
+            action = "backoff_unshared"
+        elif sharing_delta > 0 and efficiency >= KSM_MIN_EFFICIENCY and cpu_percent < self.cpu_budget * 0.75:
+            action = "raise"
+        else:
+            action = "hold"
+        
+        if action == "raise":
+            pages_to_scan = min(pages_to_scan * 2, KSM_PAGES_TO_SCAN_MAX)
+            sleep_ms = max(sleep_ms // 2, KSM_SLEEP_MS_MIN)
+        elif action.startswith("backoff"):
+            pages_to_scan = max(pages_to_scan // 2, KSM_PAGES_TO_SCAN_MIN)
+            sleep_ms = min(sleep_ms * 2, KSM_SLEEP_MS_MAX)
+        
+        return {
+            "action": action,
+            "cpu_percent": round(cpu_percent, 3),
+            "efficiency": round(efficiency, 1),
+            "sharing_delta": sharing_delta,
+            "full_scans_delta": scans_delta,
+            "unshared_ratio": round(unshared_ratio, 2),
+            "pages_to_scan": pages_to_scan,
+            "sleep_millisecs": sleep_ms
+        }
+    
+    def baseline(self) -> Dict[str, Any]:
+        """
+        Базовый замер без решения (конструктор оркестратора).
+        
+        Сохраненный замер службы не перезаписывается, иначе интервал
+        следующего шага задавали бы вызовы CLI.
+        """
+        current = self.sample()
+        if self._load_previous() is None:
+            KSM_STATE.write_text(json.dumps(current))
+        try:
+            last = json.loads(KVM_METRICS.read_text()).get("ksm", {})
+        except (OSError, ValueError):
+            last = {}
+        self.last = {
+            "action": "baseline",
+            "cpu_percent": last.get("cpu_percent", 0.0),
+            "saved_mb": round(current["pages_sharing"] * self.page_size / (1024 * 1024), 1)
+        }
+        return self.last
+    
+    def step(self) -> Dict[str, Any]:
+        """Один шаг регулятора: замер, решение, применение, метрики"""
+        current = self.sample()
+        previous = self._load_previous()
+        
+        if previous and current["time"] - previous["time"] < KSM_MIN_INTERVAL:
+            # Сохраненный замер слишком свежий: решение по нему - шум
+            return {"action": "wait", "elapsed": round(current["time"] - previous["time"], 1),
+                    "min_interval": KSM_MIN_INTERVAL,
+                    "pages_to_scan": current["pages_to_scan"],
+                    "sleep_millisecs": current["sleep_millisecs"]}
+        
+        result = {"action": "baseline", "cpu_percent": 0.0, "efficiency": 0.0,
+                  "pages_to_scan": current["pages_to_scan"],
+                  "sleep_millisecs": current["sleep_millisecs"]}
+        if previous:
+            result = self.decide(previous, current)
+            if result["pages_to_scan"] != current["pages_to_scan"]:
+                self._write("pages_to_scan", result["pages_to_scan"])
+            if result["sleep_millisecs"] != current["sleep_millisecs"]:
+                self._write("sleep_millisecs", result["sleep_millisecs"])
+            if result["action"] != "hold":
+                logger.info(f"🔄 KSM {result['action']}: pages_to_scan={result['pages_to_scan']}, "
+                            f"sleep={result['sleep_millisecs']}ms, ksmd CPU {result['cpu_percent']}%",
+                            extra={"rate_limit": True})
+        
+        KSM_STATE.write_text(json.dumps(current))
+        
+        result.update({
+            "pages_shared": current["pages_shared"],
+            "pages_sharing": current["pages_sharing"],
+            "pages_unshared": current["pages_unshared"],
+            "full_scans": current["full_scans"],
+            "saved_mb": round(current["pages_sharing"] * self.page_size / (1024 * 1024), 1),
+            "cpu_budget": self.cpu_budget,
+            "timestamp": datetime.now().isoformat()
+        })
+        self.last = result
+        self._export(result)
+        return result
+    
+    def _export(self, result: Dict[str, Any]):
+        """
+        Запись метрик в общий файл метрик KVM
+
+        Файл пишет и ConntrackManager: секция обновляется под flock
+        и заменяется атомарно, чтобы не терять чужие секции.
+        """
+        try:
+            KVM_METRICS.parent.mkdir(parents=True, exist_ok=True)
+            with open(KVM_METRICS_LOCK, "w") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    metrics = json.loads(KVM_METRICS.read_text()) if KVM_METRICS.exists() else {}
+                except (OSError, ValueError):
+                    metrics = {}
+                metrics["ksm"] = result
+                tmp = KVM_METRICS.with_suffix(".ksm.tmp")
+                tmp.write_text(json.dumps(metrics, indent=2))
+                tmp.replace(KVM_METRICS)
+        except OSError as e:
+            logger.warning(f"⚠️ Не удалось записать метрики: {e}")
+    
+    def start_monitoring(self, interval: int = KSM_INTERVAL):
+        """Запуск регулятора"""
+        self.running = True
+        self.monitor_thread = threading.Thread(target=self._monitor_loop, args=(interval,))
+        self.monitor_thread.daemon = True
+        self.monitor_thread.start()
+        logger.info(f"✅ Регулятор KSM запущен (бюджет CPU {self.cpu_budget}%)")
+    
+    def _monitor_loop(self, interval: int):
+        """Цикл регулятора"""
+        while self.running:
+            try:
+                self.step()
+            except Exception as e:
+                logger.error(f"❌ Ошибка регулятора KSM: {e}")
+            time.sleep(interval)
 
 # ============================================================================
 # ОСНОВНОЙ КЛАСС ОРКЕСТРАТОРА
@@ -156,6 +501,7 @@ class SentinelKVMOrchestrator:
     """
     
     def __init__(self):
+        init_runtime()
         self.version = SENTINEL_VERSION
         self.codename = SENTINEL_CODENAME
         self.running = False
@@ -164,14 +510,25 @@ class SentinelKVMOrchestrator:
         self.virtio_devices: List[KVMVirtIODevice] = []
         self.active_protocol: Optional[str] = None
         self.nftables_initialized = False
+        self.link_monitor = None
+        self.interface_manager = None
+        self.nic_tuner = None
+        self.ksm_controller: Optional[KSMController] = None
+        self.cgroups = None
+        self.pressure = None
+        self.memory_tuner = None
+        self.router = None
+        self.config: Dict[str, Any] = {}
         
         # Регистрируем обработчики сигналов
         signal.signal(signal.SIGINT, self._signal_handler)
         signal.signal(signal.SIGTERM, self._signal_handler)
         
         # Инициализация KVM-специфичных компонентов
-        self._init_kvm_environment()
-        self._load_configuration()
+        with PROFILER.phase("kvm_environment"):
+            self._init_kvm_environment()
+        with PROFILER.phase("configuration"):
+            self._load_configuration()
         
         logger.info(f"🚀 Sentinel KVM Orchestrator v{self.version} инициализирован")
         logger.info(f"📋 Режим: {self.codename}")
@@ -185,21 +542,22 @@ class SentinelKVMOrchestrator:
         logger.info("🔍 Инициализация KVM окружения...")
         
         # Определяем тип виртуализации
-        virt_type = self._get_virt_type()
+        with PROFILER.phase("virt_type"):
+            virt_type = self._get_virt_type()
         if "kvm" not in virt_type.lower():
             logger.warning(f"⚠️ Запущено не под KVM: {virt_type}")
         
         # Сканируем VirtIO устройства
-        self._scan_virtio_devices()
+        with PROFILER.phase("virtio_scan"):
+            self._scan_virtio_devices()
         
         # Инициализируем KSM для экономии памяти
-        self._init_ksm()
-        
-        # Настраиваем сетевые оптимизации
-        self._optimize_network()
+        with PROFILER.phase("ksm"):
+            self._init_ksm()
         
         # Обновляем информацию о ресурсах
-        self._update_kvm_resources()
+        with PROFILER.phase("resources"):
+            self._update_kvm_resources()
         
         logger.info(f"✅ KVM окружение инициализировано: {self.kvm_resources}")
     
@@ -216,18 +574,25 @@ class SentinelKVMOrchestrator:
     
     def _scan_virtio_devices(self):
         """Сканирование VirtIO устройств"""
-        # VirtIO сетевые устройства
-        for dev in VIRTIO_NET_DEVS:
-            if Path(f"/sys/class/net/{dev}").exists():
-                driver = self._get_device_driver(dev)
-                queues = self._get_net_queues(dev)
-                self.virtio_devices.append(KVMVirtIODevice(
-                    type=KVMVirtIOType.NET,
-                    name=dev,
-                    driver=driver,
-                    queues=queues
-                ))
-                logger.info(f"✅ VirtIO сеть: {dev} (драйвер: {driver}, очередей: {queues})")
+        # VirtIO сетевые устройства: все интерфейсы с драйвером virtio (enp*, ens*, eth*, hotplug)
+        try:
+            self.link_monitor = _load_sentinel_module("sentinel-netlink-kvm.py").LinkMonitor()
+            net_devices = [(i.name, i.driver, i.rx_queues)
+                           for i in self.link_monitor.refresh().values() if i.is_virtio]
+        except Exception as e:
+            logger.warning(f"⚠️ rtnetlink недоступен, сканирование sysfs: {e}")
+            net_devices = [(p.name, self._get_device_driver(p.name), self._get_net_queues(p.name))
+                           for p in sorted(Path("/sys/class/net").glob("*"))
+                           if "virtio" in self._get_device_driver(p.name)]
+
+        for dev, driver, queues in net_devices:
+            self.virtio_devices.append(KVMVirtIODevice(
+                type=KVMVirtIOType.NET,
+                name=dev,
+                driver=driver,
+                queues=queues
+            ))
+            logger.info(f"✅ VirtIO сеть: {dev} (драйвер: {driver}, очередей: {queues})")
         
         # VirtIO блочные устройства
         for dev in VIRTIO_BLK_DEVS:
@@ -275,47 +640,113 @@ class SentinelKVMOrchestrator:
             with open("/sys/kernel/mm/ksm/run", "w") as f:
                 f.write("1")
             
-            # Настраиваем параметры
-            with open("/sys/kernel/mm/ksm/pages_to_scan", "w") as f:
-                f.write("100")
-            
-            with open("/sys/kernel/mm/ksm/sleep_millisecs", "w") as f:
-                f.write("20")
+            # Параметры сканирования подбирает регулятор службы; здесь только базовый замер
+            self.ksm_controller = KSMController()
+            self.ksm_controller.baseline()
             
             logger.info("✅ KSM активирован для экономии памяти")
         except Exception as e:
             logger.warning(f"⚠️ Не удалось активировать KSM: {e}")
     
-    def _optimize_network(self):
-        """Оптимизация сети для VirtIO"""
-        for dev in self.virtio_devices:
-            if dev.type == KVMVirtIOType.NET:
-                try:
-                    # Увеличиваем размер очередей
-                    subprocess.run(
-                        f"ethtool -G {dev.name} rx 4096 tx 4096 2>/dev/null",
-                        shell=True
-                    )
-                    
-                    # Включаем все offloads
-                    subprocess.run(
-                        f"ethtool -K {dev.name} tx on rx on tso on gso on gro on 2>/dev/null",
-                        shell=True
-                    )
-                    
-                    logger.info(f"✅ Сетевые оптимизации для {dev.name}")
-                except:
-                    pass
+    def _optimize_network(self, force: bool = False) -> List[Dict[str, Any]]:
+        """Оптимизация сети для VirtIO (служба и команда nic-tune, не конструктор)"""
+        return [self._optimize_device(dev.name, force)
+                for dev in self.virtio_devices if dev.type == KVMVirtIOType.NET]
+    
+    def _get_interface_manager(self):
+        """Менеджер интерфейсов (rtnetlink + SIOCETHTOOL)"""
+        if self.interface_manager is None:
+            self.interface_manager = _load_sentinel_module("sentinel-netlink-kvm.py").InterfaceManager()
+        return self.interface_manager
+    
+    def _get_nic_tuner(self):
+        """Тюнер очередей/RPS/XPS/IRQ для VirtIO NIC"""
+        if self.nic_tuner is None:
+            netlink = _load_sentinel_module("sentinel-netlink-kvm.py")
+            # Активная проба (генератор нагрузки) задается оператором: kvm.nic_probe
+            command = self.config.get('kvm', {}).get('nic_probe')
+            probe = netlink.NICTuner.command_probe(command) if command else None
+            self.nic_tuner = netlink.NICTuner(manager=self._get_interface_manager(), probe=probe)
+        return self.nic_tuner
+    
+    def _optimize_device(self, name: str, force: bool = False) -> Dict[str, Any]:
+        """Оптимизация одного VirtIO сетевого устройства"""
+        try:
+            # Очереди по числу vCPU, RPS/XPS и IRQ affinity (с проверкой, если задана проба)
+            result = self._get_nic_tuner().tune(name, force=force)
+            for dev in self.virtio_devices:
+                if dev.type == KVMVirtIOType.NET and dev.name == name:
+                    dev.queues = result["settings"]["queues"]
+            
+            # GRO снижает нагрузку на CPU для входящего TCP; остальные offloads оставляем драйверу
+            self._get_interface_manager().set_offloads(name, gro=True)
+            
+            logger.info(f"✅ Сетевые оптимизации для {name}")
+            return result
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось оптимизировать {name}: {e}")
+            return {"dev": name, "error": str(e)}
+    
+    def start_link_monitor(self, router=None):
+        """
+        Отслеживание hotplug интерфейсов через rtnetlink.
+        
+        Новые VirtIO NIC сразу попадают в инвентарь и оптимизируются,
+        VPN интерфейсы передаются в набор vpn_ifaces роутера.
+        
+        Args:
+            router: Экземпляр KVMNFTablesRouter (опционально)
+        """
+        if self.link_monitor is None:
+            self.link_monitor = _load_sentinel_module("sentinel-netlink-kvm.py").LinkMonitor()
+        
+        def on_event(event: str, info):
+            if not info.is_virtio:
+                return
+            known = {d.name: d for d in self.virtio_devices if d.type == KVMVirtIOType.NET}
+            if event == "removed":
+                self.virtio_devices = [d for d in self.virtio_devices
+                                       if not (d.type == KVMVirtIOType.NET and d.name == info.name)]
+            elif info.name not in known:
+                self.virtio_devices.append(KVMVirtIODevice(
+                    type=KVMVirtIOType.NET,
+                    name=info.name,
+                    driver=info.driver,
+                    queues=info.rx_queues
+                ))
+                self._optimize_device(info.name)
+            else:
+                known[info.name].queues = info.rx_queues
+            self.kvm_resources.virtio_net_count = sum(
+                1 for d in self.virtio_devices if d.type == KVMVirtIOType.NET
+            )
+        
+        self.link_monitor.subscribe(on_event)
+        if router is not None:
+            router.watch_interfaces(self.link_monitor)
+        self.link_monitor.start_monitoring()
+        return self.link_monitor
     
     def _update_kvm_resources(self):
         """Обновление информации о ресурсах KVM"""
         try:
+            import psutil
+            
             # Память
             mem = psutil.virtual_memory()
             self.kvm_resources.memory_total = mem.total // (1024 * 1024)
             self.kvm_resources.memory_available = mem.available // (1024 * 1024)
             self.kvm_resources.memory_used = mem.used // (1024 * 1024)
             
+            # Balloon: доступная память уменьшается на прогноз изъятия хостом
+            if self.memory_tuner is not None:
+                prediction = self.memory_tuner.predict()
+                sample = self.memory_tuner.samples[-1]
+                self.kvm_resources.balloon_size = prediction["inflated_mb"]
+                self.kvm_resources.balloon_reclaim_mb = prediction["predicted_reclaim_mb"]
+                self.kvm_resources.memory_available = prediction["effective_available_mb"]
+                self.kvm_resources.hugepages_total = sample["hugepages_total"]
+            
             # CPU
             self.kvm_resources.cpu_count = psutil.cpu_count()
             self.kvm_resources.cpu_usage = psutil.cpu_percent(interval=0.1)
@@ -340,8 +771,63 @@ class SentinelKVMOrchestrator:
             except:
                 pass
             
+            if self.ksm_controller and self.ksm_controller.last:
+                self.kvm_resources.ksm_saved_mb = self.ksm_controller.last["saved_mb"]
+                self.kvm_resources.ksm_cpu_percent = self.ksm_controller.last["cpu_percent"]
+            
         except Exception as e:
             logger.error(f"❌ Ошибка обновления ресурсов KVM: {e}")
+        
+        # Таблица conntrack (procfs, без psutil)
+        self._update_conntrack()
+    
+    def _update_conntrack(self) -> List[Dict[str, Any]]:
+        """Заполнение таблицы conntrack и алерт при приближении к nf_conntrack_max"""
+        try:
+            with open("/proc/sys/net/netfilter/nf_conntrack_count", "r") as f:
+                count = int(f.read().strip())
+            with open("/proc/sys/net/netfilter/nf_conntrack_max", "r") as f:
+                maximum = int(f.read().strip())
+        except (OSError, ValueError):
+            return []
+        
+        usage = count / maximum if maximum else 0.0
+        self.kvm_resources.conntrack_count = count
+        self.kvm_resources.conntrack_max = maximum
+        self.kvm_resources.conntrack_usage = usage
+        
+        # Менеджер службы сам наращивает таблицу при критическом заполнении
+        conntrack = getattr(self.router, "conntrack", None)
+        if conntrack is not None:
+            return conntrack.check_usage({"count": count, "max": maximum, "usage": usage})
+        
+        if usage >= CONNTRACK_CRIT_USAGE:
+            level = "critical"
+            logger.error(f"❌ conntrack почти заполнен: {count}/{maximum} ({usage:.0%}), "
+                         f"новые потоки будут отброшены")
+        elif usage >= CONNTRACK_WARN_USAGE:
+            level = "warning"
+            logger.warning(f"⚠️ conntrack: {count}/{maximum} ({usage:.0%})")
+        else:
+            return []
+        return [{"level": level, "count": count, "max": maximum, "usage": usage,
+                 "timestamp": datetime.now().isoformat()}]
+    
+    def _tune_conntrack(self, monitor: bool = True) -> Dict[str, Any]:
+        """
+        Размер таблицы conntrack под память VM (sentinel-nftables-kvm.py).
+        
+        Args:
+            monitor: Запустить мониторинг nf_conntrack_count (служба)
+        """
+        try:
+            if self.router is None:
+                nftables = _load_sentinel_module("sentinel-nftables-kvm.py")
+                self.router = nftables.KVMNFTablesRouter(asdict(self.kvm_resources))
+            return self.router.tune_conntrack(monitor=monitor)
+        except Exception as e:
+            logger.error(f"❌ Ошибка настройки conntrack: {e}")
+            return {}
     
     # ========================================================================
     # NFTABLES МЕТОДЫ (ЧИСТАЯ АРХИТЕКТУРА)
@@ -421,22 +907,34 @@ table inet sentinel {
     chain prerouting {
         type filter hook prerouting priority -150; policy accept;
         
+        # Поток уже классифицирован: восстанавливаем решение из ct mark
+        # (бит 0x2 - поток классифицирован, 0x1 - прямой доступ; остальные биты не трогаем)
+        ct mark & 0x00000003 == 0x00000003 meta mark set meta mark | 0x00000001 accept
+        ct mark & 0x00000003 == 0x00000002 accept
+        
+        # Первый пакет потока: классификация и сохранение в ct mark
+        jump classify
+        meta mark & 0x00000001 == 0x00000001 ct mark set ct mark & 0xfffffffc | 0x00000003
+        meta mark & 0x00000001 == 0x00000000 ct mark set ct mark & 0xfffffffc | 0x00000002
+    }
+    
+    # Классификация по кортежу исходного направления (первым может прийти ответ)
+    chain classify {
         # Прямой доступ для GEOIP
-        ip saddr @geoip_ru meta mark set 0x00000001
-        ip saddr @geoip_su meta mark set 0x00000001
+        ct original ip saddr @geoip_ru meta mark set meta mark | 0x00000001 return
+        ct original ip saddr @geoip_su meta mark set meta mark | 0x00000001 return
         
         # Прямой доступ для торрентов
-        tcp dport @ports_direct meta mark set 0x00000001
-        udp dport @ports_direct meta mark set 0x00000001
+        meta l4proto { tcp, udp } ct original proto-dst @ports_direct meta mark set meta mark | 0x00000001 return
         
         # Прямой доступ для IP сервера
-        ip saddr @ips_direct meta mark set 0x00000001
-        ip daddr @ips_direct meta mark set 0x00000001
+        ct original ip saddr @ips_direct meta mark set meta mark | 0x00000001 return
+        ct original ip daddr @ips_direct meta mark set meta mark | 0x00000001 return
     }
     
     chain output {
         type route hook output priority -150; policy accept;
-        meta mark 0x00000001 return
+        meta mark & 0x00000001 == 0x00000001 return
     }
 }
 
@@ -469,6 +967,19 @@ table inet sentinel_dns {
     
     def check_resources(self, protocol: str) -> bool:
         """Проверка доступности ресурсов для протокола"""
+        # Решение по Pressure Stall Information: запуск откладывается под давлением
+        if self.pressure is None:
+            cgroup = _load_sentinel_module("sentinel-cgroup-kvm.py")
+            self.pressure = cgroup.PressureMonitor(self._get_cgroup_manager(), self.memory_tuner)
+        if self.pressure.available:
+            proto_type = self.protocols[protocol].type.value if protocol in self.protocols else protocol
+            result = self.pressure.wait_for_admission(proto_type)
+            if result["decision"] != "admit":
+                logger.error(f"❌ Запуск {protocol} отклонен ({result['decision']}): {result['reason']}")
+                return False
+            return True
+        
+        # Без PSI: фиксированные пороги
         self._update_kvm_resources()
         
         # Проверка памяти
@@ -484,6 +995,55 @@ table inet sentinel_dns {
         
         return True
     
+    def _get_cgroup_manager(self):
+        """Менеджер cgroup v2 (общий с KVMServiceManager)"""
+        if self.cgroups is None:
+            cgroup = _load_sentinel_module("sentinel-cgroup-kvm.py")
+            self.cgroups = cgroup.CgroupManager(config={
+                "resources": self.config.get("resources", {}),
+                "protocols": self.config.get("protocols", {})
+            })
+            self.cgroups.setup()
+        return self.cgroups
+    
+    def _init_memory_tuning(self):
+        """Учет balloon по kvm.* из sentinel.yaml (без записи системных настроек)"""
+        kvm_config = self.config.get('kvm', {})
+        try:
+            cgroup = _load_sentinel_module("sentinel-cgroup-kvm.py")
+            self.memory_tuner = cgroup.MemoryTuner(balloon=kvm_config.get('balloon_driver', True))
+            self.memory_tuner.sample()
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось настроить память: {e}")
+            self.memory_tuner = None
+    
+    def _apply_memory_tuning(self):
+        """
+        Системный режим THP и резерв hugepages (только служба и только если заданы).
+        kvm.thp меняет режим всего хоста, поэтому в sentinel.yaml по умолчанию не задан.
+        """
+        if self.memory_tuner is None:
+            return
+        kvm_config = self.config.get('kvm', {})
+        try:
+            if kvm_config.get('thp'):
+                self.memory_tuner.apply_thp(kvm_config['thp'])
+            if kvm_config.get('hugepages', False):
+                self.memory_tuner.reserve_hugepages(kvm_config.get('hugepages_mb', 256))
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось настроить память: {e}")
+    
+    def _thp_policy(self, policy: Optional[str]):
+        """Контекст политики THP для запуска службы"""
+        if self.memory_tuner is None:
+            return contextlib.nullcontext()
+        return self.memory_tuner.thp_policy(policy)
+    
+    def protect_memory(self):
+        """Ужесточение лимита Sentinel при раздувании balloon"""
+        if self.memory_tuner is not None and self.memory_tuner.balloon:
+            self.memory_tuner.protect(self._get_cgroup_manager())
+    
     def set_memory_limit(self, protocol: str, limit_mb: int):
         """Установка лимита памяти для протокола (cgroups)"""
         if protocol not in self.protocols:
@@ -492,20 +1052,50 @@ table inet sentinel_dns {
         try:
             pid = self._get_protocol_pid(protocol)
             if pid:
-                # Используем cgroups для ограничения памяти
-                cgroup_path = f"/sys/fs/cgroup/memory/sentinel/{protocol}"
-                os.makedirs(cgroup_path, exist_ok=True)
-                
-                with open(f"{cgroup_path}/memory.limit_in_bytes", "w") as f:
-                    f.write(str(limit_mb * 1024 * 1024))
-                
-                with open(f"{cgroup_path}/tasks", "w") as f:
-                    f.write(str(pid))
-                
-                logger.info(f"✅ Лимит памяти {limit_mb}MB установлен для {protocol}")
+                cgroups = self._get_cgroup_manager()
+                if cgroups.create(protocol):
+                    cgroups.apply_limits(protocol, {"memory_limit_mb": limit_mb})
+                    cgroups.attach(protocol, pid)
+                    logger.info(f"✅ Лимит памяти {limit_mb}MB установлен для {protocol}")
         except Exception as e:
             logger.error(f"❌ Ошибка установки лимита памяти: {e}")
     
+    def plan_cpu_pinning(self) -> Dict[str, Any]:
+        """План cpuset для всех включенных протоколов (kvm.cpu_pinning)"""
+        cgroup = _load_sentinel_module("sentinel-cgroup-kvm.py")
+        planner = cgroup.CPUPinningPlanner(self._get_cgroup_manager())
+        enabled = [p.type.value for p in self.protocols.values() if p.enabled] or \
+                  [p.type.value for p in self.protocols.values()]
+        return planner.plan(sorted(set(enabled)))
+    
+    def apply_cpu_pinning(self, protocol: str) -> Optional[str]:
+        """Привязка протокола к cpuset по плану, если включено kvm.cpu_pinning"""
+        if not self.config.get('kvm', {}).get('cpu_pinning') or protocol not in self.protocols:
+            return None
+        try:
+            proto_type = self.protocols[protocol].type.value
+            plan = self.plan_cpu_pinning()["protocols"].get(proto_type)
+            if not plan:
+                return None
+            cgroup = _load_sentinel_module("sentinel-cgroup-kvm.py")
+            planner = cgroup.CPUPinningPlanner(self._get_cgroup_manager())
+            method = planner.apply(protocol, plan["cpus"], self._get_protocol_pid(protocol))
+            logger.info(f"✅ {protocol}: CPU {plan['cpus']} ({plan['mode']}, {method})")
+            return plan["cpus"]
+        except Exception as e:
+            logger.error(f"❌ Ошибка привязки к CPU: {e}")
+            return None
+    
+    def apply_protocol_limits(self, protocol: str) -> Dict[str, str]:
+        """Применение лимитов protocols.<имя> из sentinel.yaml к запущенному протоколу"""
+        try:
+            pid = self._get_protocol_pid(protocol)
+            proto_type = self.protocols[protocol].type.value
+            return self._get_cgroup_manager().setup_protocol(protocol, pid, proto_type, protocol)
+        except Exception as e:
+            logger.error(f"❌ Ошибка применения лимитов cgroup: {e}")
+            return {}
+    
     # ========================================================================
     # ПАРСИНГ КЛЮЧЕЙ (ОПТИМИЗИРОВАННЫЙ)
     # ========================================================================
@@ -604,8 +1194,11 @@ table inet sentinel_dns {
     
     def _get_optimal_queues(self) -> int:
         """Получение оптимального количества очередей для VirtIO"""
-        cpu_count = psutil.cpu_count()
-        return min(cpu_count, 8)  # Максимум 8 очередей для VirtIO
+        # Фактически настроенные тюнером очереди, иначе оценка по vCPU
+        tuned = [d.queues for d in self.virtio_devices if d.type == KVMVirtIOType.NET]
+        if self.nic_tuner is not None and tuned:
+            return max(tuned)
+        return min(os.cpu_count() or 1, 8)  # Максимум 8 очередей для VirtIO
     
     def _get_kvm_optimizations(self, protocol: str) -> Dict[str, Any]:
         """Получение KVM-специфичных оптимизаций для протокола"""
@@ -619,6 +1212,10 @@ table inet sentinel_dns {
         if protocol in ["wireguard", "amneziawg"]:
             optimizations["multiqueue"] = True
             optimizations["rx_queues"] = self._get_optimal_queues()
+            if self.nic_tuner is not None:
+                optimizations["nic_tuning"] = {
+                    dev: best["settings"] for dev, best in self.nic_tuner.best.items()
+                }
         
         elif protocol in ["xray", "sing-box"]:
             optimizations["tcp_fastopen"] = True
@@ -654,18 +1251,22 @@ table inet sentinel_dns {
         try:
             # Запуск через systemd или init.d
             if Path(f"/etc/init.d/{protocol}").exists():
-                result = subprocess.run(
-                    f"/etc/init.d/{protocol} start",
-                    shell=True, capture_output=True, text=True
-                )
+                # Политика THP службы (protocols.<имя>.thp) наследуется запущенным процессом
+                thp = self.config.get('protocols', {}).get(protocol, {}).get('thp')
+                with self._thp_policy(thp):
+                    result = subprocess.run(
+                        f"/etc/init.d/{protocol} start",
+                        shell=True, capture_output=True, text=True
+                    )
                 
                 if result.returncode == 0:
                     proto_config.status = ProtocolStatus.RUNNING
                     proto_config.start_time = datetime.now()
                     
-                    # Установка лимитов для ресурсоемких протоколов
-                    if protocol in ["adguardhome", "xray", "hysteria2"]:
-                        self.set_memory_limit(protocol, 512)
+                    # Лимиты cgroup v2 из конфигурации (с умолчаниями для ресурсоемких протоколов)
+                    self.apply_protocol_limits(protocol)
+                    self.apply_cpu_pinning(protocol)
+                    self.protect_memory()
                     
                     logger.info(f"✅ Протокол {protocol} запущен")
                     return True
@@ -704,9 +1305,7 @@ table inet sentinel_dns {
                     proto_config.start_time = None
                     
                     # Очистка cgroups
-                    cgroup_path = f"/sys/fs/cgroup/memory/sentinel/{protocol}"
-                    if Path(cgroup_path).exists():
-                        subprocess.run(f"rmdir {cgroup_path}", shell=True)
+                    self._get_cgroup_manager().remove(protocol)
                     
                     logger.info(f"✅ Протокол {protocol} остановлен")
                     return True
@@ -790,8 +1389,16 @@ table inet sentinel {{
     chain mangle {{
         type filter hook prerouting priority -150; policy accept;
         
-        # GEOIP (загружается динамически)
-        ip saddr {{ 95.0.0.0/8, 94.0.0.0/8 }} meta mark set 0x01
+        # Поток уже классифицирован: восстанавливаем решение из ct mark (биты 0x03)
+        ct mark & 0x03 == 0x03 meta mark set meta mark | 0x01 accept
+        ct mark & 0x03 == 0x02 accept
+        
+        # GEOIP (загружается динамически), по источнику исходного направления
+        ct original ip saddr {{ 95.0.0.0/8, 94.0.0.0/8 }} meta mark set meta mark | 0x01
+        
+        # Сохраняем решение для остальных пакетов потока
+        meta mark & 0x01 == 0x01 ct mark set ct mark & 0xfffffffc | 0x03
+        meta mark & 0x01 == 0x00 ct mark set ct mark & 0xfffffffc | 0x02
     }}
     
     # Форвардинг
@@ -799,7 +1406,7 @@ table inet sentinel {{
         type filter hook forward priority 0; policy drop;
         
         # Разрешаем маркированный трафик
-        meta mark 0x01 accept
+        meta mark & 0x01 == 0x01 accept
         
         # Разрешаем VPN трафик
         oifname "wg0" accept
@@ -832,18 +1439,28 @@ table inet sentinel_dns {{
         """Загрузка конфигурации"""
         if MAIN_CONFIG.exists():
             try:
+                import yaml
                 with open(MAIN_CONFIG, 'r') as f:
                     config = yaml.safe_load(f)
-                    
-                if 'protocols' in config:
-                    for name, proto_config in config['protocols'].items():
+                self.config = config or {}
+                
+                kvm_config = self.config.get('kvm', {})
+                if self.ksm_controller:
+                    self.ksm_controller.cpu_budget = kvm_config.get('ksm_cpu_budget', KSM_CPU_BUDGET)
+                
+                if 'protocols' in self.config:
+                    for name, proto_config in self.config['protocols'].items():
                         self.protocols[name] = ProtocolConfig(
                             name=name,
                             type=ProtocolType(proto_config.get('type', 'wireguard')),
                             enabled=proto_config.get('enabled', False),
-                            auto_start=proto_config.get('auto_start', False)
+                            auto_start=proto_config.get('auto_start', False),
+                            memory_limit_mb=proto_config.get('memory_limit_mb'),
+                            cpu_quota=proto_config.get('cpu_quota')
                         )
                 
+                with PROFILER.phase("memory_tuning"):
+                    self._init_memory_tuning()
                 logger.info("✅ Конфигурация загружена")
             except Exception as e:
                 logger.error(f"❌ Ошибка загрузки: {e}")
@@ -864,6 +1481,7 @@ table inet sentinel_dns {{
     def _get_process_memory(self, pid: int) -> Optional[float]:
         """Получение использования памяти процессом"""
         try:
+            import psutil
             process = psutil.Process(pid)
             return process.memory_info().rss / 1024 / 1024
         except:
@@ -872,6 +1490,7 @@ table inet sentinel_dns {{
     def _get_process_cpu(self, pid: int) -> Optional[float]:
         """Получение использования CPU процессом"""
         try:
+            import psutil
             process = psutil.Process(pid)
             return process.cpu_percent(interval=0.1)
         except:
@@ -890,12 +1509,35 @@ table inet sentinel_dns {{
     
     def _get_system_info(self) -> Dict[str, Any]:
         """Получение системной информации"""
+        import psutil
         return {
             "hostname": socket.gethostname(),
             "load": psutil.getloadavg(),
             "connections": len(psutil.net_connections())
         }
     
+    def run_daemon(self):
+        """
+        Основной цикл службы (procd: sentinel-core-kvm daemon).
+        
+        Операции, меняющие состояние ядра, и регуляторы запускаются только
+        здесь: команды CLI строят оркестратор без побочных эффектов.
+        """
+        self.running = True
+        with PROFILER.phase("memory"):
+            self._apply_memory_tuning()
+        with PROFILER.phase("network"):
+            self._optimize_network()
+        with PROFILER.phase("conntrack"):
+            self._tune_conntrack(monitor=True)
+        self.start_link_monitor()
+        # Бюджет ksm_cpu_budget уже применен _load_configuration
+        if self.ksm_controller:
+            self.ksm_controller.start_monitoring(KSM_INTERVAL)
+        logger.info("✅ Служба Sentinel KVM запущена")
+        while self.running:
+            time.sleep(1)
+    
     def _signal_handler(self, sig, frame):
         """Обработчик сигналов"""
         logger.info("🛑 Получен сигнал завершения")
@@ -921,17 +1563,107 @@ def main():
     
     parser.add_argument(
         'command',
-        choices=['status', 'start', 'stop', 'restart', 'apply-rules', 'kvm-info'],
+        choices=['status', 'start', 'stop', 'restart', 'apply-rules', 'kvm-info', 'ksm-tune', 'conntrack-tune', 'cpu-pinning', 'subscriptions', 'parse',
+                 'nic-tune', 'daemon'],
         help='Команда для выполнения'
     )
     
     parser.add_argument('--protocol', '-p', help='Протокол')
     parser.add_argument('--json', action='store_true', help='JSON вывод')
+    parser.add_argument('--bench', action='store_true', help='cpu-pinning: синтетическая оценка (loopback UDP echo) с привязкой и без')
+    parser.add_argument('--profile', nargs='?', const='-', metavar='FILE',
+                        help='Разбивка запуска по фазам: таблица в stderr или JSON в FILE')
+    parser.add_argument('--cprofile', metavar='FILE', help='Сохранить статистику cProfile (pstats)')
+    parser.add_argument('--stats', action='store_true', help='parse: метрики кэша разбора в stderr')
+    parser.add_argument('--force', action='store_true', help='nic-tune: пересчитать сохраненные настройки')
     
     args = parser.parse_args()
     
-    orchestrator = SentinelKVMOrchestrator()
+    # Разбор ключа не требует оркестратора: без тюнинга ядра, в stdout только результат
+    if args.command == 'parse':
+        init_runtime(console=False)
+        _run_parse(args)
+        return
+    
+    init_runtime(daemon=args.command == 'daemon')
+    profile = None
+    if args.profile:
+        PROFILER.enable()
+    if args.cprofile:
+        import cProfile
+        profile = cProfile.Profile()
+        profile.enable()
+    
+    with PROFILER.phase("init"):
+        orchestrator = SentinelKVMOrchestrator()
     
+    try:
+        with PROFILER.phase(f"command:{args.command}"):
+            _run_command(orchestrator, args)
+    finally:
+        if profile is not None:
+            profile.disable()
+            profile.dump_stats(args.cprofile)
+        if args.profile == '-':
+            print(PROFILER.format_table(), file=sys.stderr)
+        elif args.profile:
+            Path(args.profile).write_text(json.dumps(PROFILER.report(), indent=2, ensure_ascii=False))
+
+
+def _parse_resources() -> Dict[str, Any]:
+    """Ресурсы гостя для парсера без инициализации оркестратора"""
+    memory_mb = 0
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemTotal:"):
+                    memory_mb = int(line.split()[1]) // 1024
+                    break
+    except (OSError, ValueError):
+        pass
+    virtio_net = any(
+        os.path.basename(os.path.realpath(path)) == "virtio_net"
+        for path in Path("/sys/class/net").glob("*/device/driver")
+    )
+    cpu_count = os.cpu_count() or 1
+    return {
+        "cpu_count": cpu_count,
+        "memory_mb": memory_mb,
+        "virtio_net": virtio_net,
+        "virtio_queues": cpu_count
+    }
+
+
+def _run_parse(args):
+    """Команда parse: ключ из stdin (protocols_add.lua), повтор - из дискового кэша"""
+    parser_module = _load_sentinel_module("sentinel-parser-kvm.py")
+    cache_config = {}
+    try:
+        import yaml
+        with open(MAIN_CONFIG, 'r') as f:
+            cache_config = (yaml.safe_load(f) or {}).get('parse_cache') or {}
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logger.warning(f"⚠️ Секция parse_cache не загружена: {e}")
+    cache = parser_module.ParseCache(
+        max_entries=cache_config.get('max_entries', parser_module.PARSE_CACHE_SIZE),
+        disk_dir=cache_config.get('disk_dir', parser_module.PARSE_CACHE_DIR),
+        disk_entries=cache_config.get('disk_entries', parser_module.PARSE_CACHE_DISK_ENTRIES)
+    )
+    parser = parser_module.KVMProtocolParser(_parse_resources(), cache=cache)
+    result = parser.parse(args.protocol or 'auto', sys.stdin.read())
+    if args.json:
+        print(json.dumps(result, indent=2, ensure_ascii=False))
+    else:
+        state = "✅" if result.get("parsed") else "❌"
+        print(f"{state} {result.get('protocol')}: {result.get('errors') or 'OK'}")
+    if args.stats:
+        print(json.dumps(cache.stats(), indent=2), file=sys.stderr)
+
+
+def _run_command(orchestrator: SentinelKVMOrchestrator, args):
+    """Выполнение команды CLI"""
     if args.command == 'status':
         result = orchestrator.status()
         if args.json:
@@ -944,6 +1676,38 @@ def main():
         print("\n🔍 KVM Information:")
         print(json.dumps(result['kvm'], indent=2, default=str))
     
+    elif args.command == 'cpu-pinning':
+        result = {"plan": orchestrator.plan_cpu_pinning()}
+        if args.bench:
+            cgroup = _load_sentinel_module("sentinel-cgroup-kvm.py")
+            planner = cgroup.CPUPinningPlanner(orchestrator._get_cgroup_manager())
+            protocol = args.protocol or next(iter(result["plan"]["protocols"]), "wireguard")
+            result["benchmark"] = planner.benchmark(protocol)
+        print(json.dumps(result, indent=2))
+    
+    elif args.command == 'subscriptions':
+        subscription = _load_sentinel_module("sentinel-subscription-kvm.py")
+        sources = subscription.load_sources(orchestrator.config)
+        print(json.dumps(subscription.SubscriptionPipeline(sources).refresh(), indent=2, ensure_ascii=False))
+    
+    elif args.command == 'nic-tune':
+        print(json.dumps(orchestrator._optimize_network(force=args.force), indent=2, ensure_ascii=False))
+    
+    elif args.command == 'daemon':
+        orchestrator.run_daemon()
+    
+    elif args.command == 'ksm-tune':
+        if not orchestrator.ksm_controller:
+            print("❌ KSM недоступен")
+            sys.exit(1)
+        print(json.dumps(orchestrator.ksm_controller.step(), indent=2))
+    
+    elif args.command == 'conntrack-tune':
+        plan = orchestrator._tune_conntrack(monitor=False)
+        print(json.dumps(plan, indent=2))
+        if not plan.get("applied"):
+            sys.exit(1)
+    
     elif args.command == 'apply-rules':
         success = orchestrator.apply_rules()
         print(f"{'✅' if success else '❌'} Правила применены")
@@ -415,10 +415,31 @@ function ajax_logs()
     local http = require "luci.http"
     local json = require "luci.jsonc"
     
-    local logfile = http.formvalue("file") or "/var/log/sentinel-core.log"
+    local util = require "luci.util"
+    
+    local logfile = http.formvalue("file") or "/var/run/sentinel/logs/sentinel-core.log"
     local lines = tonumber(http.formvalue("lines")) or 100
     
-    local logs = luci.sys.exec(string.format("tail -n %d %s 2>/dev/null", lines, logfile))
+    -- Журналы Sentinel читаются через индекс: хвост после смещения,
+    -- интервал времени и фильтр по уровню/компоненту без перечитывания файла
+    if logfile:match("^/var/run/sentinel/logs/") then
+        local cmd = string.format("/usr/bin/python3 /usr/bin/sentinel-logindex-kvm query --file %s --limit %d",
+            util.shellquote(logfile), lines)
+        local params = {since = "--since", generation = "--generation", from = "--from", to = "--to",
+                        level = "--level", component = "--component"}
+        for name, flag in pairs(params) do
+            local value = http.formvalue(name)
+            if value and #value > 0 then
+                cmd = cmd .. " " .. flag .. " " .. util.shellquote(value)
+            end
+        end
+        
+        http.prepare_content("application/json")
+        http.write(luci.sys.exec(cmd .. " 2>/dev/null"))
+        return
+    end
+    
+    local logs = luci.sys.exec(string.format("tail -n %d %s 2>/dev/null", lines, util.shellquote(logfile)))
     
     http.prepare_content("application/json")
     http.write(json.stringify({
@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+SENTINEL OS KVM - Asynchronous Structured Logging
+=================================================
+Логирование через QueueHandler/QueueListener: вызывающий поток только
+кладет запись в очередь, запись на диск идет в отдельном потоке.
+Формат - JSON lines в runtime-каталоге на tmpfs с ротацией по размеру
+и сжатием gzip, уровни по компонентам и ограничение частоты
+повторяющихся сообщений из циклов мониторинга.
+"""
+
+import os
+import sys
+import gzip
+import json
+import time
+import re
+import yaml
+import queue
+import shutil
+import atexit
+import logging
+import threading
+import logging.handlers
+from pathlib import Path
+from datetime import datetime, timezone
+from typing import Dict, Any, Optional, Tuple
+
+RUNTIME_LOG_DIR = Path("/var/run/sentinel/logs")
+MAIN_CONFIG = Path("/etc/sentinel/sentinel.yaml")
+
+# Умолчания секции logging в sentinel.yaml
+DEFAULT_LOGGING = {
+    "level": "INFO",
+    "levels": {},
+    "dir": str(RUNTIME_LOG_DIR),
+    "max_size_kb": 1024,
+    "backups": 5,
+    "console": True,
+    "rotate": True,
+    "rate_limit": {
+        "interval": 60,
+        "burst": 5,
+        "sample": 20
+    }
+}
+
+QUEUE_SIZE = 10000
+CONSOLE_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+# Служебные атрибуты LogRecord, которые не попадают в поле extra
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime", "rate_limit"}
+
+# Участие в выборке повторов: logger.info(..., extra=RATE_LIMITED)
+RATE_LIMITED = {"rate_limit": True}
+_NUMBER = re.compile(r"\d+(?:\.\d+)?")
+
+_listener: Optional[logging.handlers.QueueListener] = None
+_listener_lock = threading.Lock()
+
+
+# ============================================================================
+# ФОРМАТ И ФИЛЬТРЫ
+# ============================================================================
+
+class JSONLineFormatter(logging.Formatter):
+    """Одна запись - одна строка JSON"""
+
+    def __init__(self, component: str):
+        super().__init__()
+        self.component = component
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "component": record.name,
+            "process": self.component,
+            "msg": record.getMessage()
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRS and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Ограничение повторяющихся сообщений циклов мониторинга.
+
+    Действует только на записи с extra=RATE_LIMITED ниже WARNING:
+    предупреждения и ошибки не отбрасываются никогда. Ключ - место вызова
+    и шаблон сообщения (числа заменены), поэтому f-строки с меняющимися
+    счетчиками считаются одним сообщением, а разные имена - разными.
+    За интервал пропускаются первые burst записей, затем каждая sample-я;
+    число подавленных добавляется в следующую пропущенную запись
+    (поле suppressed).
+    """
+
+    def __init__(self, interval: float = 60, burst: int = 5, sample: int = 20):
+        super().__init__()
+        self.interval = interval
+        self.burst = burst
+        self.sample = max(sample, 1)
+        self._windows: Dict[Tuple[str, int, str], list] = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING or not getattr(record, "rate_limit", False):
+            return True
+
+        template = record.msg if record.args else _NUMBER.sub("#", str(record.msg))
+        key = (record.pathname, record.lineno, template)
+        now = record.created
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None or now - window[0] >= self.interval:
+                suppressed = window[2] if window else 0
+                window = [now, 0, 0]
+                self._windows[key] = window
+                if suppressed:
+                    record.suppressed = suppressed
+
+            window[1] += 1
+            count = window[1]
+            if count <= self.burst or (count - self.burst) % self.sample == 0:
+                if window[2] and not hasattr(record, "suppressed"):
+                    record.suppressed = window[2]
+                    window[2] = 0
+                return True
+
+            window[2] += 1
+            return False
+
+
+class ComponentLevelFilter(logging.Filter):
+    """Уровни по компонентам (logging.levels: {sentinel-service-kvm: DEBUG})"""
+
+    def __init__(self, default: int, levels: Dict[str, int]):
+        super().__init__()
+        self.default = default
+        self.levels = levels
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        name = record.name
+        while name:
+            if name in self.levels:
+                return record.levelno >= self.levels[name]
+            name = name.rpartition(".")[0]
+        return record.levelno >= self.default
+
+
+# ============================================================================
+# РОТАЦИЯ СО СЖАТИЕМ
+# ============================================================================
+
+def _gzip_namer(name: str) -> str:
+    """Имя архива ротации"""
+    return name + ".gz"
+
+
+def _gzip_rotator(source: str, dest: str):
+    """Сжатие ротированного файла (в потоке QueueListener)"""
+    with open(source, "rb") as src, gzip.open(dest, "wb", compresslevel=6) as dst:
+        shutil.copyfileobj(src, dst)
+    os.remove(source)
+
+
+def make_file_handler(path: Path, max_bytes: int, backups: int, rotate: bool = True) -> logging.Handler:
+    """
+    RotatingFileHandler с gzip-архивами
+
+    Файл ротирует только один процесс-владелец (служба). Остальные
+    процессы того же журнала (разовые команды CLI) получают
+    WatchedFileHandler: дописывают в конец и переоткрывают файл,
+    когда владелец его ротировал.
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    if not rotate:
+        return logging.handlers.WatchedFileHandler(path, encoding="utf-8")
+    handler = logging.handlers.RotatingFileHandler(
+        path, maxBytes=max_bytes, backupCount=backups, encoding="utf-8"
+    )
+    handler.namer = _gzip_namer
+    handler.rotator = _gzip_rotator
+    return handler
+
+
+# ============================================================================
+# НАСТРОЙКА
+# ============================================================================
+
+def load_logging_config(config: Dict[str, Any] = None) -> Dict[str, Any]:
+    """Секция logging из sentinel.yaml с умолчаниями"""
+    if config is None:
+        try:
+            with open(MAIN_CONFIG, "r") as f:
+                config = (yaml.safe_load(f) or {}).get("logging", {})
+        except (OSError, yaml.YAMLError):
+            config = {}
+
+    merged = dict(DEFAULT_LOGGING)
+    merged.update(config or {})
+    merged["rate_limit"] = {**DEFAULT_LOGGING["rate_limit"], **(config or {}).get("rate_limit", {})}
+    return merged
+
+
+def setup_logging(component: str, config: Dict[str, Any] = None, **overrides) -> Path:
+    """
+    Перевод корневого логгера на асинхронную запись
+
+    Args:
+        component: Имя процесса (имя файла журнала, например sentinel-core)
+        config: Секция logging (по умолчанию читается из sentinel.yaml)
+        overrides: Ключи поверх конфигурации (например console=False для CLI с JSON в stdout,
+            rotate=False для процессов, не владеющих ротацией)
+
+    Returns:
+        Путь к файлу журнала JSON lines
+    """
+    global _listener
+
+    config = load_logging_config(config)
+    config.update(overrides)
+    log_path = Path(config["dir"]) / f"{component}.log"
+    default_level = logging.getLevelName(str(config["level"]).upper())
+    levels = {name: logging.getLevelName(str(level).upper())
+              for name, level in config["levels"].items()}
+
+    handlers = [make_file_handler(log_path, int(config["max_size_kb"]) * 1024, int(config["backups"]),
+                                  rotate=bool(config["rotate"]))]
+    handlers[0].setFormatter(JSONLineFormatter(component))
+    if config["console"]:
+        console = logging.StreamHandler(sys.stderr)
+        console.setFormatter(logging.Formatter(CONSOLE_FORMAT))
+        handlers.append(console)
+
+    log_queue: queue.Queue = queue.Queue(QUEUE_SIZE)
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.addFilter(ComponentLevelFilter(default_level, levels))
+    queue_handler.addFilter(RateLimitFilter(**config["rate_limit"]))
+
+    with _listener_lock:
+        if _listener is not None:
+            _listener.stop()
+
+        root = logging.getLogger()
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+            handler.close()
+        root.addHandler(queue_handler)
+        # Отбор по уровню делает ComponentLevelFilter
+        root.setLevel(min([default_level] + list(levels.values())))
+
+        _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+        _listener.start()
+
+    return log_path
+
+
+def shutdown_logging():
+    """Дописывание очереди и остановка потока записи"""
+    global _listener
+    with _listener_lock:
+        if _listener is not None:
+            _listener.stop()
+            _listener = None
+
+
+atexit.register(shutdown_logging)
+
+
+# ============================================================================
+# ТЕСТИРОВАНИЕ
+# ============================================================================
+
+def test_logging():
+    """Тестирование асинхронного журнала"""
+    import tempfile
+
+    print("=" * 60)
+    print("ТЕСТИРОВАНИЕ ЛОГИРОВАНИЯ")
+    print("=" * 60)
+
+    tmp = Path(tempfile.mkdtemp(prefix="sentinel-logs-"))
+    path = setup_logging("sentinel-test", {
+        "dir": str(tmp),
+        "max_size_kb": 4,
+        "backups": 2,
+        "console": False,
+        "levels": {"sentinel-test.quiet": "WARNING"},
+        "rate_limit": {"interval": 60, "burst": 3, "sample": 50}
+    })
+    log = logging.getLogger("sentinel-test")
+
+    start = time.perf_counter()
+    for i in range(200):
+        log.info(f"📊 Итерация мониторинга {i}", extra=RATE_LIMITED)
+    elapsed = (time.perf_counter() - start) * 1000
+    logging.getLogger("sentinel-test.quiet").info("не должно попасть в журнал")
+    for i in range(100):
+        log.info("🔄 Запись %d", i, extra={"iteration": i, **RATE_LIMITED})
+    for name in ("wireguard", "openvpn", "xray", "tor", "byedpi", "zapret"):
+        log.error(f"❌ Ошибка запуска {name}")
+    shutdown_logging()
+
+    lines = path.read_text().splitlines()
+    print(f"📊 200 вызовов за {elapsed:.2f} мс, записано строк: {len(lines)}")
+    for line in lines[:4]:
+        print(f"   {line}")
+    print(f"📁 Файлы: {sorted(p.name for p in tmp.iterdir())}")
+    shutil.rmtree(tmp)
+
+
+if __name__ == "__main__":
+    test_logging()
@@ -0,0 +1,453 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+SENTINEL OS KVM - Log Index
+===========================
+Индекс журналов Sentinel для просмотрщика LuCI. Для каждого журнала
+ведется индекс смещений строк (время, уровень, компонент) фиксированного
+размера и списки строк по уровням. Индекс дописывается инкрементально,
+запросы "хвост после смещения", "диапазон по времени" и "фильтр по
+уровню/компоненту" читают через mmap только нужные записи индекса и
+строки журнала, поэтому не зависят от его размера.
+"""
+
+import os
+import re
+import json
+import mmap
+import fcntl
+import heapq
+import struct
+import logging
+import argparse
+import time
+from pathlib import Path
+from datetime import datetime
+from typing import Dict, Any, List, Optional, Iterator, Callable
+
+# Настройка логирования
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger("sentinel-logindex-kvm")
+
+INDEX_VERSION = 1
+INDEX_DIR = Path("/var/run/sentinel/logs/.index")
+DEFAULT_LOG = Path("/var/run/sentinel/logs/sentinel-core.log")
+
+# Запись индекса: смещение строки, время (unix), уровень, номер компонента
+RECORD = struct.Struct("<QdBH")
+# Элемент списка уровня: номер записи индекса
+POSTING = struct.Struct("<I")
+
+LEVELS = {"DEBUG": 10, "INFO": 20, "WARNING": 30, "ERROR": 40, "CRITICAL": 50}
+LEVEL_NAMES = {value: name for name, value in LEVELS.items()}
+
+# Начало строки JSONLineFormatter (sentinel-logging-kvm.py): разбор без json.loads
+JSON_PREFIX = re.compile(rb'^\{"ts": "([^"]+)", "level": "([A-Z]+)", "component": "([^"]*)"')
+# Текстовый формат logging.basicConfig: "2024-01-01 12:00:00,123 - имя - LEVEL - сообщение"
+TEXT_LINE = re.compile(r"^(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d)(?:,(\d{3}))? - (\S+) - ([A-Z]+) - ")
+MAX_LIMIT = 5000
+
+
+def parse_line(line: bytes) -> Optional[Dict[str, Any]]:
+    """Время, уровень и компонент строки журнала (JSON lines или текст)"""
+    match = JSON_PREFIX.match(line)
+    if match:
+        try:
+            return {"ts": datetime.fromisoformat(match.group(1).decode()).timestamp(),
+                    "level": match.group(2).decode(), "component": match.group(3).decode(), "msg": None}
+        except ValueError:
+            pass
+    if line.startswith(b"{"):
+        try:
+            entry = json.loads(line)
+            ts = datetime.fromisoformat(entry["ts"]).timestamp()
+            return {"ts": ts, "level": entry.get("level", ""),
+                    "component": entry.get("component", ""), "msg": entry.get("msg", "")}
+        except (ValueError, KeyError, TypeError):
+            return None
+
+    match = TEXT_LINE.match(line.decode("utf-8", "replace"))
+    if not match:
+        return None
+    ts = datetime.strptime(match.group(1), "%Y-%m-%d %H:%M:%S").timestamp()
+    ts += int(match.group(2) or 0) / 1000
+    return {"ts": ts, "level": match.group(4), "component": match.group(3), "msg": None}
+
+
+# ============================================================================
+# ИНДЕКС ЖУРНАЛА
+# ============================================================================
+
+class LogIndex:
+    """
+    Индекс одного журнала.
+
+    Файлы в INDEX_DIR: <имя>.idx - записи RECORD в порядке смещений,
+    <имя>.L<уровень> - номера записей каждого уровня, <имя>.meta -
+    inode журнала, время создания индекса, проиндексированная длина и
+    таблица компонентов. Пара inode и время создания - поколение индекса:
+    смещения since имеют смысл только внутри одного поколения.
+    """
+
+    def __init__(self, log_path: Path, index_dir: Path = INDEX_DIR):
+        self.log_path = Path(log_path)
+        self.index_dir = Path(index_dir)
+        base = str(self.log_path.resolve()).strip("/").replace("/", "_")
+        self.base = self.index_dir / base
+        self.meta: Dict[str, Any] = {}
+
+    def _path(self, suffix: str) -> Path:
+        return Path(f"{self.base}.{suffix}")
+
+    @property
+    def generation(self) -> str:
+        """Поколение индекса: меняется при ротации (inode) и усечении журнала"""
+        return f"{self.meta.get('inode', 0)}.{self.meta.get('created', 0)}"
+
+    def _empty_meta(self, inode: int) -> Dict[str, Any]:
+        return {"version": INDEX_VERSION, "inode": inode, "created": time.time_ns(), "indexed_to": 0,
+                "records": 0, "last_ts": 0.0, "components": [], "levels": {}}
+
+    def _reset(self, inode: int):
+        """Удаление индекса (ротация или усечение журнала)"""
+        for path in self.index_dir.glob(f"{self.base.name}.*"):
+            if path.suffix != ".lock":
+                path.unlink()
+        self.meta = self._empty_meta(inode)
+
+    def _load_meta(self, inode: int):
+        try:
+            self.meta = json.loads(self._path("meta").read_text())
+        except (OSError, ValueError):
+            self.meta = {}
+
+        records_size = self.meta.get("records", 0) * RECORD.size
+        if (self.meta.get("version") != INDEX_VERSION or self.meta.get("inode") != inode
+                or not self._path("idx").exists() or self._path("idx").stat().st_size < records_size):
+            self._reset(inode)
+            return
+
+        # Хвосты, дописанные прерванным обновлением, отбрасываются
+        os.truncate(self._path("idx"), records_size)
+        for level, count in self.meta["levels"].items():
+            os.truncate(self._path(f"L{level}"), count * POSTING.size)
+
+    def update(self) -> int:
+        """
+        Дописывание индекса по новым строкам журнала
+
+        Returns:
+            Количество добавленных записей
+        """
+        self.index_dir.mkdir(parents=True, exist_ok=True)
+        try:
+            stat = self.log_path.stat()
+        except OSError:
+            self.meta = self._empty_meta(0)
+            return 0
+
+        with open(self._path("lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self._load_meta(stat.st_ino)
+            if stat.st_size < self.meta["indexed_to"]:
+                self._reset(stat.st_ino)
+            if stat.st_size == self.meta["indexed_to"]:
+                return 0
+
+            added = self._index_tail(stat.st_size)
+            tmp = self._path("meta.tmp")
+            tmp.write_text(json.dumps(self.meta))
+            tmp.replace(self._path("meta"))
+        return added
+
+    def _index_tail(self, size: int) -> int:
+        """Разбор строк от indexed_to до последнего перевода строки"""
+        components = {name: i for i, name in enumerate(self.meta["components"])}
+        postings: Dict[int, bytearray] = {}
+        records = bytearray()
+        number = self.meta["records"]
+        last_ts = self.meta["last_ts"]
+        position = self.meta["indexed_to"]
+
+        with open(self.log_path, "rb") as f, mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) as log:
+            while position < size:
+                end = log.find(b"\n", position, size)
+                if end < 0:
+                    break
+                parsed = parse_line(log[position:end])
+                if parsed:
+                    last_ts = parsed["ts"]
+                    level = LEVELS.get(parsed["level"], 0)
+                    component = components.setdefault(parsed["component"], len(components))
+                else:
+                    # Продолжение многострочной записи (traceback) или чужой формат
+                    level, component = 0, components.setdefault("", len(components))
+                records += RECORD.pack(position, last_ts, level, component)
+                postings.setdefault(level, bytearray()).extend(POSTING.pack(number))
+                number += 1
+                position = end + 1
+
+        with open(self._path("idx"), "ab") as f:
+            f.write(records)
+        for level, data in postings.items():
+            with open(self._path(f"L{level}"), "ab") as f:
+                f.write(data)
+            key = str(level)
+            self.meta["levels"][key] = self.meta["levels"].get(key, 0) + len(data) // POSTING.size
+
+        added = number - self.meta["records"]
+        self.meta.update(records=number, last_ts=last_ts, indexed_to=position,
+                         components=sorted(components, key=components.get))
+        return added
+
+    # ------------------------------------------------------------------------
+    # Запросы
+    # ------------------------------------------------------------------------
+
+    @staticmethod
+    def _bisect(lo: int, hi: int, key: Callable[[int], float], value: float) -> int:
+        """Первый номер в [lo, hi), для которого key >= value"""
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if key(mid) < value:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def query(self, since: Optional[int] = None, start: Optional[float] = None,
+              end: Optional[float] = None, levels: Optional[List[str]] = None,
+              components: Optional[List[str]] = None, limit: int = 100,
+              generation: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Последние limit строк, удовлетворяющих условиям
+
+        Args:
+            since: Только строки, начинающиеся с этого смещения и дальше
+            generation: Поколение индекса, в котором получено since. После
+                        ротации или усечения (другое поколение или since за
+                        концом журнала) запрос выполняется как новый хвост,
+                        в ответе reset=true
+            start, end: Диапазон времени (unix)
+            levels: Уровни (DEBUG/INFO/WARNING/ERROR/CRITICAL)
+            components: Имена логгеров
+            limit: Максимум строк
+
+        Returns:
+            Строки в хронологическом порядке, смещение и поколение для следующего запроса
+        """
+        self.update()
+        limit = max(1, min(limit, MAX_LIMIT))
+        result = {"file": str(self.log_path), "entries": [], "truncated": False, "reset": False,
+                  "next_offset": self.meta["indexed_to"], "generation": self.generation,
+                  "records": self.meta["records"]}
+        if since is not None and (since > self.meta["indexed_to"]
+                                  or (generation is not None and generation != self.generation)):
+            since = None
+            result["reset"] = True
+        total = self.meta["records"]
+        if not total:
+            return result
+
+        wanted_components = None
+        if components:
+            wanted_components = {self.meta["components"].index(name)
+                                 for name in components if name in self.meta["components"]}
+            if not wanted_components:
+                return result
+
+        with open(self._path("idx"), "rb") as f, \
+                mmap.mmap(f.fileno(), total * RECORD.size, access=mmap.ACCESS_READ) as index:
+            record = lambda i: RECORD.unpack_from(index, i * RECORD.size)
+
+            lo, hi = 0, total
+            if since is not None:
+                lo = max(lo, self._bisect(0, total, lambda i: record(i)[0], since))
+            if start is not None:
+                lo = max(lo, self._bisect(0, total, lambda i: record(i)[1], start))
+            if end is not None:
+                hi = min(hi, self._bisect(0, total, lambda i: record(i)[1], end))
+
+            selected = []
+            for number in self._candidates(lo, hi, levels):
+                rec = record(number)
+                if wanted_components is not None and rec[3] not in wanted_components:
+                    continue
+                if len(selected) == limit:
+                    result["truncated"] = True
+                    break
+                line_end = record(number + 1)[0] if number + 1 < total else self.meta["indexed_to"]
+                selected.append((rec, line_end))
+
+        selected.reverse()
+        with open(self.log_path, "rb") as f, \
+                mmap.mmap(f.fileno(), self.meta["indexed_to"], access=mmap.ACCESS_READ) as log:
+            for (offset, ts, level, component), line_end in selected:
+                line = log[offset:line_end].rstrip(b"\n")
+                msg = None
+                if line.startswith(b"{"):
+                    try:
+                        msg = json.loads(line).get("msg")
+                    except ValueError:
+                        pass
+                result["entries"].append({
+                    "offset": offset,
+                    "ts": ts,
+                    "level": LEVEL_NAMES.get(level, ""),
+                    "component": self.meta["components"][component],
+                    "msg": msg if msg is not None else line.decode("utf-8", "replace")
+                })
+        return result
+
+    def _candidates(self, lo: int, hi: int, levels: Optional[List[str]]) -> Iterator[int]:
+        """Номера записей в [lo, hi) от новых к старым (по спискам уровней, если заданы)"""
+        if not levels:
+            yield from range(hi - 1, lo - 1, -1)
+            return
+
+        streams = []
+        maps = []
+        try:
+            for name in levels:
+                level = LEVELS.get(name.upper())
+                count = self.meta["levels"].get(str(level), 0)
+                if not count:
+                    continue
+                with open(self._path(f"L{level}"), "rb") as f:
+                    postings = mmap.mmap(f.fileno(), count * POSTING.size, access=mmap.ACCESS_READ)
+                maps.append(postings)
+                item = lambda j, p=postings: POSTING.unpack_from(p, j * POSTING.size)[0]
+                first = self._bisect(0, count, item, lo)
+                last = self._bisect(first, count, item, hi)
+                streams.append(map(lambda j, item=item: -item(j), range(last - 1, first - 1, -1)))
+            for negative in heapq.merge(*streams):
+                yield -negative
+        finally:
+            for postings in maps:
+                postings.close()
+
+    def tail(self, since: Optional[int] = None, limit: int = 100,
+             generation: Optional[str] = None) -> Dict[str, Any]:
+        """Хвост журнала (после смещения since поколения generation, если заданы)"""
+        return self.query(since=since, limit=limit, generation=generation)
+
+    def range(self, start: float, end: float, limit: int = 100) -> Dict[str, Any]:
+        """Строки за интервал времени"""
+        return self.query(start=start, end=end, limit=limit)
+
+    def filter(self, levels: List[str] = None, components: List[str] = None,
+               limit: int = 100) -> Dict[str, Any]:
+        """Строки заданных уровней и компонентов"""
+        return self.query(levels=levels, components=components, limit=limit)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Состояние индекса"""
+        self.update()
+        return {
+            "file": str(self.log_path),
+            "indexed_bytes": self.meta["indexed_to"],
+            "records": self.meta["records"],
+            "components": self.meta["components"],
+            "levels": {LEVEL_NAMES.get(int(level), "OTHER"): count
+                       for level, count in self.meta["levels"].items()}
+        }
+
+
+# ============================================================================
+# ТЕСТИРОВАНИЕ
+# ============================================================================
+
+def test_log_index():
+    """Тестирование индекса на синтетическом журнале"""
+    import shutil
+    import tempfile
+
+    print("=" * 60)
+    print("ТЕСТИРОВАНИЕ ИНДЕКСА ЖУРНАЛОВ")
+    print("=" * 60)
+
+    tmp = Path(tempfile.mkdtemp(prefix="sentinel-logindex-"))
+    log_path = tmp / "sentinel-core.log"
+    components = ["sentinel-core-kvm", "sentinel-netlink-kvm", "sentinel-cgroup-kvm"]
+    levels = ["INFO"] * 16 + ["WARNING"] * 3 + ["ERROR"]
+    base = time.time() - 200000
+    with open(log_path, "w") as f:
+        for i in range(200000):
+            ts = datetime.fromtimestamp(base + i).astimezone().isoformat(timespec="milliseconds")
+            f.write(json.dumps({"ts": ts, "level": levels[i % len(levels)],
+                                "component": components[i % 3], "msg": f"📊 Сообщение {i}"},
+                               ensure_ascii=False) + "\n")
+
+    index = LogIndex(log_path, tmp / ".index")
+    started = time.perf_counter()
+    index.update()
+    print(f"📊 Индексация {log_path.stat().st_size // 1024} КБ: "
+          f"{(time.perf_counter() - started) * 1000:.0f} мс")
+
+    checks = [
+        ("tail", lambda: index.tail(limit=50)),
+        ("since", lambda: index.tail(since=index.meta["indexed_to"] - 1000)),
+        ("range", lambda: index.range(base + 1000, base + 1100)),
+        ("errors", lambda: index.filter(levels=["ERROR"], limit=100)),
+        ("component", lambda: index.filter(levels=["WARNING"], components=["sentinel-cgroup-kvm"]))
+    ]
+    for name, check in checks:
+        started = time.perf_counter()
+        result = check()
+        elapsed = (time.perf_counter() - started) * 1000
+        print(f"   {name}: {len(result['entries'])} строк за {elapsed:.2f} мс, "
+              f"последняя: {result['entries'][-1]['msg'] if result['entries'] else '-'}")
+
+    # Ротация: смещение старого файла не должно терять строки нового
+    position, generation = index.meta["indexed_to"], index.generation
+    log_path.rename(tmp / "sentinel-core.log.1")
+    with open(log_path, "w") as f:
+        f.write(json.dumps({"ts": datetime.now().astimezone().isoformat(timespec="milliseconds"),
+                            "level": "INFO", "component": components[0], "msg": "🔄 После ротации"},
+                           ensure_ascii=False) + "\n")
+    rotated = index.tail(since=position, generation=generation)
+    assert rotated["reset"] and rotated["generation"] != generation, rotated
+    assert [e["msg"] for e in rotated["entries"]] == ["🔄 После ротации"], rotated["entries"]
+    print(f"   rotation: reset, {len(rotated['entries'])} строк нового файла")
+
+    print(json.dumps(index.get_stats(), indent=2, ensure_ascii=False))
+    shutil.rmtree(tmp)
+
+
+def main():
+    """CLI для ajax_logs"""
+    parser = argparse.ArgumentParser(description="Sentinel KVM Log Index")
+    parser.add_argument("command", choices=["query", "stats", "test"])
+    parser.add_argument("--file", default=str(DEFAULT_LOG), help="Файл журнала")
+    parser.add_argument("--since", type=int, help="Смещение, с которого читать")
+    parser.add_argument("--generation", help="Поколение индекса, в котором получено --since")
+    parser.add_argument("--from", dest="start", type=float, help="Начало интервала (unix)")
+    parser.add_argument("--to", dest="end", type=float, help="Конец интервала (unix)")
+    parser.add_argument("--level", help="Уровни через запятую")
+    parser.add_argument("--component", help="Компоненты через запятую")
+    parser.add_argument("--limit", type=int, default=100, help="Максимум строк")
+    args = parser.parse_args()
+
+    if args.command == "test":
+        test_log_index()
+        return
+
+    index = LogIndex(Path(args.file))
+    if args.command == "stats":
+        result = index.get_stats()
+    else:
+        result = index.query(
+            since=args.since, start=args.start, end=args.end,
+            levels=args.level.split(",") if args.level else None,
+            components=args.component.split(",") if args.component else None,
+            limit=args.limit, generation=args.generation
+        )
+    print(json.dumps(result, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
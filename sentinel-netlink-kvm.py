@@ -0,0 +1,894 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+SENTINEL OS KVM - Netlink Link Monitor
+======================================
+Живая инвентаризация сетевых интерфейсов через rtnetlink.
+Подписка на RTMGRP_LINK/RTMGRP_*_IFADDR вместо опроса и
+захардкоженных списков eth0..eth3: hotplug VirtIO NIC и
+VPN интерфейсы видны сразу после появления.
+"""
+
+import os
+import re
+import json
+import time
+import errno
+import fcntl
+import ctypes
+import socket
+import struct
+import logging
+import threading
+import ipaddress
+from pathlib import Path
+from dataclasses import dataclass, field, asdict
+from typing import Dict, Any, List, Optional, Callable, Iterator, Tuple
+
+# Настройка логирования
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger("sentinel-netlink-kvm")
+
+# ============================================================================
+# КОНСТАНТЫ RTNETLINK
+# ============================================================================
+
+NETLINK_ROUTE = 0
+RTMGRP_LINK = 0x1
+RTMGRP_IPV4_IFADDR = 0x10
+RTMGRP_IPV6_IFADDR = 0x100
+
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+RTM_NEWLINK = 16
+RTM_DELLINK = 17
+RTM_GETLINK = 18
+RTM_NEWADDR = 20
+RTM_DELADDR = 21
+RTM_GETADDR = 22
+
+NLM_F_REQUEST = 0x1
+NLM_F_ACK = 0x4
+NLM_F_DUMP = 0x300
+
+IFLA_IFNAME = 3
+IFLA_MTU = 4
+IFLA_OPERSTATE = 16
+IFLA_LINKINFO = 18
+IFLA_NUM_TX_QUEUES = 31
+IFLA_NUM_RX_QUEUES = 32
+IFLA_INFO_KIND = 1
+
+IFA_ADDRESS = 1
+IFA_LOCAL = 2
+
+IFF_UP = 0x1
+
+NLMSG_HDR = struct.Struct("=LHHLL")
+IFINFOMSG = struct.Struct("=BxHiII")
+IFADDRMSG = struct.Struct("=BBBBI")
+RTATTR = struct.Struct("=HH")
+
+OPERSTATES = {0: "unknown", 1: "notpresent", 2: "down", 3: "lowerlayerdown",
+              4: "testing", 5: "dormant", 6: "up"}
+
+# Интерфейсы VPN по типу link и по префиксу имени
+VPN_LINK_KINDS = {"wireguard", "amneziawg", "tun", "tap"}
+VPN_NAME_PREFIXES = ("wg", "awg", "tun", "tap")
+
+# SIOCETHTOOL и команды ethtool (linux/ethtool.h)
+SIOCETHTOOL = 0x8946
+ETHTOOL_GRINGPARAM = 0x10
+ETHTOOL_SRINGPARAM = 0x11
+ETHTOOL_GCHANNELS = 0x3c
+ETHTOOL_SCHANNELS = 0x3d
+# Офлоады: (get, set)
+ETHTOOL_OFFLOADS = {
+    "rx": (0x14, 0x15),
+    "tx": (0x16, 0x17),
+    "sg": (0x18, 0x19),
+    "tso": (0x1e, 0x1f),
+    "gso": (0x23, 0x24),
+    "gro": (0x2b, 0x2c)
+}
+ETHTOOL_RING_FIELDS = ["rx_max", "rx_mini_max", "rx_jumbo_max", "tx_max",
+                       "rx", "rx_mini", "rx_jumbo", "tx"]
+ETHTOOL_CHANNEL_FIELDS = ["max_rx", "max_tx", "max_other", "max_combined",
+                          "rx", "tx", "other", "combined"]
+IFNAMSIZ = 16
+IFREQ_SIZE = 40
+
+SYSFS_NET = Path("/sys/class/net")
+RECV_BUFFER = 65536
+
+# Тюнинг VirtIO multiqueue
+PROC_INTERRUPTS = Path("/proc/interrupts")
+PROC_IRQ = Path("/proc/irq")
+NIC_TUNING_STATE = Path("/var/run/sentinel/kvm/nic-tuning.json")
+VIRTIO_MAX_QUEUES = 8
+PROBE_TIMEOUT = 60
+
+
+def _align(length: int) -> int:
+    """Выравнивание netlink атрибута по 4 байтам"""
+    return (length + 3) & ~3
+
+
+def _parse_attrs(data: bytes, offset: int) -> Dict[int, bytes]:
+    """Разбор rtattr TLV начиная со смещения"""
+    attrs = {}
+    while offset + RTATTR.size <= len(data):
+        length, attr_type = RTATTR.unpack_from(data, offset)
+        if length < RTATTR.size:
+            break
+        attrs[attr_type & 0x7fff] = data[offset + RTATTR.size:offset + length]
+        offset += _align(length)
+    return attrs
+
+
+def _attr_str(value: Optional[bytes]) -> Optional[str]:
+    """Строковый атрибут (с нулевым терминатором)"""
+    return value.split(b"\x00", 1)[0].decode(errors="replace") if value is not None else None
+
+
+def _attr_u32(value: Optional[bytes], default: int = 0) -> int:
+    """Атрибут u32"""
+    return struct.unpack("=I", value[:4])[0] if value and len(value) >= 4 else default
+
+
+def _attr_u8(value: Optional[bytes], default: int = 0) -> int:
+    """Атрибут u8"""
+    return value[0] if value else default
+
+
+def iter_messages(data: bytes) -> Iterator[Tuple[int, int, bytes]]:
+    """Разбор буфера на netlink сообщения (тип, флаги, payload)"""
+    offset = 0
+    while offset + NLMSG_HDR.size <= len(data):
+        length, msg_type, flags, _seq, _pid = NLMSG_HDR.unpack_from(data, offset)
+        if length < NLMSG_HDR.size:
+            break
+        yield msg_type, flags, data[offset + NLMSG_HDR.size:offset + length]
+        offset += _align(length)
+
+
+def open_rtnetlink(groups: int = 0, rcvbuf: int = 1024 * 1024) -> socket.socket:
+    """Открытие rtnetlink сокета с подпиской на группы"""
+    sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+    sock.bind((0, groups))
+    return sock
+
+
+# ============================================================================
+# ИНВЕНТАРИЗАЦИЯ ИНТЕРФЕЙСОВ
+# ============================================================================
+
+@dataclass
+class InterfaceInfo:
+    """Состояние сетевого интерфейса"""
+    index: int
+    name: str
+    mtu: int = 0
+    operstate: str = "unknown"
+    flags: int = 0
+    rx_queues: int = 1
+    tx_queues: int = 1
+    kind: Optional[str] = None
+    driver: str = "unknown"
+    addresses: List[str] = field(default_factory=list)
+
+    @property
+    def is_up(self) -> bool:
+        return bool(self.flags & IFF_UP)
+
+    @property
+    def is_virtio(self) -> bool:
+        return "virtio" in self.driver
+
+    @property
+    def is_vpn(self) -> bool:
+        return self.kind in VPN_LINK_KINDS or self.name.startswith(VPN_NAME_PREFIXES)
+
+    def to_dict(self) -> Dict[str, Any]:
+        data = asdict(self)
+        data.update({"up": self.is_up, "virtio": self.is_virtio, "vpn": self.is_vpn})
+        return data
+
+
+def _read_driver(name: str) -> str:
+    """Драйвер устройства из sysfs"""
+    try:
+        driver_path = SYSFS_NET / name / "device" / "driver"
+        if driver_path.exists():
+            return driver_path.resolve().name
+    except OSError:
+        pass
+    return "unknown"
+
+
+def parse_link(payload: bytes) -> Optional[InterfaceInfo]:
+    """Разбор RTM_NEWLINK/RTM_DELLINK"""
+    if len(payload) < IFINFOMSG.size:
+        return None
+    _family, _type, index, flags, _change = IFINFOMSG.unpack_from(payload)
+    attrs = _parse_attrs(payload, IFINFOMSG.size)
+
+    name = _attr_str(attrs.get(IFLA_IFNAME))
+    if not name:
+        return None
+
+    kind = None
+    if IFLA_LINKINFO in attrs:
+        kind = _attr_str(_parse_attrs(attrs[IFLA_LINKINFO], 0).get(IFLA_INFO_KIND))
+
+    return InterfaceInfo(
+        index=index,
+        name=name,
+        mtu=_attr_u32(attrs.get(IFLA_MTU)),
+        operstate=OPERSTATES.get(_attr_u8(attrs.get(IFLA_OPERSTATE)), "unknown"),
+        flags=flags,
+        rx_queues=_attr_u32(attrs.get(IFLA_NUM_RX_QUEUES), 1),
+        tx_queues=_attr_u32(attrs.get(IFLA_NUM_TX_QUEUES), 1),
+        kind=kind,
+        driver=_read_driver(name)
+    )
+
+
+def parse_addr(payload: bytes) -> Optional[Tuple[int, str]]:
+    """Разбор RTM_NEWADDR/RTM_DELADDR: (индекс, адрес/префикс)"""
+    if len(payload) < IFADDRMSG.size:
+        return None
+    _family, prefixlen, _flags, _scope, index = IFADDRMSG.unpack_from(payload)
+    attrs = _parse_attrs(payload, IFADDRMSG.size)
+    raw = attrs.get(IFA_LOCAL) or attrs.get(IFA_ADDRESS)
+    if not raw:
+        return None
+    try:
+        return index, f"{ipaddress.ip_address(raw)}/{prefixlen}"
+    except ValueError:
+        return None
+
+
+class LinkMonitor:
+    """
+    Живая инвентаризация интерфейсов по событиям rtnetlink.
+
+    Подписчики получают (событие, InterfaceInfo), где событие одно из
+    "added", "changed", "removed", "address". Обработка идет в потоке,
+    блокирующемся на recv() - без опроса.
+    """
+
+    GROUPS = RTMGRP_LINK | RTMGRP_IPV4_IFADDR | RTMGRP_IPV6_IFADDR
+
+    def __init__(self):
+        self.interfaces: Dict[int, InterfaceInfo] = {}
+        self.subscribers: List[Callable[[str, InterfaceInfo], None]] = []
+        self.lock = threading.Lock()
+        self.running = False
+        self.events_total = 0
+        self.last_dispatch_ms = 0.0
+        self._sock: Optional[socket.socket] = None
+        self._seq = int(time.time())
+
+    def subscribe(self, callback: Callable[[str, InterfaceInfo], None]):
+        """Регистрация обработчика изменений"""
+        self.subscribers.append(callback)
+
+    # ------------------------------------------------------------------------
+    # Запросы
+    # ------------------------------------------------------------------------
+
+    def _dump(self, msg_type: int, payload: bytes) -> Iterator[Tuple[int, bytes]]:
+        """Дамп объектов через RTM_GET* с NLM_F_DUMP"""
+        self._seq += 1
+        header = NLMSG_HDR.pack(NLMSG_HDR.size + len(payload), msg_type,
+                                NLM_F_REQUEST | NLM_F_DUMP, self._seq, 0)
+        with open_rtnetlink() as sock:
+            sock.send(header + payload)
+            while True:
+                data = sock.recv(RECV_BUFFER)
+                for reply_type, _flags, body in iter_messages(data):
+                    if reply_type == NLMSG_DONE:
+                        return
+                    if reply_type == NLMSG_ERROR:
+                        code = struct.unpack_from("=i", body)[0]
+                        if code:
+                            raise OSError(-code, os.strerror(-code))
+                        return
+                    yield reply_type, body
+
+    def refresh(self) -> Dict[int, InterfaceInfo]:
+        """Полная инвентаризация (ссылки + адреса)"""
+        interfaces = {}
+        for _type, body in self._dump(RTM_GETLINK, IFINFOMSG.pack(0, 0, 0, 0, 0)):
+            info = parse_link(body)
+            if info:
+                interfaces[info.index] = info
+
+        for _type, body in self._dump(RTM_GETADDR, IFADDRMSG.pack(0, 0, 0, 0, 0)):
+            parsed = parse_addr(body)
+            if parsed and parsed[0] in interfaces:
+                interfaces[parsed[0]].addresses.append(parsed[1])
+
+        with self.lock:
+            self.interfaces = interfaces
+        return interfaces
+
+    def snapshot(self) -> List[InterfaceInfo]:
+        """Текущее состояние интерфейсов"""
+        with self.lock:
+            return sorted(self.interfaces.values(), key=lambda i: i.index)
+
+    def virtio_devices(self) -> List[InterfaceInfo]:
+        """VirtIO NIC"""
+        return [i for i in self.snapshot() if i.is_virtio]
+
+    def vpn_interfaces(self) -> List[InterfaceInfo]:
+        """VPN интерфейсы (WireGuard, AmneziaWG, tun/tap)"""
+        return [i for i in self.snapshot() if i.is_vpn]
+
+    # ------------------------------------------------------------------------
+    # События
+    # ------------------------------------------------------------------------
+
+    def handle(self, data: bytes):
+        """Применение пакета событий к инвентарю и уведомление подписчиков"""
+        events = []
+        with self.lock:
+            for msg_type, _flags, body in iter_messages(data):
+                if msg_type == RTM_NEWLINK:
+                    info = parse_link(body)
+                    if not info:
+                        continue
+                    previous = self.interfaces.get(info.index)
+                    if previous:
+                        info.addresses = previous.addresses
+                        if asdict(previous) == asdict(info):
+                            continue
+                    self.interfaces[info.index] = info
+                    events.append(("changed" if previous else "added", info))
+
+                elif msg_type == RTM_DELLINK:
+                    # После удаления sysfs пуст (driver, очереди): подписчикам отдается
+                    # последнее известное состояние устройства
+                    info = parse_link(body)
+                    removed = self.interfaces.pop(info.index, None) if info else None
+                    if removed:
+                        events.append(("removed", removed))
+
+                elif msg_type in (RTM_NEWADDR, RTM_DELADDR):
+                    parsed = parse_addr(body)
+                    if not parsed or parsed[0] not in self.interfaces:
+                        continue
+                    info = self.interfaces[parsed[0]]
+                    if msg_type == RTM_NEWADDR and parsed[1] not in info.addresses:
+                        info.addresses.append(parsed[1])
+                    elif msg_type == RTM_DELADDR and parsed[1] in info.addresses:
+                        info.addresses.remove(parsed[1])
+                    else:
+                        continue
+                    events.append(("address", info))
+
+        self._dispatch(events)
+
+    def resync(self) -> List[Tuple[str, InterfaceInfo]]:
+        """
+        Полная переинвентаризация с рассылкой событий по разнице состояний.
+
+        Используется после ENOBUFS: события потеряны, подписчики получают
+        синтезированные added/changed/removed для сверки своего состояния.
+        """
+        with self.lock:
+            before = dict(self.interfaces)
+        after = self.refresh()
+
+        events = []
+        for index, info in after.items():
+            previous = before.get(index)
+            if previous is None:
+                events.append(("added", info))
+            elif asdict(previous) != asdict(info):
+                events.append(("changed", info))
+        for index, previous in before.items():
+            if index not in after:
+                events.append(("removed", previous))
+
+        self._dispatch(events)
+        return events
+
+    def _dispatch(self, events: List[Tuple[str, InterfaceInfo]]):
+        """Уведомление подписчиков"""
+        start = time.perf_counter()
+        for event, info in events:
+            self.events_total += 1
+            # Флапающий линк шлет события пачками: выборка sentinel-logging-kvm
+            logger.info(f"🔌 {info.name}: {event} ({info.operstate}, mtu {info.mtu})",
+                        extra={"rate_limit": True})
+            for callback in self.subscribers:
+                try:
+                    callback(event, info)
+                except Exception as e:
+                    logger.error(f"❌ Ошибка обработчика события {event} {info.name}: {e}")
+        if events:
+            self.last_dispatch_ms = round((time.perf_counter() - start) * 1000, 3)
+
+    def start_monitoring(self):
+        """Подписка на события и запуск потока"""
+        if self.running:
+            return
+        # Подписываемся до дампа, чтобы не потерять события между ними
+        self._sock = open_rtnetlink(self.GROUPS)
+        self.refresh()
+        self.running = True
+        thread = threading.Thread(target=self._monitor_loop, daemon=True)
+        thread.start()
+        logger.info(f"✅ Мониторинг интерфейсов запущен ({len(self.interfaces)} интерфейсов)")
+
+    def stop(self):
+        """Остановка мониторинга"""
+        self.running = False
+        if self._sock:
+            self._sock.close()
+            self._sock = None
+
+    def _monitor_loop(self):
+        """Цикл получения событий"""
+        while self.running:
+            try:
+                data = self._sock.recv(RECV_BUFFER)
+            except OSError as e:
+                if not self.running:
+                    break
+                if e.errno == errno.ENOBUFS:
+                    # Переполнение буфера сокета: события потеряны, пересобираем инвентарь
+                    logger.warning("⚠️ Netlink ENOBUFS, полная переинвентаризация")
+                    self.resync()
+                    continue
+                logger.error(f"❌ Ошибка netlink: {e}")
+                break
+            if not self.running:
+                break
+            self.handle(data)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Статистика монитора"""
+        return {
+            "interfaces": [i.to_dict() for i in self.snapshot()],
+            "events_total": self.events_total,
+            "last_dispatch_ms": self.last_dispatch_ms
+        }
+
+
+# ============================================================================
+# УПРАВЛЕНИЕ ИНТЕРФЕЙСАМИ (RTNETLINK + SIOCETHTOOL)
+# ============================================================================
+
+class InterfaceManager:
+    """
+    Настройка интерфейсов без запуска ip/ethtool.
+
+    MTU и состояние линка - через RTM_NEWLINK, очереди, кольцевые буферы
+    и офлоады - через ioctl SIOCETHTOOL. Каждая операция замеряется.
+    """
+
+    def __init__(self):
+        self.operations: List[Dict[str, Any]] = []
+        self._ioctl_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._seq = int(time.time())
+
+    def close(self):
+        """Закрытие сокетов"""
+        self._ioctl_sock.close()
+
+    def _record(self, op: str, dev: str, start: float, ok: bool, error: str = None):
+        """Запись латентности операции"""
+        entry = {"op": op, "dev": dev, "ms": round((time.perf_counter() - start) * 1000, 3), "ok": ok}
+        if error:
+            entry["error"] = error
+        self.operations.append(entry)
+        return ok
+
+    # ------------------------------------------------------------------------
+    # rtnetlink
+    # ------------------------------------------------------------------------
+
+    def _setlink(self, name: str, flags: int = 0, change: int = 0, attrs: bytes = b""):
+        """RTM_NEWLINK с ожиданием подтверждения"""
+        index = socket.if_nametoindex(name)
+        payload = IFINFOMSG.pack(socket.AF_UNSPEC, 0, index, flags, change) + attrs
+        self._seq += 1
+        header = NLMSG_HDR.pack(NLMSG_HDR.size + len(payload), RTM_NEWLINK,
+                                NLM_F_REQUEST | NLM_F_ACK, self._seq, 0)
+        with open_rtnetlink() as sock:
+            sock.send(header + payload)
+            for msg_type, _flags, body in iter_messages(sock.recv(RECV_BUFFER)):
+                if msg_type == NLMSG_ERROR:
+                    code = struct.unpack_from("=i", body)[0]
+                    if code:
+                        raise OSError(-code, os.strerror(-code))
+                    return
+
+    def set_mtu(self, name: str, mtu: int) -> bool:
+        """Установка MTU"""
+        start = time.perf_counter()
+        try:
+            attr = RTATTR.pack(RTATTR.size + 4, IFLA_MTU) + struct.pack("=I", mtu)
+            self._setlink(name, attrs=attr)
+            return self._record("set_mtu", name, start, True)
+        except OSError as e:
+            logger.error(f"❌ MTU {name}: {e}")
+            return self._record("set_mtu", name, start, False, str(e))
+
+    def set_link_state(self, name: str, up: bool) -> bool:
+        """Поднятие/опускание линка"""
+        start = time.perf_counter()
+        try:
+            self._setlink(name, flags=IFF_UP if up else 0, change=IFF_UP)
+            return self._record("set_link_state", name, start, True)
+        except OSError as e:
+            logger.error(f"❌ Состояние линка {name}: {e}")
+            return self._record("set_link_state", name, start, False, str(e))
+
+    # ------------------------------------------------------------------------
+    # SIOCETHTOOL
+    # ------------------------------------------------------------------------
+
+    def _ethtool(self, name: str, data: bytes) -> bytes:
+        """Вызов SIOCETHTOOL с буфером команды"""
+        buf = ctypes.create_string_buffer(data, len(data))
+        ifreq = struct.pack(f"{IFNAMSIZ}sP", name.encode()[:IFNAMSIZ - 1], ctypes.addressof(buf))
+        fcntl.ioctl(self._ioctl_sock.fileno(), SIOCETHTOOL, ifreq.ljust(IFREQ_SIZE, b"\x00"))
+        return buf.raw
+
+    def get_ring(self, name: str) -> Dict[str, int]:
+        """Размеры кольцевых буферов"""
+        raw = self._ethtool(name, struct.pack("=9I", ETHTOOL_GRINGPARAM, *([0] * 8)))
+        return dict(zip(ETHTOOL_RING_FIELDS, struct.unpack("=9I", raw)[1:]))
+
+    def set_ring(self, name: str, rx: int = None, tx: int = None) -> bool:
+        """Установка кольцевых буферов (с ограничением по максимуму драйвера)"""
+        start = time.perf_counter()
+        try:
+            ring = self.get_ring(name)
+            if rx is not None:
+                ring["rx"] = min(rx, ring["rx_max"]) if ring["rx_max"] else rx
+            if tx is not None:
+                ring["tx"] = min(tx, ring["tx_max"]) if ring["tx_max"] else tx
+            self._ethtool(name, struct.pack("=9I", ETHTOOL_SRINGPARAM,
+                                            *[ring[f] for f in ETHTOOL_RING_FIELDS]))
+            return self._record("set_ring", name, start, True)
+        except OSError as e:
+            return self._record("set_ring", name, start, False, str(e))
+
+    def get_channels(self, name: str) -> Dict[str, int]:
+        """Количество каналов (очередей)"""
+        raw = self._ethtool(name, struct.pack("=9I", ETHTOOL_GCHANNELS, *([0] * 8)))
+        return dict(zip(ETHTOOL_CHANNEL_FIELDS, struct.unpack("=9I", raw)[1:]))
+
+    def set_channels(self, name: str, combined: int = None, rx: int = None, tx: int = None) -> bool:
+        """Установка количества каналов (с ограничением по максимуму драйвера)"""
+        start = time.perf_counter()
+        try:
+            channels = self.get_channels(name)
+            if combined is not None and not channels["max_combined"]:
+                # Драйвер без combined каналов (раздельные rx/tx очереди)
+                rx, tx, combined = combined if rx is None else rx, combined if tx is None else tx, None
+            for key, value in (("combined", combined), ("rx", rx), ("tx", tx)):
+                if value is not None and channels[f"max_{key}"]:
+                    channels[key] = min(value, channels[f"max_{key}"])
+            self._ethtool(name, struct.pack("=9I", ETHTOOL_SCHANNELS,
+                                            *[channels[f] for f in ETHTOOL_CHANNEL_FIELDS]))
+            return self._record("set_channels", name, start, True)
+        except OSError as e:
+            return self._record("set_channels", name, start, False, str(e))
+
+    def get_offloads(self, name: str) -> Dict[str, bool]:
+        """Состояние офлоадов"""
+        offloads = {}
+        for feature, (get_cmd, _set_cmd) in ETHTOOL_OFFLOADS.items():
+            try:
+                raw = self._ethtool(name, struct.pack("=II", get_cmd, 0))
+                offloads[feature] = bool(struct.unpack("=II", raw)[1])
+            except OSError:
+                continue
+        return offloads
+
+    def set_offloads(self, name: str, **features: bool) -> bool:
+        """Включение/выключение офлоадов (rx, tx, sg, tso, gso, gro)"""
+        start = time.perf_counter()
+        failed = []
+        for feature, enabled in features.items():
+            try:
+                self._ethtool(name, struct.pack("=II", ETHTOOL_OFFLOADS[feature][1], int(enabled)))
+            except (OSError, KeyError) as e:
+                failed.append(f"{feature}: {e}")
+        return self._record("set_offloads", name, start, not failed, "; ".join(failed) or None)
+
+    def get_report(self) -> Dict[str, Any]:
+        """Сводка по операциям: количество, ошибки и латентность"""
+        report = {}
+        for entry in self.operations:
+            stats = report.setdefault(entry["op"], {"count": 0, "failed": 0, "total_ms": 0.0, "max_ms": 0.0})
+            stats["count"] += 1
+            stats["failed"] += 0 if entry["ok"] else 1
+            stats["total_ms"] = round(stats["total_ms"] + entry["ms"], 3)
+            stats["max_ms"] = max(stats["max_ms"], entry["ms"])
+        for stats in report.values():
+            stats["avg_ms"] = round(stats["total_ms"] / stats["count"], 3)
+        return report
+
+
+# ============================================================================
+# ТЮНИНГ MULTIQUEUE / RPS / XPS / IRQ
+# ============================================================================
+
+def cpu_mask(cpus: List[int]) -> str:
+    """Маска CPU в формате sysfs (группы по 32 бита через запятую)"""
+    value = 0
+    for cpu in cpus:
+        value |= 1 << cpu
+    groups = []
+    while True:
+        groups.append(f"{value & 0xffffffff:08x}")
+        value >>= 32
+        if not value:
+            break
+    return ",".join(reversed(groups))
+
+
+def _read_text(path: Path) -> Optional[str]:
+    """Чтение sysfs/procfs файла"""
+    try:
+        return path.read_text().strip()
+    except OSError:
+        return None
+
+
+def _write_text(path: Path, value: str) -> bool:
+    """Запись в sysfs/procfs файл"""
+    try:
+        path.write_text(value)
+        return True
+    except OSError as e:
+        logger.debug(f"Запись {path}: {e}")
+        return False
+
+
+class NICTuner:
+    """
+    Подбор очередей, RPS/XPS и привязки IRQ для VirtIO NIC.
+
+    План: combined каналы по числу vCPU (не более VIRTIO_MAX_QUEUES),
+    XPS очереди q на CPU q, q+N, ...; RPS только когда очередей меньше
+    vCPU; IRQ virtioX-input.q на отдельные CPU. План применяется, если
+    проба пропускной способности не хуже исходной; лучшие настройки
+    сохраняются по NIC и применяются сразу при следующем запуске.
+
+    Проба должна быть активной: генератор фиксированной нагрузки (пир,
+    loopback), возвращающий достигнутые пакеты/с. Пассивный счетчик
+    трафика измеряет предложенную нагрузку, а не пропускную способность,
+    поэтому без пробы план применяется без проверки (verified: false).
+    """
+
+    def __init__(self, manager: InterfaceManager = None, cpu_count: int = None,
+                 probe: Optional[Callable[[str], float]] = None, state_file: Path = NIC_TUNING_STATE):
+        self.manager = manager or InterfaceManager()
+        self.cpu_count = cpu_count or os.cpu_count() or 1
+        self.probe = probe
+        self.state_file = state_file
+        self.best: Dict[str, Dict[str, Any]] = self._load_state()
+
+    def _load_state(self) -> Dict[str, Dict[str, Any]]:
+        """Загрузка сохраненных настроек"""
+        try:
+            with open(self.state_file) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_state(self):
+        """Сохранение лучших настроек"""
+        try:
+            self.state_file.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.state_file, "w") as f:
+                json.dump(self.best, f, indent=2)
+        except OSError as e:
+            logger.warning(f"⚠️ Не удалось сохранить настройки NIC: {e}")
+
+    def find_input_irqs(self, dev: str) -> Dict[int, int]:
+        """IRQ входных очередей VirtIO: {очередь: irq}"""
+        virtio_name = (SYSFS_NET / dev / "device").resolve().name
+        pattern = re.compile(rf"^\s*(\d+):.*\b{re.escape(virtio_name)}-input\.(\d+)\s*$")
+        irqs = {}
+        for line in (_read_text(PROC_INTERRUPTS) or "").splitlines():
+            match = pattern.match(line)
+            if match:
+                irqs[int(match.group(2))] = int(match.group(1))
+        return irqs
+
+    def _max_queues(self, dev: str) -> int:
+        """Максимум очередей, поддерживаемый драйвером"""
+        try:
+            channels = self.manager.get_channels(dev)
+            return channels["max_combined"] or channels["max_rx"] or 1
+        except OSError:
+            return len(list((SYSFS_NET / dev / "queues").glob("rx-*"))) or 1
+
+    def plan(self, dev: str) -> Dict[str, Any]:
+        """Расчет целевых настроек для NIC"""
+        queues = max(1, min(self.cpu_count, self._max_queues(dev), VIRTIO_MAX_QUEUES))
+        spread = {q: [c for c in range(self.cpu_count) if c % queues == q] for q in range(queues)}
+
+        return {
+            "queues": queues,
+            # Аппаратных очередей хватает на все vCPU - программный RPS только добавит IPI
+            "rps": {f"rx-{q}": cpu_mask(cpus) if queues < self.cpu_count else "0"
+                    for q, cpus in spread.items()},
+            "xps": {f"tx-{q}": cpu_mask(cpus) for q, cpus in spread.items()},
+            "irq": {str(irq): str(q % self.cpu_count)
+                    for q, irq in self.find_input_irqs(dev).items() if q < queues}
+        }
+
+    def current(self, dev: str) -> Dict[str, Any]:
+        """Текущие настройки NIC"""
+        queues_dir = SYSFS_NET / dev / "queues"
+        rx = sorted(queues_dir.glob("rx-*"))
+        tx = sorted(queues_dir.glob("tx-*"))
+        return {
+            "queues": len(rx) or 1,
+            "rps": {q.name: _read_text(q / "rps_cpus") or "0" for q in rx},
+            "xps": {q.name: _read_text(q / "xps_cpus") or "0" for q in tx},
+            "irq": {str(irq): _read_text(PROC_IRQ / str(irq) / "smp_affinity_list") or ""
+                    for irq in self.find_input_irqs(dev).values()}
+        }
+
+    def apply(self, dev: str, settings: Dict[str, Any]) -> Dict[str, int]:
+        """
+        Применение настроек
+
+        Returns:
+            Количество успешных записей по типам
+        """
+        applied = {"channels": 0, "rps": 0, "xps": 0, "irq": 0}
+        if self.manager.set_channels(dev, combined=settings["queues"]):
+            applied["channels"] = settings["queues"]
+
+        queues_dir = SYSFS_NET / dev / "queues"
+        for kind, filename in (("rps", "rps_cpus"), ("xps", "xps_cpus")):
+            for queue, mask in settings.get(kind, {}).items():
+                if (queues_dir / queue).exists() and _write_text(queues_dir / queue / filename, mask):
+                    applied[kind] += 1
+
+        for irq, cpus in settings.get("irq", {}).items():
+            if cpus and _write_text(PROC_IRQ / irq / "smp_affinity_list", cpus):
+                applied["irq"] += 1
+        return applied
+
+    @staticmethod
+    def command_probe(command: str, timeout: float = PROBE_TIMEOUT) -> Callable[[str], float]:
+        """
+        Активная проба из внешней команды (kvm.nic_probe в sentinel.yaml)
+
+        Команда запускает генератор фиксированной нагрузки через {dev}
+        и печатает достигнутые пакеты/с последней строкой stdout.
+        """
+        import shlex
+        import subprocess
+
+        def probe(dev: str) -> float:
+            result = subprocess.run(shlex.split(command.format(dev=dev)),
+                                    capture_output=True, text=True, timeout=timeout, check=True)
+            lines = result.stdout.strip().splitlines()
+            try:
+                return float(lines[-1])
+            except (IndexError, ValueError):
+                raise ValueError(f"проба не вернула пакеты/с: {result.stdout.strip()[-80:]}")
+
+        return probe
+
+    def _fingerprint(self, dev: str) -> Dict[str, int]:
+        """Условия, при которых сохраненные настройки остаются валидными"""
+        return {"cpu_count": self.cpu_count, "max_queues": self._max_queues(dev)}
+
+    def tune(self, dev: str, force: bool = False) -> Dict[str, Any]:
+        """
+        Тюнинг NIC: план, с активной пробой - с проверкой эффекта
+
+        Args:
+            dev: Имя интерфейса
+            force: Игнорировать сохраненные настройки и пересчитать
+
+        Returns:
+            Итог: выбранные настройки, пробы до/после, примененные записи
+        """
+        saved = self.best.get(dev)
+        # Непроверенный план пересчитывается, как только появляется проба
+        reusable = saved and (saved.get("verified") or self.probe is None)
+        if reusable and not force and saved.get("fingerprint") == self._fingerprint(dev):
+            applied = self.apply(dev, saved["settings"])
+            logger.info(f"✅ {dev}: применены сохраненные настройки ({saved['settings']['queues']} очередей)")
+            return {"dev": dev, "source": "saved", "settings": saved["settings"], "applied": applied,
+                    "verified": bool(saved.get("verified"))}
+
+        candidate = self.plan(dev)
+        if self.probe is None:
+            applied = self.apply(dev, candidate)
+            logger.info(f"✅ {dev}: {candidate['queues']} очередей, RPS/XPS/IRQ применены (без пробы)")
+            self.best[dev] = {"settings": candidate, "fingerprint": self._fingerprint(dev),
+                              "verified": False, "tuned_at": time.strftime("%Y-%m-%dT%H:%M:%S")}
+            self._save_state()
+            return {"dev": dev, "source": "plan", "settings": candidate, "applied": applied,
+                    "verified": False}
+
+        baseline = self.current(dev)
+        before = self.probe(dev)
+        applied = self.apply(dev, candidate)
+        after = self.probe(dev)
+
+        if after < before:
+            # План хуже исходного состояния - откатываемся
+            self.apply(dev, baseline)
+            chosen, source = baseline, "baseline"
+            logger.warning(f"⚠️ {dev}: план хуже исходного ({after:.0f} < {before:.0f}), откат")
+        else:
+            chosen, source = candidate, "plan"
+            logger.info(f"✅ {dev}: {candidate['queues']} очередей, RPS/XPS/IRQ применены "
+                        f"({before:.0f} -> {after:.0f})")
+
+        # Нулевые пробы - генератор не дал нагрузки, сравнение ничего не доказывает
+        verified = before > 0 and after > 0
+        self.best[dev] = {"settings": chosen, "fingerprint": self._fingerprint(dev),
+                          "verified": verified, "probe_before": before, "probe_after": after,
+                          "tuned_at": time.strftime("%Y-%m-%dT%H:%M:%S")}
+        self._save_state()
+        return {"dev": dev, "source": source, "settings": chosen, "applied": applied,
+                "verified": verified, "probe_before": before, "probe_after": after}
+
+
+# ============================================================================
+# ТЕСТИРОВАНИЕ
+# ============================================================================
+
+def test_link_monitor():
+    """Тестирование монитора интерфейсов"""
+    import json
+
+    monitor = LinkMonitor()
+    monitor.subscribe(lambda event, info: print(f"  {event}: {info.name}"))
+    monitor.start_monitoring()
+    print(json.dumps(monitor.get_stats(), indent=2))
+
+    # Создаем и удаляем veth пару (нужен CAP_NET_ADMIN)
+    os.system("ip link add sentinel-t0 type veth peer name sentinel-t1 2>/dev/null "
+              "&& ip link set sentinel-t0 up && ip addr add 10.254.0.1/32 dev sentinel-t0 "
+              "&& ip link del sentinel-t0")
+    time.sleep(0.2)
+    print(f"Событий: {monitor.events_total}, диспетчеризация: {monitor.last_dispatch_ms} мс")
+    monitor.stop()
+
+
+def test_interface_manager():
+    """Тестирование управления интерфейсами без ip/ethtool"""
+    import json
+
+    os.system("ip link add sentinel-t0 type veth peer name sentinel-t1 2>/dev/null")
+    manager = InterfaceManager()
+    manager.set_link_state("sentinel-t0", True)
+    manager.set_mtu("sentinel-t0", 1400)
+    manager.set_channels("sentinel-t0", combined=1)
+    manager.set_ring("sentinel-t0", rx=4096, tx=4096)
+    manager.set_offloads("sentinel-t0", gro=True, tso=True)
+    print(json.dumps({"offloads": manager.get_offloads("sentinel-t0"),
+                      "report": manager.get_report()}, indent=2))
+    manager.close()
+    os.system("ip link del sentinel-t0 2>/dev/null")
+
+
+if __name__ == "__main__":
+    test_link_monitor()
+    test_interface_manager()
@@ -9,15 +9,20 @@ SENTINEL OS KVM - nftables Router
 """
 
 import os
+import re
 import sys
 import json
 import time
+import fcntl
+import bisect
 import logging
 import subprocess
 import ipaddress
 import urllib.request
+import socket
 from pathlib import Path
-from typing import Dict, Any, List, Optional, Tuple, Set
+from typing import Dict, Any, List, Optional, Tuple, Set, Union, Iterable, Iterator, Callable
+from dataclasses import dataclass
 from datetime import datetime
 import threading
 import hashlib
@@ -29,6 +34,37 @@ logging.basicConfig(
 )
 logger = logging.getLogger("sentinel-nftables-kvm")
 
+
+# Соседние модули sentinel-*.py загружает общий загрузчик из того же каталога
+_SENTINEL_DIR = str(Path(__file__).resolve().parent)
+if _SENTINEL_DIR not in sys.path:
+    sys.path.insert(0, _SENTINEL_DIR)
+from sentinel_modules import load_sentinel_module as _load_sentinel_module
+
+
+# Динамические наборы прямого доступа
+DIRECT_SETS = ["ips_direct", "ports_direct"]
+DIRECT_IMPORT_CHUNK = 1000
+TIMEOUT_PATTERN = re.compile(r"^\d+[smhd]$")
+
+# Ingress стелс-режим (netdev)
+INGRESS_TABLE = "sentinel_ingress"
+INGRESS_COUNTERS = ["syn_closed_drop", "syn_flood_drop", "icmp_flood_drop", "udp_flood_drop"]
+INGRESS_SYN_RATE = "20/second burst 40 packets"
+INGRESS_ICMP_RATE = "5/second burst 10 packets"
+INGRESS_METER_SIZE = 65535
+INGRESS_METERS = [("syn_meter4", "ipv4_addr"), ("syn_meter6", "ipv6_addr"),
+                  ("icmp_meter4", "ipv4_addr"), ("icmp_meter6", "ipv6_addr"),
+                  ("udp_meter4", "ipv4_addr")]
+
+# Профиль notrack (приоритет raw, до conntrack)
+NOTRACK_TABLE = "sentinel_raw"
+NOTRACK_DEFAULT_CLASSES = [
+    {"name": "dns_local", "loopback": True, "proto": "udp", "port": 53},
+    {"name": "dns_local_tcp", "loopback": True, "proto": "tcp", "port": 53}
+]
+NOTRACK_UDP_TRANSPORTS = ["wireguard", "amneziawg", "hysteria2"]
+
 class KVMNFTablesRouter:
     """
     Маршрутизатор на чистом nftables для KVM.
@@ -36,6 +72,8 @@ class KVMNFTablesRouter:
     """
     
     def __init__(self, kvm_resources: Dict[str, Any] = None):
+        self.link_monitor = None
+        self.vpn_interfaces: Set[str] = set()
         self.kvm_resources = kvm_resources or self._detect_kvm_resources()
         self.nftables_bin = self._find_nftables()
         self.rules_dir = Path("/etc/nftables.d")
@@ -55,6 +93,15 @@ class KVMNFTablesRouter:
             "custom": self.rules_dir / "99-custom.nft"
         }
         
+        # Профиль защиты, из которого скомпилирован 40-protection.nft:
+        # enable_* в новом процессе дополняют его, а не начинают с пустого
+        self.protection_state = self.rules_dir / "40-protection.json"
+        self.protection_profile: Dict[str, Any] = self._load_protection_profile()
+        
+        # Порядок правил, выученный optimize_rule_order: reload_all_rules
+        # собирает цепочки из build_base_ruleset и восстанавливает его
+        self.rule_order_state = self.rules_dir / "50-rule-order.json"
+        
         # Проверка nftables
         self._check_nftables()
         
@@ -73,18 +120,12 @@ class KVMNFTablesRouter:
     
     def _check_virtio_net(self) -> bool:
         """Проверка VirtIO сетевых устройств"""
-        for dev in ["eth0", "eth1", "ens3", "ens4"]:
-            path = f"/sys/class/net/{dev}/device/driver"
-            if os.path.exists(path):
-                driver = os.path.realpath(path).split('/')[-1]
-                if "virtio" in driver:
-                    return True
-        return False
+        return bool(self._get_virtio_net_devices())
     
     def _get_virtio_queues(self) -> int:
         """Получение количества очередей VirtIO"""
         try:
-            for dev in ["eth0", "eth1", "ens3", "ens4"]:
+            for dev in self._get_virtio_net_devices():
                 queues_path = f"/sys/class/net/{dev}/queues"
                 if os.path.exists(queues_path):
                     rx_queues = len(list(Path(queues_path).glob("rx-*")))
@@ -113,12 +154,23 @@ class KVMNFTablesRouter:
     
     def _init_nftables(self):
         """Инициализация базовых таблиц nftables"""
-        rules = """
+        self._apply_rules_string(self.build_base_ruleset())
+        logger.info("✅ Базовые nftables таблицы созданы")
+
+    @staticmethod
+    def build_base_ruleset() -> str:
+        """Базовый ruleset (без применения, используется и бенчмарком)"""
+        return """
 # SENTINEL OS KVM - Base nftables Configuration
 flush ruleset
 
 table inet sentinel {
     # Базовые наборы
+    set vpn_ifaces {
+        type ifname
+        elements = { "wg0", "wg1", "tun0", "tap0" }
+    }
+    
     set geoip_direct {
         type ipv4_addr
         flags interval
@@ -128,13 +180,13 @@ table inet sentinel {
     
     set ports_direct {
         type inet_service
-        flags constant
+        flags interval, timeout
         elements = { 6881-6889 }
     }
     
     set ips_direct {
         type ipv4_addr
-        flags constant
+        flags interval, timeout
         elements = { 192.168.1.11 }
     }
     
@@ -142,16 +194,30 @@ table inet sentinel {
     chain prerouting {
         type filter hook prerouting priority -150; policy accept;
         
+        # Поток уже классифицирован: восстанавливаем решение из ct mark
+        # (бит 0x2 - поток классифицирован, 0x1 - прямой доступ; остальные биты не трогаем)
+        ct mark & 0x00000003 == 0x00000003 meta mark set meta mark | 0x00000001 accept
+        ct mark & 0x00000003 == 0x00000002 accept
+        
+        # Первый пакет потока: классификация и сохранение в ct mark
+        jump classify
+        meta mark & 0x00000001 == 0x00000001 ct mark set ct mark & 0xfffffffc | 0x00000003
+        meta mark & 0x00000001 == 0x00000000 ct mark set ct mark & 0xfffffffc | 0x00000002
+    }
+    
+    # Классификация потока (выход на первом совпадении).
+    # Первым в prerouting может прийти ответ (поток начат локально),
+    # поэтому сверяем кортеж исходного направления из conntrack.
+    chain classify {
         # Прямой доступ для GEOIP
-        ip saddr @geoip_direct meta mark set 0x00000001
+        ct original ip saddr @geoip_direct meta mark set meta mark | 0x00000001 return
         
         # Прямой доступ для торрентов
-        tcp dport @ports_direct meta mark set 0x00000001
-        udp dport @ports_direct meta mark set 0x00000001
+        meta l4proto { tcp, udp } ct original proto-dst @ports_direct meta mark set meta mark | 0x00000001 return
         
         # Прямой доступ для IP сервера
-        ip saddr @ips_direct meta mark set 0x00000001
-        ip daddr @ips_direct meta mark set 0x00000001
+        ct original ip saddr @ips_direct meta mark set meta mark | 0x00000001 return
+        ct original ip daddr @ips_direct meta mark set meta mark | 0x00000001 return
     }
     
     # Цепочка форвардинга
@@ -159,11 +225,11 @@ table inet sentinel {
         type filter hook forward priority 0; policy drop;
         
         # Разрешаем маркированный трафик
-        meta mark 0x00000001 accept
+        meta mark & 0x00000001 == 0x00000001 accept
         
-        # Разрешаем VPN трафик
-        oifname { "wg0", "wg1", "tun0", "tap0" } accept
-        iifname { "wg0", "wg1", "tun0", "tap0" } accept
+        # Разрешаем VPN трафик (набор обновляется монитором интерфейсов)
+        oifname @vpn_ifaces accept
+        iifname @vpn_ifaces accept
         
         # Разрешаем установленные соединения
         ct state { established, related } accept
@@ -172,7 +238,7 @@ table inet sentinel {
     # Цепочка вывода
     chain output {
         type route hook output priority -150; policy accept;
-        meta mark 0x00000001 return
+        meta mark & 0x00000001 == 0x00000001 return
     }
 }
 
@@ -195,9 +261,6 @@ table inet sentinel_dns {
     }
 }
 """
-        
-        self._apply_rules_string(rules)
-        logger.info("✅ Базовые nftables таблицы созданы")
     
     def _apply_rules_string(self, rules: str) -> bool:
         """Применение правил из строки"""
@@ -214,6 +277,22 @@ table inet sentinel_dns {
             logger.error(f"❌ Ошибка: {e}")
             return False
     
+    def _apply_json(self, commands: List[Dict[str, Any]]) -> bool:
+        """Применение JSON команд nftables одной атомарной транзакцией"""
+        try:
+            result = subprocess.run(
+                f"{self.nftables_bin} -j -f -",
+                input=json.dumps({"nftables": commands}),
+                shell=True, capture_output=True, text=True
+            )
+            if result.returncode != 0:
+                logger.error(f"❌ Ошибка применения правил: {result.stderr}")
+                return False
+            return True
+        except Exception as e:
+            logger.error(f"❌ Ошибка: {e}")
+            return False
+    
     def _apply_rules_file(self, filepath: Path) -> bool:
         """Применение правил из файла"""
         try:
@@ -283,134 +362,728 @@ add element inet sentinel geoip_direct {{ {', '.join(networks)} }}
         # Добавляем в существующий набор
         self._apply_rules_file(set_file)
     
-    def add_vpn_interface(self, iface: str, table: str = "inet", chain: str = "forward"):
-        """Добавление VPN интерфейса в правила форвардинга"""
-        rules = f"""
-add rule {table} sentinel {chain} oifname {{ "{iface}" }} accept
-add rule {table} sentinel {chain} iifname {{ "{iface}" }} accept
-"""
-        self._apply_rules_string(rules)
-        logger.info(f"✅ VPN интерфейс {iface} добавлен в маршрутизацию")
+    def add_vpn_interface(self, iface: str, table: str = "inet"):
+        """Добавление VPN интерфейса в набор форвардинга"""
+        if self._apply_rules_string(f'add element {table} sentinel vpn_ifaces {{ "{iface}" }}'):
+            self.vpn_interfaces.add(iface)
+            logger.info(f"✅ VPN интерфейс {iface} добавлен в маршрутизацию")
     
-    def remove_vpn_interface(self, iface: str, table: str = "inet", chain: str = "forward"):
-        """Удаление VPN интерфейса из правил"""
-        # В nftables нет прямого удаления, нужно перезагрузить всю таблицу
-        self.reload_all_rules()
-        logger.info(f"🔄 Правила перезагружены, интерфейс {iface} удален")
+    def remove_vpn_interface(self, iface: str, table: str = "inet"):
+        """Удаление VPN интерфейса из набора форвардинга"""
+        if self._apply_rules_string(f'delete element {table} sentinel vpn_ifaces {{ "{iface}" }}'):
+            self.vpn_interfaces.discard(iface)
+            logger.info(f"✅ VPN интерфейс {iface} удален из маршрутизации")
+
+    def watch_interfaces(self, monitor=None):
+        """
+        Синхронизация набора vpn_ifaces с событиями LinkMonitor.
+
+        Args:
+            monitor: Экземпляр LinkMonitor (по умолчанию создается и запускается новый)
+
+        Returns:
+            Используемый монитор
+        """
+        if monitor is None:
+            monitor = _load_sentinel_module("sentinel-netlink-kvm.py").LinkMonitor()
+        self.link_monitor = monitor
+
+        def on_event(event: str, info):
+            if not info.is_vpn:
+                return
+            if event == "removed":
+                if info.name in self.vpn_interfaces:
+                    self.remove_vpn_interface(info.name)
+            elif info.name not in self.vpn_interfaces:
+                self.add_vpn_interface(info.name)
+
+        monitor.subscribe(on_event)
+        if not monitor.running:
+            monitor.start_monitoring()
+        for info in monitor.vpn_interfaces():
+            on_event("added", info)
+        return monitor
     
-    def add_direct_ip(self, ip: str):
+    def add_direct_ip(self, ip: str, timeout: Optional[str] = None) -> bool:
         """Добавление IP для прямого доступа"""
-        rules = f"add element inet sentinel ips_direct {{ {ip} }}"
-        self._apply_rules_string(rules)
-        logger.info(f"✅ IP {ip} добавлен для прямого доступа")
-    
-    def add_direct_port(self, port: int, proto: str = "tcp"):
+        stats = self.import_direct_elements("ips_direct", [ip], timeout=timeout)
+        if stats["added"]:
+            logger.info(f"✅ IP {ip} добавлен для прямого доступа")
+        elif stats["duplicates"]:
+            logger.info(f"ℹ️ IP {ip} уже в наборе прямого доступа")
+        else:
+            logger.error(f"❌ IP {ip} не добавлен для прямого доступа")
+        return bool(stats["added"] or stats["duplicates"])
+
+    def add_direct_port(self, port: int, proto: str = "tcp", timeout: Optional[str] = None) -> bool:
         """Добавление порта для прямого доступа"""
-        rules = f"add element inet sentinel ports_direct {{ {port} }}"
-        self._apply_rules_string(rules)
-        logger.info(f"✅ Порт {port}/{proto} добавлен для прямого доступа")
+        stats = self.import_direct_elements("ports_direct", [port], timeout=timeout)
+        if stats["added"]:
+            logger.info(f"✅ Порт {port}/{proto} добавлен для прямого доступа")
+        elif stats["duplicates"]:
+            logger.info(f"ℹ️ Порт {port}/{proto} уже в наборе прямого доступа")
+        else:
+            logger.error(f"❌ Порт {port}/{proto} не добавлен для прямого доступа")
+        return bool(stats["added"] or stats["duplicates"])
+
+    def import_direct_elements(self, set_name: str, source: Union[str, Path, Iterable[Any]],
+                               timeout: Optional[str] = None,
+                               chunk_size: int = DIRECT_IMPORT_CHUNK) -> Dict[str, Any]:
+        """
+        Потоковый импорт элементов в ips_direct / ports_direct.
+
+        Args:
+            set_name: "ips_direct" или "ports_direct"
+            source: Путь к файлу (по элементу на строку, "элемент [timeout]")
+                    или iterable из элементов / кортежей (элемент, timeout)
+            timeout: Таймаут по умолчанию для элементов без своего ("1h", 3600)
+            chunk_size: Количество элементов в одной транзакции nft
+
+        Returns:
+            Dict со статистикой импорта и пропускной способностью
+        """
+        if set_name not in DIRECT_SETS:
+            raise ValueError(f"Неизвестный набор: {set_name}")
+        if timeout is not None and self._format_timeout(timeout) is None:
+            raise ValueError(f"Некорректный таймаут: {timeout}")
+
+        stats = {
+            "set": set_name,
+            "read": 0,
+            "added": 0,
+            "duplicates": 0,
+            "invalid": 0,
+            "failed": 0,
+            "chunks": 0,
+            "elapsed_sec": 0.0,
+            "elements_per_sec": 0.0
+        }
+
+        start = time.monotonic()
+        existing = self._get_set_elements(set_name)
+        # Интервалы набора: элемент внутри существующего диапазона - дубль,
+        # иначе nft отклонил бы всю транзакцию из-за пересечения
+        covered = self._merge_intervals(self._element_interval(set_name, e) for e in existing)
+        covered_starts = [low for low, _ in covered]
+        chunk: List[str] = []
+
+        for element, elem_timeout in self._iter_direct_source(source):
+            stats["read"] += 1
+
+            normalized = self._normalize_set_element(set_name, element)
+            if normalized is None:
+                stats["invalid"] += 1
+                continue
+            if normalized in existing:
+                stats["duplicates"] += 1
+                continue
+            low, high = self._element_interval(set_name, normalized)
+            i = bisect.bisect_right(covered_starts, low) - 1
+            if i >= 0 and covered[i][1] >= high:
+                stats["duplicates"] += 1
+                continue
+
+            elem_timeout = elem_timeout or timeout
+            if elem_timeout:
+                formatted = self._format_timeout(elem_timeout)
+                if formatted is None:
+                    stats["invalid"] += 1
+                    continue
+                chunk.append(f"{normalized} timeout {formatted}")
+            else:
+                chunk.append(normalized)
+            existing.add(normalized)
+
+            if len(chunk) >= chunk_size:
+                self._commit_set_chunk(set_name, chunk, stats)
+                chunk = []
+
+        if chunk:
+            self._commit_set_chunk(set_name, chunk, stats)
+
+        stats["elapsed_sec"] = round(time.monotonic() - start, 3)
+        if stats["elapsed_sec"] > 0:
+            stats["elements_per_sec"] = round(stats["added"] / stats["elapsed_sec"], 1)
+
+        logger.info(f"✅ {set_name}: добавлено {stats['added']}, дублей {stats['duplicates']}, "
+                    f"ошибок {stats['invalid'] + stats['failed']} "
+                    f"({stats['elements_per_sec']} эл/с)")
+        return stats
+
+    def _iter_direct_source(self, source: Union[str, Path, Iterable[Any]]) -> Iterator[Tuple[str, Optional[str]]]:
+        """Потоковое чтение элементов из файла или iterable"""
+        if isinstance(source, (str, Path)):
+            with open(source, 'r') as f:
+                for line in f:
+                    line = line.split('#', 1)[0].strip()
+                    if not line:
+                        continue
+                    parts = line.split()
+                    yield parts[0], parts[1] if len(parts) > 1 else None
+            return
+
+        for item in source:
+            if isinstance(item, (tuple, list)):
+                yield str(item[0]), item[1] if len(item) > 1 else None
+            else:
+                yield str(item), None
+
+    def _normalize_set_element(self, set_name: str, element: str) -> Optional[str]:
+        """Каноническая форма элемента набора (для дедупликации)"""
+        element = element.strip()
+        try:
+            if set_name == "ports_direct":
+                if '-' in element:
+                    low, high = (int(p) for p in element.split('-', 1))
+                    if not 0 < low <= high <= 65535:
+                        return None
+                    return f"{low}-{high}" if low != high else str(low)
+                port = int(element)
+                return str(port) if 0 < port <= 65535 else None
+
+            if '-' in element:
+                low, high = (ipaddress.IPv4Address(p.strip()) for p in element.split('-', 1))
+                if low > high:
+                    return None
+                return f"{low}-{high}" if low != high else str(low)
+            network = ipaddress.IPv4Network(element, strict=False)
+            if network.prefixlen == 32:
+                return str(network.network_address)
+            return str(network)
+        except ValueError:
+            return None
+
+    def _element_interval(self, set_name: str, normalized: str) -> Tuple[int, int]:
+        """Границы канонического элемента как целые (порт или IPv4)"""
+        if set_name == "ports_direct":
+            low, _, high = normalized.partition('-')
+            return int(low), int(high or low)
+        if '-' in normalized:
+            low, high = normalized.split('-', 1)
+            return int(ipaddress.IPv4Address(low)), int(ipaddress.IPv4Address(high))
+        network = ipaddress.IPv4Network(normalized)
+        return int(network.network_address), int(network.broadcast_address)
+
+    @staticmethod
+    def _merge_intervals(intervals: Iterable[Tuple[int, int]]) -> List[Tuple[int, int]]:
+        """Сортировка и слияние пересекающихся интервалов"""
+        merged: List[Tuple[int, int]] = []
+        for low, high in sorted(intervals):
+            if merged and low <= merged[-1][1] + 1:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], high))
+            else:
+                merged.append((low, high))
+        return merged
+
+    def _format_timeout(self, timeout: Union[str, int]) -> Optional[str]:
+        """Форматирование таймаута для nftables (None - некорректный)"""
+        if isinstance(timeout, int) or str(timeout).isdigit():
+            return f"{int(timeout)}s"
+        timeout = str(timeout).strip()
+        # Значение подставляется в команду nft: только число и единица
+        return timeout if TIMEOUT_PATTERN.match(timeout) else None
+
+    def _commit_set_chunk(self, set_name: str, chunk: List[str], stats: Dict[str, Any]):
+        """
+        Фиксация порции элементов одной транзакцией nft
+
+        При отказе (пересечение интервалов внутри импорта и т.п.) порция
+        делится пополам до отдельных элементов: в failed попадают только
+        отвергнутые элементы, а не вся транзакция.
+        """
+        rules = f"add element inet sentinel {set_name} {{ {', '.join(chunk)} }}"
+        stats["chunks"] += 1
+        if self._apply_rules_string(rules):
+            stats["added"] += len(chunk)
+        elif len(chunk) == 1:
+            stats["failed"] += 1
+        else:
+            middle = len(chunk) // 2
+            self._commit_set_chunk(set_name, chunk[:middle], stats)
+            self._commit_set_chunk(set_name, chunk[middle:], stats)
+
+    def _get_set_elements(self, set_name: str) -> Set[str]:
+        """Получение текущих элементов набора в канонической форме"""
+        elements: Set[str] = set()
+        result = subprocess.run(
+            f"{self.nftables_bin} -j list set inet sentinel {set_name}",
+            shell=True, capture_output=True, text=True
+        )
+        if result.returncode != 0:
+            return elements
+
+        try:
+            data = json.loads(result.stdout)
+        except ValueError:
+            return elements
+
+        for item in data.get("nftables", []):
+            for value in item.get("set", {}).get("elem", []):
+                if isinstance(value, dict) and "elem" in value:
+                    value = value["elem"]["val"]
+                if isinstance(value, dict) and "prefix" in value:
+                    value = f"{value['prefix']['addr']}/{value['prefix']['len']}"
+                elif isinstance(value, dict) and "range" in value:
+                    value = f"{value['range'][0]}-{value['range'][1]}"
+                normalized = self._normalize_set_element(set_name, str(value))
+                if normalized:
+                    elements.add(normalized)
+
+        return elements
     
     def enable_dns_leak_protection(self):
         """Включение защиты от DNS утечек"""
-        rules = """
-# DNS Leak Protection
-add table inet sentinel_dns
-add chain inet sentinel_dns output { type filter hook output priority -160; policy accept; }
-add rule inet sentinel_dns output ip daddr != 127.0.0.1 udp dport 53 drop
-add rule inet sentinel_dns output ip daddr != 127.0.0.1 tcp dport 53 drop
-add rule inet sentinel_dns output ip6 daddr != ::1 udp dport 53 drop
-add rule inet sentinel_dns output ip6 daddr != ::1 tcp dport 53 drop
-"""
-        self._apply_rules_string(rules)
-        logger.info("✅ Защита от DNS утечек включена")
+        if self._enable_protection("dns_leak", True):
+            logger.info("✅ Защита от DNS утечек включена")
     
     def enable_ipv6_leak_protection(self):
         """Включение защиты от IPv6 утечек"""
-        rules = """
-# IPv6 Leak Protection
-add table inet sentinel_ipv6
-add chain inet sentinel_ipv6 output { type filter hook output priority -150; policy accept; }
-add rule inet sentinel_ipv6 output ip6 daddr { ::/0 } reject with icmpv6 addr-unreachable
-"""
-        self._apply_rules_string(rules)
-        logger.info("✅ Защита от IPv6 утечек включена")
-    
-    def enable_port_stealth(self):
-        """Включение стелс-режима (скрытие открытых портов)"""
-        rules = """
-# Port Stealth Mode
-add table inet sentinel_stealth
-add chain inet sentinel_stealth input { type filter hook input priority -150; policy drop; }
+        if self._enable_protection("ipv6_leak", True):
+            logger.info("✅ Защита от IPv6 утечек включена")
+
+    def _load_protection_profile(self) -> Dict[str, Any]:
+        """Сохраненный профиль защиты (пустой, если профиль еще не применялся)"""
+        try:
+            return json.loads(self.protection_state.read_text())
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logger.warning(f"⚠️ Профиль защиты {self.protection_state} не прочитан: {e}")
+            return {}
 
-# Разрешаем только established соединения
-add rule inet sentinel_stealth input ct state { established, related } accept
+    def _save_protection_profile(self):
+        """Сохранение профиля защиты рядом с 40-protection.nft"""
+        tmp = self.protection_state.with_suffix(".tmp")
+        tmp.write_text(json.dumps(self.protection_profile, indent=2, ensure_ascii=False))
+        tmp.replace(self.protection_state)
 
-# Разрешаем локальный трафик
-add rule inet sentinel_stealth input iif "lo" accept
+    def _enable_protection(self, name: str, value: Any) -> bool:
+        """
+        Включение одной защиты через ProtectionProfileCompiler.
+        Защита добавляется к текущему профилю, и профиль перекомпилируется
+        целиком: отдельные таблицы sentinel_* больше не создаются.
+        """
+        profile = dict(self.protection_profile)
+        profile[name] = value
+        return self.apply_protection_profile(profile)["applied"]
+    
+    def enable_port_stealth(self, ingress: bool = False, **ingress_options):
+        """
+        Включение стелс-режима (скрытие открытых портов).
 
-# Разрешаем ICMP
-add rule inet sentinel_stealth input ip protocol icmp accept
-add rule inet sentinel_stealth input ip6 protocol icmpv6 accept
-"""
-        self._apply_rules_string(rules)
-        logger.info("✅ Стелс-режим включен")
+        Args:
+            ingress: Дополнительно отбрасывать незапрошенные пакеты в netdev ingress
+                     (до conntrack), см. enable_ingress_stealth
+        """
+        if ingress:
+            self.enable_ingress_stealth(**ingress_options)
+
+        if self._enable_protection("port_stealth", True):
+            logger.info("✅ Стелс-режим включен")
     
-    def enable_ttl_fuzzing(self, mode: str = "random"):
-        """Включение TTL фаззинга для обхода DPI"""
-        if mode == "random":
-            ttl_rules = "ip ttl set 64-128"
-        elif mode == "windows":
-            ttl_rules = "ip ttl set 128"
-        elif mode == "linux":
-            ttl_rules = "ip ttl set 64"
+    def enable_ingress_stealth(self, devices: List[str] = None, open_ports: List[Union[int, str]] = None,
+                               syn_rate: str = INGRESS_SYN_RATE, icmp_rate: str = INGRESS_ICMP_RATE,
+                               udp_rate: Optional[str] = None, close_all_ports: bool = False) -> bool:
+        """
+        Ранний drop в netdev ingress на WAN интерфейсах.
+        Сканы и флуд отбрасываются до создания записи conntrack и стека IP.
+
+        Ingress стоит до маршрутизации: незапрошенный SYN отбрасывается и для
+        транзитного трафика. Поэтому интерфейсы задаются явно (только WAN, не LAN),
+        а порты create_port_forward должны входить в open_ports.
+
+        Args:
+            devices: WAN интерфейсы (обязательно)
+            open_ports: TCP порты, на которые разрешены входящие SYN
+            syn_rate: Лимит новых TCP соединений на источник ("20/second burst 40 packets")
+            icmp_rate: Лимит echo-request на источник (ICMP и ICMPv6)
+            udp_rate: Лимит UDP на источник (None - без лимита)
+            close_all_ports: Явное согласие отбрасывать все входящие SYN при пустом open_ports
+        """
+        if not devices:
+            logger.warning("⚠️ Ingress стелс не включен: WAN интерфейсы не заданы")
+            return False
+        if not open_ports and not close_all_ports:
+            logger.warning("⚠️ Ingress стелс не включен: open_ports пуст "
+                           "(все входящие SYN, включая проброс портов, будут отброшены; см. close_all_ports)")
+            return False
+
+        device_list = ", ".join(f'"{dev}"' for dev in devices)
+        ports = ", ".join(str(p) for p in open_ports or [])
+        syn = "tcp flags & (fin | syn | rst | ack) == syn"
+
+        lines = [
+            "# Ingress Stealth Mode (netdev, до conntrack)",
+            f"add table netdev {INGRESS_TABLE}",
+            f"delete table netdev {INGRESS_TABLE}",
+            f"table netdev {INGRESS_TABLE} {{"
+        ]
+        for counter in INGRESS_COUNTERS:
+            lines.append(f"    counter {counter} {{ }}")
+
+        # Метры по источникам: ограниченный размер и таймаут держат память и CPU
+        for meter, addr_type in INGRESS_METERS:
+            lines.append(f"    set {meter} {{ type {addr_type}; size {INGRESS_METER_SIZE}; "
+                         f"flags dynamic, timeout; timeout 60s; }}")
+
+        if ports:
+            lines.append(f"    set open_ports {{ type inet_service; flags interval; elements = {{ {ports} }}; }}")
+
+        lines.append("    chain ingress {")
+        lines.append(f"        type filter hook ingress devices = {{ {device_list} }} priority -500; policy accept;")
+
+        # Незапрошенные SYN на закрытые порты
+        if ports:
+            lines.append(f'        {syn} tcp dport != @open_ports counter name "syn_closed_drop" drop')
         else:
-            ttl_rules = "ip ttl set 65"
-        
-        rules = f"""
-# TTL Fuzzing
-add table inet sentinel_ttl
-add chain inet sentinel_ttl postrouting {{ type filter hook postrouting priority -150; policy accept; }}
-add rule inet sentinel_ttl postrouting {ttl_rules}
-"""
-        self._apply_rules_string(rules)
-        logger.info(f"✅ TTL фаззинг включен (режим: {mode})")
+            lines.append(f'        {syn} counter name "syn_closed_drop" drop')
+
+        # SYN флуд на открытые порты
+        lines.append(f'        ip protocol tcp {syn} update @syn_meter4 {{ ip saddr limit rate over {syn_rate} }} '
+                     f'counter name "syn_flood_drop" drop')
+        lines.append(f'        ip6 nexthdr tcp {syn} update @syn_meter6 {{ ip6 saddr limit rate over {syn_rate} }} '
+                     f'counter name "syn_flood_drop" drop')
+
+        # ICMP флуд
+        lines.append(f'        icmp type echo-request update @icmp_meter4 {{ ip saddr limit rate over {icmp_rate} }} '
+                     f'counter name "icmp_flood_drop" drop')
+        lines.append(f'        icmpv6 type echo-request update @icmp_meter6 {{ ip6 saddr limit rate over {icmp_rate} }} '
+                     f'counter name "icmp_flood_drop" drop')
+
+        # UDP флуд (опционально: ответы VPN транспорта тоже UDP)
+        if udp_rate:
+            lines.append(f'        ip protocol udp update @udp_meter4 {{ ip saddr limit rate over {udp_rate} }} '
+                         f'counter name "udp_flood_drop" drop')
+
+        lines.append("    }")
+        lines.append("}")
+
+        success = self._apply_rules_string("\n".join(lines) + "\n")
+        if success:
+            logger.info(f"✅ Ingress стелс включен на {', '.join(devices)}")
+        return success
+
+    def get_ingress_counters(self) -> Dict[str, Any]:
+        """Счетчики drop/rate-limit ingress стелс-режима"""
+        counters: Dict[str, Any] = {}
+        result = subprocess.run(
+            f"{self.nftables_bin} -j list counters table netdev {INGRESS_TABLE}",
+            shell=True, capture_output=True, text=True
+        )
+        if result.returncode != 0:
+            return counters
+
+        try:
+            data = json.loads(result.stdout)
+        except ValueError:
+            return counters
+
+        for item in data.get("nftables", []):
+            counter = item.get("counter")
+            if counter:
+                counters[counter["name"]] = {
+                    "packets": counter.get("packets", 0),
+                    "bytes": counter.get("bytes", 0)
+                }
+
+        # Количество отслеживаемых источников в метрах
+        for meter, _ in INGRESS_METERS:
+            result = subprocess.run(
+                f"{self.nftables_bin} -j list set netdev {INGRESS_TABLE} {meter}",
+                shell=True, capture_output=True, text=True
+            )
+            if result.returncode == 0:
+                try:
+                    sets = [i["set"] for i in json.loads(result.stdout).get("nftables", []) if "set" in i]
+                    counters[meter] = {"sources": len(sets[0].get("elem", [])) if sets else 0}
+                except ValueError:
+                    pass
+
+        return counters
+
+    def _get_virtio_net_devices(self) -> List[str]:
+        """Список сетевых интерфейсов с драйвером VirtIO"""
+        if self.link_monitor and self.link_monitor.running:
+            return [info.name for info in self.link_monitor.virtio_devices()]
+        devices = []
+        for dev_path in sorted(Path("/sys/class/net").glob("*")):
+            driver_path = dev_path / "device" / "driver"
+            if driver_path.exists() and "virtio" in driver_path.resolve().name:
+                devices.append(dev_path.name)
+        return devices
+
+    def enable_notrack_profile(self, flow_classes: List[Dict[str, Any]] = None,
+                               parsed_configs: List[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """
+        Обход conntrack (notrack) для потоков, которым не нужно состояние.
+
+        Args:
+            flow_classes: Классы потоков {"name", "proto", "port", "loopback"|"address"}
+                          (по умолчанию локальный DNS)
+            parsed_configs: Результаты KVMProtocolParser.parse - из них извлекаются
+                            UDP эндпоинты WireGuard/AmneziaWG/Hysteria2
+
+        Returns:
+            Dict с примененными классами
+        """
+        classes = list(flow_classes if flow_classes is not None else NOTRACK_DEFAULT_CLASSES)
+        if parsed_configs:
+            classes.extend(self.notrack_classes_from_parsed(parsed_configs))
+
+        prerouting: List[str] = []
+        output: List[str] = []
+        counters: List[str] = []
+
+        for flow in classes:
+            name = flow["name"]
+            proto = flow.get("proto", "udp")
+            port = flow["port"]
+            counter = f'counter name "notrack_{name}" notrack'
+            counters.append(f"notrack_{name}")
+
+            if flow.get("loopback"):
+                # Запрос и ответ проходят output и prerouting на lo
+                for direction in ("dport", "sport"):
+                    output.append(f'oif "lo" {proto} {direction} {port} {counter}')
+                    prerouting.append(f'iif "lo" {proto} {direction} {port} {counter}')
+                continue
+
+            family = "ip6" if ":" in flow["address"] else "ip"
+            output.append(f'{family} daddr {flow["address"]} {proto} dport {port} {counter}')
+            prerouting.append(f'{family} saddr {flow["address"]} {proto} sport {port} {counter}')
+
+        lines = [
+            "# Conntrack Bypass Profile",
+            f"add table inet {NOTRACK_TABLE}",
+            f"delete table inet {NOTRACK_TABLE}",
+            f"table inet {NOTRACK_TABLE} {{"
+        ]
+        lines.extend(f"    counter {counter} {{ }}" for counter in dict.fromkeys(counters))
+        for chain, hook, rules in (("prerouting", "prerouting", prerouting), ("output", "output", output)):
+            lines.append(f"    chain {chain} {{")
+            lines.append(f"        type filter hook {hook} priority raw; policy accept;")
+            lines.extend(f"        {rule}" for rule in rules)
+            lines.append("    }")
+        lines.append("}")
+
+        success = self._apply_rules_string("\n".join(lines) + "\n")
+        if success:
+            logger.info(f"✅ notrack профиль: {', '.join(flow['name'] for flow in classes)}")
+            # Стелс-режим принимает untracked только для этих классов: перекомпилируем
+            if self.protection_profile.get("port_stealth"):
+                profile = dict(self.protection_profile)
+                profile["notrack_classes"] = classes
+                self.apply_protection_profile(profile)
+            else:
+                self.protection_profile["notrack_classes"] = classes
+                self._save_protection_profile()
+
+        return {
+            "applied": success,
+            "classes": classes
+        }
+
+    def notrack_classes_from_parsed(self, parsed_configs: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Классы notrack из UDP эндпоинтов распарсенных протоколов"""
+        classes = []
+        seen = set()
+
+        for parsed in parsed_configs:
+            proto_type = parsed.get("type") or parsed.get("protocol")
+            if proto_type not in NOTRACK_UDP_TRANSPORTS:
+                continue
+
+            endpoints = []
+            if proto_type == "hysteria2" and parsed.get("server"):
+                endpoints.append((parsed["server"], parsed.get("port", 443)))
+            for peer in parsed.get("peers", []):
+                endpoint = peer.get("endpoint", "")
+                host, sep, port = endpoint.rpartition(':')
+                if sep and port.isdigit():
+                    endpoints.append((host.strip("[]"), int(port)))
+
+            for host, port in endpoints:
+                for address in self._resolve_endpoint(host, port):
+                    if (address, port) in seen:
+                        continue
+                    seen.add((address, port))
+                    classes.append({
+                        "name": f"{proto_type}_{len(classes)}",
+                        "proto": "udp",
+                        "address": address,
+                        "port": port
+                    })
+
+        return classes
+
+    def _resolve_endpoint(self, host: str, port: int) -> List[str]:
+        """IP адреса эндпоинта (nftables требует адреса, не имена)"""
+        try:
+            return [str(ipaddress.ip_address(host))]
+        except ValueError:
+            pass
+        try:
+            infos = socket.getaddrinfo(host, port, type=socket.SOCK_DGRAM)
+            return sorted({info[4][0] for info in infos})
+        except OSError as e:
+            logger.warning(f"⚠️ Не удалось разрешить {host}: {e}")
+            return []
+
+    def get_notrack_stats(self) -> Dict[str, Any]:
+        """Пакеты, прошедшие мимо conntrack, по счетчикам правил notrack"""
+        stats: Dict[str, Any] = {"classes": {}}
+        result = subprocess.run(
+            f"{self.nftables_bin} -j list counters table inet {NOTRACK_TABLE}",
+            shell=True, capture_output=True, text=True
+        )
+        if result.returncode == 0:
+            try:
+                for item in json.loads(result.stdout).get("nftables", []):
+                    counter = item.get("counter")
+                    if counter:
+                        stats["classes"][counter["name"][len("notrack_"):]] = {
+                            "packets": counter.get("packets", 0),
+                            "bytes": counter.get("bytes", 0)
+                        }
+            except ValueError:
+                pass
+
+        # Один счетчик на класс: сумма - пакеты, не создавшие записей conntrack
+        stats["bypassed_packets"] = sum(c["packets"] for c in stats["classes"].values())
+        stats["bypassed_bytes"] = sum(c["bytes"] for c in stats["classes"].values())
+        return stats
+
+    def enable_ttl_fuzzing(self, mode: str = "random"):
+        """Включение TTL фаззинга для обхода DPI (режимы TTL_MODES)"""
+        if self._enable_protection("ttl_fuzzing", mode):
+            logger.info(f"✅ TTL фаззинг включен (режим: {mode})")
     
     def enable_mtu_randomization(self):
         """Включение MTU рандомизации"""
         # MTU рандомизация требует изменения на интерфейсах
-        for dev in ["eth0", "eth1", "ens3", "ens4"]:
-            if os.path.exists(f"/sys/class/net/{dev}"):
-                import random
-                new_mtu = random.randint(1300, 1500)
-                subprocess.run(f"ip link set dev {dev} mtu {new_mtu}", shell=True)
+        import random
+        manager = _load_sentinel_module("sentinel-netlink-kvm.py").InterfaceManager()
+        for dev in self._get_virtio_net_devices():
+            new_mtu = random.randint(1300, 1500)
+            if manager.set_mtu(dev, new_mtu):
                 logger.info(f"✅ MTU для {dev}: {new_mtu}")
+        logger.info(f"📊 Операции с интерфейсами: {manager.get_report()}")
+        manager.close()
     
     def enable_fragment_obfuscation(self):
         """Включение обфускации IP фрагментов"""
-        rules = """
-# IP Fragment Obfuscation
-add table inet sentinel_frag
-add chain inet sentinel_frag output { type filter hook output priority -150; policy accept; }
+        if self._enable_protection("fragment_obfuscation", True):
+            logger.info("✅ Обфускация фрагментов включена")
+    
+    def tune_conntrack(self, monitor: bool = True) -> Dict[str, Any]:
+        """
+        Размер таблицы conntrack под память VM и торрент-трафик ports_direct.
 
-# Обфускация идентификаторов фрагментов
-add rule inet sentinel_frag output ip frag-off & 0x1fff != 0 ip id set 0
+        Args:
+            monitor: Запустить мониторинг nf_conntrack_count
+        """
+        low, high = TORRENT_PORTS
+        torrent = False
+        for element in self._get_set_elements("ports_direct"):
+            first, _, last = element.partition('-')
+            if int(first) <= high and int(last or first) >= low:
+                torrent = True
+                break
+
+        self.conntrack = ConntrackManager(self.kvm_resources, torrent_traffic=torrent)
+        plan = self.conntrack.apply_size()
+        if monitor:
+            self.conntrack.start_monitoring()
+        return plan
+
+    def optimize_rule_order(self, chain: str = "forward", window: int = 60,
+                            apply: bool = True) -> Dict[str, Any]:
+        """Переупорядочивание правил цепочки по счетчикам срабатываний"""
+        optimizer = RuleOrderOptimizer(self, chain=chain)
+        report = optimizer.optimize(window=window, apply=apply)
+        if report["applied"]:
+            self._save_rule_order(report["chain"], optimizer.learned_order)
+        return report
+
+    def _load_rule_order(self) -> Dict[str, List[str]]:
+        """Сохраненный порядок правил по цепочкам ("inet sentinel forward")"""
+        try:
+            return json.loads(self.rule_order_state.read_text())
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logger.warning(f"⚠️ Порядок правил {self.rule_order_state} не прочитан: {e}")
+            return {}
+
+    def _save_rule_order(self, chain: str, order: List[str]):
+        """Сохранение выученного порядка цепочки рядом с наборами правил"""
+        state = self._load_rule_order()
+        state[chain] = order
+        tmp = self.rule_order_state.with_suffix(".tmp")
+        tmp.write_text(json.dumps(state, indent=2, ensure_ascii=False))
+        tmp.replace(self.rule_order_state)
+
+    def restore_rule_order(self) -> Dict[str, bool]:
+        """Восстановление выученного порядка после пересборки цепочек"""
+        restored = {}
+        for chain, order in self._load_rule_order().items():
+            family, table, name = chain.split()
+            try:
+                restored[chain] = RuleOrderOptimizer(self, family, table, name).restore(order)
+            except RuntimeError as e:
+                logger.warning(f"⚠️ Порядок правил {chain} не восстановлен: {e}")
+                restored[chain] = False
+        return restored
+
+    def apply_protection_profile(self, profile: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Применение профиля защиты одной таблицей вместо отдельных таблиц.
+
+        Args:
+            profile: {"dns_leak": bool, "ipv6_leak": bool, "port_stealth": bool,
+                      "ttl_fuzzing": "random"|"windows"|"linux"|None,
+                      "fragment_obfuscation": bool,
+                      "notrack_classes": классы enable_notrack_profile}
+
+        Returns:
+            Dict с результатом и модельной оценкой стоимости обхода хуков
+            (cost_model - расчет по модели правил, а не замер nft)
+        """
+        # Классы notrack задает enable_notrack_profile, а не вызывающий код
+        if "notrack_classes" not in profile and "notrack_classes" in self.protection_profile:
+            profile = dict(profile, notrack_classes=self.protection_profile["notrack_classes"])
+
+        compiler = ProtectionProfileCompiler(profile)
+        rules = compiler.compile()
+
+        # Сохраняем для reload_all_rules
+        with open(self.rulesets["protection"], 'w') as f:
+            f.write(rules)
+
+        success = self._apply_rules_file(self.rulesets["protection"])
+        if success:
+            self.protection_profile = dict(profile)
+            self._save_protection_profile()
+            logger.info(f"✅ Профиль защиты применен: {', '.join(compiler.enabled) or 'пустой'}")
+
+        return {
+            "applied": success,
+            "protections": compiler.enabled,
+            "cost_model": compiler.benchmark()
+        }
 
-# Принудительная фрагментация для больших UDP пакетов
-add rule inet sentinel_frag output udp length > 500 ip frag-off set 0x2000
-"""
-        self._apply_rules_string(rules)
-        logger.info("✅ Обфускация фрагментов включена")
-    
     def create_vpn_bypass_rule(self, dest_ip: str, dest_port: int = None):
         """Создание правила обхода VPN для конкретного назначения"""
-        if dest_port:
-            rule = f"add rule inet sentinel output ip daddr {dest_ip} tcp dport {dest_port} meta mark set 0x00000001"
-        else:
-            rule = f"add rule inet sentinel output ip daddr {dest_ip} meta mark set 0x00000001"
-        
-        self._apply_rules_string(rule)
+        self._apply_rules_string(self.build_bypass_rule(dest_ip, dest_port))
         logger.info(f"✅ Правило обхода VPN создано для {dest_ip}")
     
+    @staticmethod
+    def build_bypass_rule(dest_ip: str, dest_port: int = None) -> str:
+        """Текст правила обхода VPN"""
+        if dest_port:
+            return f"add rule inet sentinel output ip daddr {dest_ip} tcp dport {dest_port} meta mark set 0x00000001"
+        return f"add rule inet sentinel output ip daddr {dest_ip} meta mark set 0x00000001"
+
     def create_port_forward(self, public_port: int, private_ip: str, private_port: int, proto: str = "tcp"):
         """Создание проброса портов"""
         rules = f"""
@@ -453,11 +1126,23 @@ add rule inet sentinel_nat postrouting ip daddr {private_ip} masquerade
         """Перезагрузка всех правил"""
         self._init_nftables()
         
+        # vpn_ifaces пересоздан только со статическими элементами: возвращаем
+        # интерфейсы, добавленные hotplug (по снимку монитора, если он запущен)
+        interfaces = set(self.vpn_interfaces)
+        if self.link_monitor is not None and self.link_monitor.running:
+            interfaces = {info.name for info in self.link_monitor.vpn_interfaces()}
+        self.vpn_interfaces.clear()
+        for iface in sorted(interfaces):
+            self.add_vpn_interface(iface)
+        
         # Загружаем все файлы правил
         for ruleset in sorted(self.rulesets.values()):
             if ruleset.exists():
                 self._apply_rules_file(ruleset)
         
+        # Базовый ruleset вернул исходный порядок цепочек
+        self.restore_rule_order()
+        
         logger.info("✅ Все правила перезагружены")
     
     def save_ruleset(self, name: str = "current"):
@@ -476,6 +1161,25 @@ add rule inet sentinel_nat postrouting ip daddr {private_ip} masquerade
         
         return None
     
+    def export_ruleset_json(self, path: Optional[Path] = None) -> Optional[str]:
+        """
+        Сохранение текущего ruleset в JSON форме.
+        Используется sentinel-nfteval-kvm для офлайн оценки стоимости правил.
+        """
+        result = subprocess.run(
+            f"{self.nftables_bin} -j list ruleset",
+            shell=True, capture_output=True, text=True
+        )
+        if result.returncode != 0:
+            logger.error(f"❌ Ошибка экспорта: {result.stderr}")
+            return None
+
+        save_file = Path(path) if path else self.rules_dir / "ruleset.json"
+        with open(save_file, 'w') as f:
+            f.write(result.stdout)
+        logger.info(f"✅ Ruleset (JSON) сохранен в {save_file}")
+        return str(save_file)
+
     def restore_ruleset(self, name: str = "current"):
         """Восстановление сохраненного набора правил"""
         save_file = self.rules_dir / f"saved-{name}.nft"
@@ -549,6 +1253,776 @@ WantedBy=multi-user.target
         logger.info(f"✅ systemd сервис создан: {service_file}")
 
 
+# ============================================================================
+# КОМПИЛЯТОР ПРОФИЛЯ ЗАЩИТЫ
+# ============================================================================
+
+@dataclass
+class ProtectionRule:
+    """Правило защиты и его модель для оценки стоимости"""
+    text: str
+    match: Callable[[Dict[str, Any]], bool]
+    terminal: bool = False
+
+
+def _is_dns(pkt: Dict[str, Any]) -> bool:
+    return pkt.get("l4proto") in ("tcp", "udp") and pkt.get("dport") == 53
+
+
+def _is_local_dns(pkt: Dict[str, Any]) -> bool:
+    return pkt.get("daddr") in ("127.0.0.1", "::1")
+
+
+# Базовые таблицы build_base_ruleset: профиль их не удаляет
+BASE_PROTECTION_TABLES = {"sentinel_dns"}
+
+# Отдельные таблицы, которые создавали прежние enable_* методы
+LEGACY_PROTECTION_TABLES = {
+    "dns_leak": "sentinel_dns",
+    "ipv6_leak": "sentinel_ipv6",
+    "port_stealth": "sentinel_stealth",
+    "ttl_fuzzing": "sentinel_ttl",
+    "fragment_obfuscation": "sentinel_frag"
+}
+
+TTL_MODES = {
+    "random": "ip ttl set numgen random mod 65 offset 64",
+    "windows": "ip ttl set 128",
+    "linux": "ip ttl set 64"
+}
+
+# Типовой набор пакетов: (описание, вес, хуки по пути, поля пакета)
+PROTECTION_BENCH_MIX = [
+    ("tcp_out_https", 40, ["output", "postrouting"],
+     {"family": "ipv4", "l4proto": "tcp", "dport": 443, "daddr": "1.1.1.1", "length": 1400}),
+    ("tcp_in_established", 40, ["input"],
+     {"family": "ipv4", "l4proto": "tcp", "sport": 443, "ct_state": "established", "iif": "eth0"}),
+    ("dns_local", 8, ["output", "postrouting", "input"],
+     {"family": "ipv4", "l4proto": "udp", "dport": 53, "daddr": "127.0.0.1",
+      "ct_state": "new", "iif": "lo", "length": 60}),
+    ("dns_leak", 2, ["output", "postrouting"],
+     {"family": "ipv4", "l4proto": "udp", "dport": 53, "daddr": "8.8.8.8", "length": 60}),
+    ("udp_out_large", 6, ["output", "postrouting"],
+     {"family": "ipv4", "l4proto": "udp", "dport": 51820, "daddr": "5.5.5.5", "length": 1200}),
+    ("ipv6_out", 2, ["output", "postrouting"],
+     {"family": "ipv6", "l4proto": "tcp", "dport": 443, "daddr": "2001:db8::1"}),
+    ("syn_scan", 2, ["input"],
+     {"family": "ipv4", "l4proto": "tcp", "dport": 22, "ct_state": "new", "iif": "eth0"})
+]
+
+
+class ProtectionProfileCompiler:
+    """
+    Компилятор профиля защиты.
+    Сводит все включенные защиты в одну базовую цепочку на хук,
+    прыгая в обычные цепочки только для отфильтрованного трафика.
+    """
+
+    TABLE = "sentinel_protect"
+
+    def __init__(self, profile: Dict[str, Any]):
+        self.profile = profile
+        self.enabled = [name for name in LEGACY_PROTECTION_TABLES if profile.get(name)]
+
+    def _ttl_rule(self) -> ProtectionRule:
+        mode = self.profile.get("ttl_fuzzing")
+        text = TTL_MODES.get(mode, "ip ttl set 65")
+        return ProtectionRule(text, lambda p: p.get("family") == "ipv4")
+
+    def _frag_rules(self) -> List[ProtectionRule]:
+        return [
+            ProtectionRule("ip frag-off & 0x1fff != 0 ip id set 0",
+                           lambda p: p.get("family") == "ipv4" and p.get("fragment", False)),
+            ProtectionRule("udp length > 500 ip frag-off set 0x2000",
+                           lambda p: p.get("l4proto") == "udp" and p.get("length", 0) > 500)
+        ]
+
+    def _stealth_rules(self) -> List[ProtectionRule]:
+        rules = [
+            ProtectionRule("ct state { established, related } accept",
+                           lambda p: p.get("ct_state") in ("established", "related"), True),
+            ProtectionRule('iif "lo" accept', lambda p: p.get("iif") == "lo", True)
+        ]
+        rules.extend(self._untracked_rules())
+        rules.append(ProtectionRule("meta l4proto { icmp, ipv6-icmp } accept",
+                                    lambda p: p.get("l4proto") in ("icmp", "ipv6-icmp"), True))
+        return rules
+
+    def _untracked_rules(self) -> List[ProtectionRule]:
+        """
+        Прием untracked только для классов notrack профиля.
+        Общий ct state untracked пропускал бы любой пакет под notrack
+        правилом, включая подделанные: сверяем адрес, порт и интерфейс.
+        """
+        rules = []
+        for flow in self.profile.get("notrack_classes") or []:
+            proto = flow.get("proto", "udp")
+            port = flow["port"]
+            if flow.get("loopback"):
+                # Локальные классы уже приняты правилом iif "lo"
+                continue
+            family = "ip6" if ":" in flow["address"] else "ip"
+            text = f'ct state untracked {family} saddr {flow["address"]} {proto} sport {port} accept'
+            if flow.get("interface"):
+                text = f'iif "{flow["interface"]}" {text}'
+            rules.append(ProtectionRule(
+                text,
+                lambda p, f=flow, pr=proto: (p.get("ct_state") == "untracked"
+                                             and p.get("saddr") == f["address"]
+                                             and p.get("l4proto") == pr and p.get("sport") == f["port"]
+                                             and (not f.get("interface") or p.get("iif") == f["interface"])),
+                True))
+        return rules
+
+    def _hooks(self) -> Dict[str, Dict[str, Any]]:
+        """Модель скомпилированных базовых цепочек по хукам"""
+        hooks: Dict[str, Dict[str, Any]] = {}
+
+        def hook(name: str, priority: int, policy: str = "accept") -> Dict[str, Any]:
+            if name not in hooks:
+                hooks[name] = {"priority": priority, "policy": policy, "rules": [], "chains": {}}
+            return hooks[name]
+
+        if "dns_leak" in self.enabled:
+            output = hook("output", -160)
+            output["chains"]["dns_guard"] = [
+                ProtectionRule("ip daddr != 127.0.0.1 drop",
+                               lambda p: p.get("family") == "ipv4" and not _is_local_dns(p), True),
+                ProtectionRule("ip6 daddr != ::1 drop",
+                               lambda p: p.get("family") == "ipv6" and not _is_local_dns(p), True)
+            ]
+            output["rules"].append(ProtectionRule("meta l4proto { tcp, udp } th dport 53 jump dns_guard",
+                                                  _is_dns))
+
+        if "ipv6_leak" in self.enabled:
+            hook("output", -150)["rules"].append(
+                ProtectionRule("meta nfproto ipv6 reject with icmpv6 addr-unreachable",
+                               lambda p: p.get("family") == "ipv6", True))
+
+        if "fragment_obfuscation" in self.enabled:
+            hook("output", -150)["rules"].extend(self._frag_rules())
+
+        if "ttl_fuzzing" in self.enabled:
+            hook("postrouting", -150)["rules"].append(self._ttl_rule())
+
+        if "port_stealth" in self.enabled:
+            hook("input", -150, "drop")["rules"].extend(self._stealth_rules())
+
+        return hooks
+
+    def _legacy_hooks(self) -> Dict[str, List[List[ProtectionRule]]]:
+        """Модель раздельных таблиц enable_* методов (базовые цепочки по хукам)"""
+        hooks: Dict[str, List[List[ProtectionRule]]] = {}
+
+        if "dns_leak" in self.enabled:
+            hooks.setdefault("output", []).append([
+                ProtectionRule(f"{fam} daddr != {addr} {proto} dport 53 drop",
+                               lambda p, f=fam, pr=proto: (p.get("family") == ("ipv4" if f == "ip" else "ipv6")
+                                                           and p.get("l4proto") == pr and _is_dns(p)
+                                                           and not _is_local_dns(p)), True)
+                for fam, addr in (("ip", "127.0.0.1"), ("ip6", "::1")) for proto in ("udp", "tcp")
+            ])
+        if "ipv6_leak" in self.enabled:
+            hooks.setdefault("output", []).append([
+                ProtectionRule("ip6 daddr { ::/0 } reject", lambda p: p.get("family") == "ipv6", True)
+            ])
+        if "fragment_obfuscation" in self.enabled:
+            hooks.setdefault("output", []).append(self._frag_rules())
+        if "ttl_fuzzing" in self.enabled:
+            hooks.setdefault("postrouting", []).append([self._ttl_rule()])
+        if "port_stealth" in self.enabled:
+            hooks.setdefault("input", []).append(self._stealth_rules())
+
+        return hooks
+
+    def compile(self) -> str:
+        """Генерация nftables-скрипта для профиля"""
+        lines = [
+            "# SENTINEL OS KVM - Compiled Protection Profile",
+            f"# Generated: {datetime.now().isoformat()}",
+            f"# Protections: {', '.join(self.enabled) or 'none'}",
+            ""
+        ]
+
+        # Удаляем все отдельные таблицы защит, в том числе выключенных в профиле
+        # (add + delete не падает, если таблицы нет). sentinel_dns - базовая защита
+        # от DNS утечек из build_base_ruleset, она остается при любом профиле.
+        for table in LEGACY_PROTECTION_TABLES.values():
+            if table in BASE_PROTECTION_TABLES:
+                continue
+            lines.append(f"add table inet {table}")
+            lines.append(f"delete table inet {table}")
+        lines.append(f"add table inet {self.TABLE}")
+        lines.append(f"delete table inet {self.TABLE}")
+        lines.append("")
+
+        hooks = self._hooks()
+        lines.append(f"table inet {self.TABLE} {{")
+
+        for spec in hooks.values():
+            for chain, rules in spec["chains"].items():
+                lines.append(f"    chain {chain} {{")
+                lines.extend(f"        {rule.text}" for rule in rules)
+                lines.append("    }")
+                lines.append("")
+
+        for name, spec in hooks.items():
+            lines.append(f"    chain {name} {{")
+            lines.append(f"        type filter hook {name} priority {spec['priority']}; "
+                         f"policy {spec['policy']};")
+            lines.extend(f"        {rule.text}" for rule in spec["rules"])
+            lines.append("    }")
+            lines.append("")
+
+        if lines[-1] == "":
+            lines.pop()
+        lines.append("}")
+        return "\n".join(lines) + "\n"
+
+    def _walk(self, rules: List[ProtectionRule], pkt: Dict[str, Any],
+              chains: Dict[str, List[ProtectionRule]]) -> Tuple[int, Optional[str]]:
+        """Количество вычисленных правил и терминальный вердикт (если был)"""
+        evaluations = 0
+        for rule in rules:
+            evaluations += 1
+            if not rule.match(pkt):
+                continue
+            if " jump " in rule.text:
+                target = rule.text.rsplit(" ", 1)[1]
+                sub_evals, verdict = self._walk(chains.get(target, []), pkt, chains)
+                evaluations += sub_evals
+                if verdict:
+                    return evaluations, verdict
+            elif rule.terminal:
+                return evaluations, rule.text.split()[-1] if "reject" not in rule.text else "reject"
+        return evaluations, None
+
+    def _cost(self, path: List[str], pkt: Dict[str, Any],
+              hooks: Dict[str, List[Tuple[List[ProtectionRule], Dict[str, List[ProtectionRule]], str]]]
+              ) -> Tuple[int, int]:
+        """Базовые цепочки и вычисления правил для пакета по его пути через хуки"""
+        base_chains = evaluations = 0
+        for hook_name in path:
+            for rules, chains, policy in hooks.get(hook_name, []):
+                base_chains += 1
+                evals, verdict = self._walk(rules, pkt, chains)
+                evaluations += evals
+                # accept завершает только текущую базовую цепочку, drop/reject - весь путь
+                if (verdict or policy) in ("drop", "reject"):
+                    return base_chains, evaluations
+        return base_chains, evaluations
+
+    def benchmark(self, mix: List[Tuple[str, int, List[str], Dict[str, Any]]] = None) -> Dict[str, Any]:
+        """
+        Модельная оценка стоимости обхода хуков на пакет до и после компиляции.
+
+        Это не замер: правила вычисляются Python-моделью (ProtectionRule.match)
+        на синтетическом наборе пакетов и показывают только число обходимых
+        цепочек и правил, а не время на nft.
+
+        Returns:
+            Dict со средним числом базовых цепочек и вычислений правил на пакет
+        """
+        mix = mix or PROTECTION_BENCH_MIX
+        total_weight = sum(weight for _, weight, _, _ in mix) or 1
+
+        layouts = {
+            "legacy": {
+                hook_name: [(rules, {}, "drop" if hook_name == "input" else "accept") for rules in chains]
+                for hook_name, chains in self._legacy_hooks().items()
+            },
+            "compiled": {
+                hook_name: [(spec["rules"], spec["chains"], spec["policy"])]
+                for hook_name, spec in self._hooks().items()
+            }
+        }
+
+        result: Dict[str, Any] = {"method": "model", "packets": {}}
+        for layout, hooks in layouts.items():
+            result[layout] = {
+                "base_chains": 0.0,
+                "rule_evaluations": 0.0,
+                "per_hook": {hook_name: len(chains) for hook_name, chains in hooks.items()}
+            }
+
+        for name, weight, path, pkt in mix:
+            result["packets"][name] = {}
+            for layout, hooks in layouts.items():
+                base_chains, evaluations = self._cost(path, pkt, hooks)
+                result["packets"][name][layout] = {
+                    "base_chains": base_chains,
+                    "rule_evaluations": evaluations
+                }
+                result[layout]["base_chains"] += base_chains * weight / total_weight
+                result[layout]["rule_evaluations"] += evaluations * weight / total_weight
+
+        for layout in layouts:
+            result[layout]["base_chains"] = round(result[layout]["base_chains"], 2)
+            result[layout]["rule_evaluations"] = round(result[layout]["rule_evaluations"], 2)
+
+        return result
+
+
+# ============================================================================
+# УПРАВЛЕНИЕ CONNTRACK
+# ============================================================================
+
+CONNTRACK_PROC = Path("/proc/sys/net/netfilter")
+CONNTRACK_HASHSIZE = Path("/sys/module/nf_conntrack/parameters/hashsize")
+CONNTRACK_STATE = Path("/var/run/sentinel/kvm/conntrack.json")
+KVM_METRICS = Path("/var/run/sentinel/kvm/metrics.json")
+# Общий с KSMController (sentinel-core-kvm.py): чтение-изменение-запись под flock
+KVM_METRICS_LOCK = Path("/var/run/sentinel/kvm/metrics.json.lock")
+
+CONNTRACK_ENTRY_BYTES = 320      # struct nf_conn + расширения
+CONNTRACK_MEMORY_SHARE = 0.02    # Доля RAM под таблицу conntrack
+CONNTRACK_MIN_ENTRIES = 16384
+CONNTRACK_MAX_ENTRIES = 1048576
+CONNTRACK_TORRENT_ENTRIES = 131072
+CONNTRACK_PEAK_HEADROOM = 2.0
+CONNTRACK_WARN_USAGE = 0.80
+CONNTRACK_CRIT_USAGE = 0.95
+TORRENT_PORTS = (6881, 6889)
+
+
+class ConntrackManager:
+    """
+    Размер таблицы conntrack по памяти VM и наблюдаемому пику,
+    мониторинг nf_conntrack_count и алерты до переполнения.
+    """
+
+    def __init__(self, kvm_resources: Dict[str, Any], torrent_traffic: bool = False):
+        self.kvm_resources = kvm_resources
+        self.torrent_traffic = torrent_traffic
+        self.state = self._load_state()
+        self.running = False
+        self.monitor_thread = None
+
+    def _memory_mb(self) -> int:
+        """Память VM (KVMResources.memory_total или memory_mb роутера)"""
+        return int(self.kvm_resources.get("memory_total") or self.kvm_resources.get("memory_mb") or 1024)
+
+    def _load_state(self) -> Dict[str, Any]:
+        try:
+            with open(CONNTRACK_STATE, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {"peak": 0, "alerts": []}
+
+    def _save_state(self):
+        try:
+            CONNTRACK_STATE.parent.mkdir(parents=True, exist_ok=True)
+            with open(CONNTRACK_STATE, 'w') as f:
+                json.dump(self.state, f, indent=2)
+        except OSError as e:
+            logger.warning(f"⚠️ Не удалось сохранить состояние conntrack: {e}")
+
+    def _read_int(self, path: Path) -> Optional[int]:
+        try:
+            return int(path.read_text().strip())
+        except (OSError, ValueError):
+            return None
+
+    def plan_size(self) -> Dict[str, Any]:
+        """Расчет nf_conntrack_max и числа бакетов"""
+        memory_bytes = self._memory_mb() * 1024 * 1024
+        by_memory = int(memory_bytes * CONNTRACK_MEMORY_SHARE) // CONNTRACK_ENTRY_BYTES
+        by_peak = int(self.state.get("peak", 0) * CONNTRACK_PEAK_HEADROOM)
+
+        candidates = {"memory": by_memory, "peak": by_peak, "minimum": CONNTRACK_MIN_ENTRIES}
+        if self.torrent_traffic:
+            candidates["torrent"] = CONNTRACK_TORRENT_ENTRIES
+
+        reason = max(candidates, key=candidates.get)
+        max_entries = candidates[reason]
+
+        # Не отдаем таблице больше двойной доли памяти даже при высоком пике
+        hard_cap = max(min(int(memory_bytes * CONNTRACK_MEMORY_SHARE * 2) // CONNTRACK_ENTRY_BYTES,
+                           CONNTRACK_MAX_ENTRIES), CONNTRACK_MIN_ENTRIES)
+        if max_entries > hard_cap:
+            max_entries, reason = hard_cap, "memory_cap"
+
+        max_entries = (max_entries + 1023) // 1024 * 1024
+
+        # Хеш-таблица: степень двойки, ~4 записи на бакет
+        buckets = 1
+        while buckets < max_entries // 4:
+            buckets <<= 1
+
+        return {
+            "max": max_entries,
+            "buckets": buckets,
+            "reason": reason,
+            "memory_mb": self._memory_mb(),
+            "estimated_mb": round(max_entries * CONNTRACK_ENTRY_BYTES / (1024 * 1024), 1)
+        }
+
+    def apply_size(self, plan: Dict[str, Any] = None) -> Dict[str, Any]:
+        """Применение размера таблицы conntrack"""
+        plan = plan or self.plan_size()
+        try:
+            # Бакеты: nf_conntrack_buckets (новые ядра) или параметр модуля
+            buckets_path = CONNTRACK_PROC / "nf_conntrack_buckets"
+            target = buckets_path if os.access(buckets_path, os.W_OK) else CONNTRACK_HASHSIZE
+            target.write_text(str(plan["buckets"]))
+
+            (CONNTRACK_PROC / "nf_conntrack_max").write_text(str(plan["max"]))
+            plan["applied"] = True
+            logger.info(f"✅ conntrack: max={plan['max']}, buckets={plan['buckets']} "
+                        f"(~{plan['estimated_mb']}MB, по: {plan['reason']})")
+        except OSError as e:
+            plan["applied"] = False
+            logger.error(f"❌ Ошибка настройки conntrack: {e}")
+        return plan
+
+    def sample(self) -> Dict[str, Any]:
+        """Текущее использование таблицы conntrack"""
+        count = self._read_int(CONNTRACK_PROC / "nf_conntrack_count") or 0
+        max_entries = self._read_int(CONNTRACK_PROC / "nf_conntrack_max") or 0
+
+        if count > self.state.get("peak", 0):
+            self.state["peak"] = count
+            self.state["peak_time"] = datetime.now().isoformat()
+
+        return {
+            "count": count,
+            "max": max_entries,
+            "usage": round(count / max_entries, 4) if max_entries else 0.0,
+            "peak": self.state.get("peak", 0)
+        }
+
+    def check_usage(self, sample: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """Алерты при приближении к переполнению"""
+        alerts = []
+        usage = sample["usage"]
+
+        if usage >= CONNTRACK_CRIT_USAGE:
+            level = "critical"
+            logger.error(f"❌ conntrack почти заполнен: {sample['count']}/{sample['max']} "
+                         f"({usage:.0%}), новые потоки будут отброшены")
+        elif usage >= CONNTRACK_WARN_USAGE:
+            level = "warning"
+            logger.warning(f"⚠️ conntrack: {sample['count']}/{sample['max']} ({usage:.0%})")
+        else:
+            return alerts
+
+        alerts.append({
+            "level": level,
+            "count": sample["count"],
+            "max": sample["max"],
+            "usage": usage,
+            "timestamp": datetime.now().isoformat()
+        })
+        self.state["alerts"] = (self.state.get("alerts", []) + alerts)[-50:]
+
+        # Растем, если пик позволяет увеличить таблицу в пределах памяти
+        if level == "critical":
+            plan = self.plan_size()
+            if plan["max"] > sample["max"]:
+                self.apply_size(plan)
+
+        return alerts
+
+    def collect_metrics(self) -> Dict[str, Any]:
+        """Сбор метрик conntrack в общий файл метрик KVM"""
+        sample = self.sample()
+        sample["alerts"] = self.check_usage(sample)
+        self._save_state()
+
+        sample["timestamp"] = datetime.now().isoformat()
+        try:
+            KVM_METRICS.parent.mkdir(parents=True, exist_ok=True)
+            with open(KVM_METRICS_LOCK, "w") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    metrics = json.loads(KVM_METRICS.read_text()) if KVM_METRICS.exists() else {}
+                except (OSError, ValueError):
+                    metrics = {}
+                metrics["conntrack"] = sample
+                # Атомарная замена: читатели не видят недописанный файл
+                tmp = KVM_METRICS.with_suffix(".conntrack.tmp")
+                tmp.write_text(json.dumps(metrics, indent=2))
+                tmp.replace(KVM_METRICS)
+        except OSError as e:
+            logger.warning(f"⚠️ Не удалось записать метрики: {e}")
+
+        return sample
+
+    def start_monitoring(self, interval: int = 10):
+        """Запуск мониторинга conntrack"""
+        self.running = True
+        self.monitor_thread = threading.Thread(target=self._monitor_loop, args=(interval,))
+        self.monitor_thread.daemon = True
+        self.monitor_thread.start()
+        logger.info("✅ Мониторинг conntrack запущен")
+
+    def _monitor_loop(self, interval: int):
+        """Цикл мониторинга"""
+        while self.running:
+            self.collect_metrics()
+            time.sleep(interval)
+
+
+# ============================================================================
+# ОПТИМИЗАЦИЯ ПОРЯДКА ПРАВИЛ
+# ============================================================================
+
+# Терминальные вердикты, порядок правил с одинаковым вердиктом не важен
+COMMUTABLE_VERDICTS = ["accept", "drop", "reject"]
+# Выражения без побочных эффектов
+PURE_EXPRESSIONS = ["match", "counter"]
+SET_SUGGESTION_MIN_RUN = 3
+
+
+class RuleOrderOptimizer:
+    """
+    Переупорядочивание правил цепочки по частоте срабатываний.
+    Переставляются только соседние правила без побочных эффектов
+    с одинаковым терминальным вердиктом.
+    """
+
+    def __init__(self, router: "KVMNFTablesRouter", family: str = "inet",
+                 table: str = "sentinel", chain: str = "forward"):
+        self.router = router
+        self.family = family
+        self.table = table
+        self.chain = chain
+        self.snapshot: List[Dict[str, Any]] = []
+        self.learned_order: List[str] = []
+
+    def list_rules(self) -> List[Dict[str, Any]]:
+        """Правила цепочки в JSON форме nftables"""
+        result = subprocess.run(
+            f"{self.router.nftables_bin} -j list chain {self.family} {self.table} {self.chain}",
+            shell=True, capture_output=True, text=True
+        )
+        if result.returncode != 0:
+            raise RuntimeError(f"Цепочка {self.chain} не найдена: {result.stderr}")
+        items = json.loads(result.stdout).get("nftables", [])
+        return [item["rule"] for item in items if "rule" in item]
+
+    def _counter(self, rule: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        for expr in rule.get("expr", []):
+            if "counter" in expr:
+                return expr["counter"] if isinstance(expr["counter"], dict) else {}
+        return None
+
+    def _verdict(self, rule: Dict[str, Any]) -> Optional[str]:
+        """Терминальный вердикт чистого правила или None (барьер)"""
+        verdict = None
+        for expr in rule.get("expr", []):
+            key = next(iter(expr))
+            if key in COMMUTABLE_VERDICTS:
+                verdict = key
+            elif key not in PURE_EXPRESSIONS:
+                return None
+        return verdict
+
+    def rule_key(self, rule: Dict[str, Any]) -> str:
+        """Выражения правила без счетчика: не зависят от handle и переживают перезагрузку"""
+        return json.dumps([e for e in rule.get("expr", []) if "counter" not in e], sort_keys=True)
+
+    def _signature(self, rules: List[Dict[str, Any]]) -> List[Tuple[int, str]]:
+        """Handle и выражения правил без значений счетчиков (для обнаружения изменений)"""
+        signature = []
+        for rule in rules:
+            expr = [{"counter": None} if "counter" in e else e for e in rule.get("expr", [])]
+            signature.append((rule["handle"], json.dumps(expr, sort_keys=True)))
+        return signature
+
+    def _apply_rules(self, rules: List[Dict[str, Any]], expected: List[Dict[str, Any]]) -> bool:
+        """
+        Атомарная замена правил цепочки одной транзакцией
+
+        Args:
+            rules: Новый порядок правил
+            expected: Правила, из которых он получен. Если цепочка с тех пор
+                      изменилась, замена не выполняется: повторное добавление
+                      вернуло бы устаревшие правила. Удаление идет по handle,
+                      поэтому удаление или замена правила после проверки тоже
+                      отменяет транзакцию целиком.
+        """
+        if self._signature(self.list_rules()) != self._signature(expected):
+            logger.warning(f"⚠️ Цепочка {self.chain} изменилась, перестановка отменена")
+            return False
+
+        commands: List[Dict[str, Any]] = [
+            {"delete": {"rule": {"family": self.family, "table": self.table,
+                                 "chain": self.chain, "handle": rule["handle"]}}}
+            for rule in expected
+        ]
+        for rule in rules:
+            rule = {k: v for k, v in rule.items() if k != "handle"}
+            commands.append({"add": {"rule": rule}})
+        return self.router._apply_json(commands)
+
+    def instrument(self, rules: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Добавление счетчиков в правила без них (перед вердиктом)"""
+        if all(self._counter(rule) is not None for rule in rules):
+            return rules
+
+        instrumented = []
+        for rule in rules:
+            rule = dict(rule)
+            if self._counter(rule) is None:
+                expr = list(rule.get("expr", []))
+                position = len(expr)
+                if expr and next(iter(expr[-1])) in COMMUTABLE_VERDICTS + ["jump", "goto", "return"]:
+                    position -= 1
+                expr.insert(position, {"counter": {"packets": 0, "bytes": 0}})
+                rule["expr"] = expr
+            instrumented.append(rule)
+
+        if not self._apply_rules(instrumented, rules):
+            raise RuntimeError(f"Не удалось добавить счетчики в {self.chain}")
+        logger.info(f"📊 Счетчики добавлены в цепочку {self.chain}")
+        return self.list_rules()
+
+    def collect_hits(self, window: int = 60) -> Tuple[List[Dict[str, Any]], Dict[int, int]]:
+        """Срабатывания каждого правила за окно (по handle); правила начала окна в self.snapshot"""
+        rules = self.instrument(self.list_rules())
+        self.snapshot = rules
+        before = {rule["handle"]: (self._counter(rule) or {}).get("packets", 0) for rule in rules}
+        time.sleep(window)
+        rules = self.list_rules()
+        hits = {
+            rule["handle"]: (self._counter(rule) or {}).get("packets", 0) - before.get(rule["handle"], 0)
+            for rule in rules
+        }
+        return rules, hits
+
+    def reorder(self, rules: List[Dict[str, Any]], hits: Dict[int, int]) -> List[Dict[str, Any]]:
+        """Сортировка сегментов коммутируемых правил по частоте срабатываний"""
+        ordered: List[Dict[str, Any]] = []
+        segment: List[Dict[str, Any]] = []
+        segment_verdict = None
+
+        def flush():
+            ordered.extend(sorted(segment, key=lambda r: -hits.get(r["handle"], 0)))
+            segment.clear()
+
+        for rule in rules:
+            verdict = self._verdict(rule)
+            if verdict is None or verdict != segment_verdict:
+                flush()
+                segment_verdict = verdict
+            if verdict is None:
+                ordered.append(rule)
+            else:
+                segment.append(rule)
+        flush()
+
+        return ordered
+
+    def evaluation_stats(self, rules: List[Dict[str, Any]], hits: Dict[int, int]) -> Dict[str, Any]:
+        """Среднее число вычисленных правил на совпавший пакет"""
+        total = sum(max(hits.get(rule["handle"], 0), 0) for rule in rules)
+        weighted = sum(position * max(hits.get(rule["handle"], 0), 0)
+                       for position, rule in enumerate(rules, 1))
+        return {
+            "rules": len(rules),
+            "matched_packets": total,
+            "mean_evaluations": round(weighted / total, 3) if total else 0.0
+        }
+
+    def suggest_sets(self, rules: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Поиск серий правил, отличающихся одним значением (кандидаты в набор)"""
+        suggestions = []
+
+        def shape(rule: Dict[str, Any]) -> Tuple[List[str], List[Any]]:
+            keys, values = [], []
+            for expr in rule.get("expr", []):
+                if "counter" in expr:
+                    continue
+                if "match" in expr and not isinstance(expr["match"]["right"], (dict, list)):
+                    match = expr["match"]
+                    keys.append(json.dumps({"match": {"left": match["left"], "op": match["op"]}},
+                                           sort_keys=True))
+                    values.append(match["right"])
+                else:
+                    keys.append(json.dumps(expr, sort_keys=True))
+                    values.append(None)
+            return keys, values
+
+        run: List[Tuple[Dict[str, Any], List[Any]]] = []
+        run_keys = None
+        diff_index = None
+
+        def close_run():
+            if len(run) >= SET_SUGGESTION_MIN_RUN and diff_index is not None:
+                key = json.loads(run_keys[diff_index])["match"]
+                suggestions.append({
+                    "chain": self.chain,
+                    "handles": [rule["handle"] for rule, _ in run],
+                    "match": key["left"],
+                    "op": key["op"],
+                    "values": [values[diff_index] for _, values in run]
+                })
+
+        for rule in rules:
+            keys, values = shape(rule)
+            if run and keys == run_keys:
+                diffs = [i for i, (a, b) in enumerate(zip(run[0][1], values)) if a != b]
+                if len(diffs) == 1 and (diff_index is None or diffs[0] == diff_index) \
+                        and run_keys[diffs[0]].startswith('{"match"'):
+                    diff_index = diffs[0]
+                    run.append((rule, values))
+                    continue
+            close_run()
+            run, run_keys, diff_index = [(rule, values)], keys, None
+        close_run()
+
+        return suggestions
+
+    def optimize(self, window: int = 60, apply: bool = True) -> Dict[str, Any]:
+        """Сбор счетчиков, переупорядочивание и атомарное применение"""
+        rules, hits = self.collect_hits(window)
+        optimized = self.reorder(rules, hits)
+        changed = [r["handle"] for r in optimized] != [r["handle"] for r in rules]
+
+        report = {
+            "chain": f"{self.family} {self.table} {self.chain}",
+            "window_sec": window,
+            "before": self.evaluation_stats(rules, hits),
+            "after": self.evaluation_stats(optimized, hits),
+            "changed": changed,
+            "applied": False,
+            "set_suggestions": self.suggest_sets(rules)
+        }
+
+        # Правила, добавленные или замененные за окно, не должны откатиться
+        if self._signature(rules) != self._signature(self.snapshot):
+            report["aborted"] = "цепочка изменилась за окно сбора"
+            logger.warning(f"⚠️ {self.chain}: цепочка изменилась за окно, перестановка отменена")
+            return report
+
+        if changed and apply:
+            report["applied"] = self._apply_rules(optimized, rules)
+            if report["applied"]:
+                self.learned_order = [self.rule_key(rule) for rule in optimized]
+                logger.info(f"✅ {self.chain}: среднее правил на пакет "
+                            f"{report['before']['mean_evaluations']} -> {report['after']['mean_evaluations']}")
+
+        return report
+
+    def restore(self, order: List[str]) -> bool:
+        """
+        Применение сохраненного порядка к пересобранной цепочке.
+        Переставляются только сегменты коммутируемых правил (как в reorder);
+        правила, которых не было при обучении, остаются в конце своего сегмента.
+        """
+        rules = self.list_rules()
+        rank = {key: position for position, key in enumerate(order)}
+        hits = {rule["handle"]: -rank.get(self.rule_key(rule), len(order)) for rule in rules}
+        ordered = self.reorder(rules, hits)
+        if [r["handle"] for r in ordered] == [r["handle"] for r in rules]:
+            return True
+        applied = self._apply_rules(ordered, rules)
+        if applied:
+            logger.info(f"✅ {self.chain}: восстановлен выученный порядок правил")
+        return applied
+
+
 # ============================================================================
 # ТЕСТОВЫЙ МОДУЛЬ
 # ============================================================================
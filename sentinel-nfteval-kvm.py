@@ -0,0 +1,700 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+SENTINEL OS KVM - Offline nftables Evaluator
+============================================
+Оценка стоимости набора правил на пакет без root и ядра.
+Загружает ruleset в JSON форме (nft -j list ruleset / export_ruleset_json)
+и прогоняет синтетический или извлеченный из pcap набор пакетов.
+"""
+
+import sys
+import json
+import random
+import shutil
+import struct
+import bisect
+import logging
+import tempfile
+import ipaddress
+import subprocess
+from pathlib import Path
+from typing import Dict, Any, List, Optional, Tuple, Iterator, Callable
+
+# Настройка логирования
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger("sentinel-nfteval-kvm")
+
+# Пути пакета через хуки
+HOOK_PATHS = {
+    "input": ["ingress", "prerouting", "input"],
+    "forward": ["ingress", "prerouting", "forward", "postrouting"],
+    "output": ["output", "postrouting"]
+}
+
+# Семейства таблиц, которые видят пакет данного семейства
+TABLE_FAMILIES = {
+    "ip": ["ip", "inet"],
+    "ip6": ["ip6", "inet"]
+}
+
+L4_PROTOCOLS = {"icmp": 1, "tcp": 6, "udp": 17, "ipv6-icmp": 58, "icmpv6": 58}
+TCP_FLAGS = {"fin": 0x01, "syn": 0x02, "rst": 0x04, "psh": 0x08,
+             "ack": 0x10, "urg": 0x20, "ecn": 0x40, "cwr": 0x80}
+CHAIN_PRIORITIES = {"raw": -300, "mangle": -150, "dstnat": -100,
+                    "filter": 0, "security": 50, "srcnat": 100}
+TERMINAL_VERDICTS = ["accept", "drop", "reject", "queue"]
+CT_TUPLE_FIELDS = {"saddr": "saddr", "daddr": "daddr", "proto-src": "sport", "proto-dst": "dport"}
+MAX_JUMP_DEPTH = 16
+
+# ruleset.nft, его JSON форма и пакеты с ожидаемыми вердиктами
+FIXTURE_DIR = Path(__file__).resolve().parent / "fixtures" / "nfteval"
+
+
+class NFTSet:
+    """Набор nftables с поиском по интервалам"""
+
+    def __init__(self, spec: Dict[str, Any]):
+        self.name = spec["name"]
+        self.type = spec.get("type")
+        self.values = set()
+        self.starts: List[int] = []
+        self.ends: List[int] = []
+
+        intervals = []
+        for elem in spec.get("elem", []):
+            if isinstance(elem, dict) and "elem" in elem:
+                elem = elem["elem"]["val"]
+            low, high = _value_range(elem)
+            if low is None:
+                self.values.add(_normalize_scalar(elem))
+            else:
+                intervals.append((low, high))
+
+        for low, high in sorted(intervals):
+            self.starts.append(low)
+            self.ends.append(high)
+
+    def __len__(self) -> int:
+        return len(self.values) + len(self.starts)
+
+    def contains(self, value: Any) -> bool:
+        if value in self.values:
+            return True
+        if isinstance(value, int) and self.starts:
+            index = bisect.bisect_right(self.starts, value) - 1
+            return index >= 0 and value <= self.ends[index]
+        return False
+
+
+def _normalize_scalar(value: Any) -> Any:
+    """Приведение значения к сравнимой форме (адреса -> int)"""
+    if isinstance(value, str):
+        try:
+            return int(ipaddress.ip_address(value))
+        except ValueError:
+            return L4_PROTOCOLS.get(value, value)
+    return value
+
+
+def _value_range(value: Any) -> Tuple[Optional[int], Optional[int]]:
+    """Интервал для prefix/range значений, иначе (None, None)"""
+    if isinstance(value, dict) and "prefix" in value:
+        network = ipaddress.ip_network(f"{value['prefix']['addr']}/{value['prefix']['len']}", strict=False)
+        return int(network.network_address), int(network.broadcast_address)
+    if isinstance(value, dict) and "range" in value:
+        low, high = value["range"]
+        return _normalize_scalar(low), _normalize_scalar(high)
+    if isinstance(value, str) and "/" in value:
+        try:
+            network = ipaddress.ip_network(value, strict=False)
+            return int(network.network_address), int(network.broadcast_address)
+        except ValueError:
+            pass
+    return None, None
+
+
+class RulesetEvaluator:
+    """
+    Интерпретатор подмножества nftables JSON для оценки стоимости.
+    Каждое посещенное правило считается одним вычислением.
+    """
+
+    def __init__(self, ruleset: Dict[str, Any]):
+        self.chains: Dict[Tuple[str, str, str], Dict[str, Any]] = {}
+        self.sets: Dict[Tuple[str, str, str], NFTSet] = {}
+        self.hooks: Dict[str, List[Dict[str, Any]]] = {}
+        self._load(ruleset)
+
+    @classmethod
+    def from_file(cls, path: str) -> "RulesetEvaluator":
+        with open(path, 'r') as f:
+            return cls(json.load(f))
+
+    def _load(self, ruleset: Dict[str, Any]):
+        """Разбор nft -j вывода: цепочки, правила, наборы"""
+        for item in ruleset.get("nftables", []):
+            if "chain" in item:
+                spec = item["chain"]
+                key = (spec["family"], spec["table"], spec["name"])
+                self.chains[key] = {"spec": spec, "rules": []}
+                if "hook" in spec:
+                    priority = spec.get("prio", 0)
+                    if isinstance(priority, str):
+                        priority = CHAIN_PRIORITIES.get(priority, 0)
+                    self.hooks.setdefault(spec["hook"], []).append({
+                        "key": key,
+                        "family": spec["family"],
+                        "priority": priority,
+                        "policy": spec.get("policy", "accept"),
+                        "devices": [spec["dev"]] if isinstance(spec.get("dev"), str) else spec.get("dev", [])
+                    })
+            elif "rule" in item:
+                spec = item["rule"]
+                key = (spec["family"], spec["table"], spec["chain"])
+                self.chains.setdefault(key, {"spec": {}, "rules": []})["rules"].append(spec)
+            elif "set" in item:
+                spec = item["set"]
+                self.sets[(spec["family"], spec["table"], spec["name"])] = NFTSet(spec)
+
+        for chains in self.hooks.values():
+            chains.sort(key=lambda c: c["priority"])
+
+    # ------------------------------------------------------------------
+    # Вычисление выражений
+    # ------------------------------------------------------------------
+
+    def _field(self, expr: Any, pkt: Dict[str, Any]) -> Any:
+        """Значение левой части выражения для пакета"""
+        if isinstance(expr, str) and expr in TCP_FLAGS:
+            return TCP_FLAGS[expr]
+        if not isinstance(expr, dict):
+            return _normalize_scalar(expr)
+
+        if "payload" in expr:
+            payload = expr["payload"]
+            protocol, field = payload.get("protocol"), payload.get("field")
+            if protocol in ("ip", "ip6"):
+                if pkt["family"] != protocol:
+                    return None
+                if field in ("saddr", "daddr"):
+                    return _normalize_scalar(pkt.get(field))
+                if field in ("protocol", "nexthdr"):
+                    return L4_PROTOCOLS.get(pkt.get("l4proto"))
+                return pkt.get(field.replace("-", "_"))
+            if protocol in ("tcp", "udp", "th"):
+                if protocol != "th" and pkt.get("l4proto") != protocol:
+                    return None
+                if field == "flags":
+                    return pkt.get("tcp_flags", 0)
+                return pkt.get(field)
+            if protocol in ("icmp", "icmpv6"):
+                return pkt.get("icmp_type") if pkt.get("l4proto") in ("icmp", "ipv6-icmp") else None
+            return None
+
+        if "meta" in expr:
+            key = expr["meta"]["key"]
+            if key == "l4proto":
+                return L4_PROTOCOLS.get(pkt.get("l4proto"))
+            if key in ("nfproto", "protocol"):
+                return {"ip": "ipv4", "ip6": "ipv6"}[pkt["family"]]
+            if key in ("iif", "iifname"):
+                return pkt.get("iifname")
+            if key in ("oif", "oifname"):
+                return pkt.get("oifname")
+            if key == "mark":
+                return pkt.get("mark", 0)
+            if key == "length":
+                return pkt.get("length", 0)
+            return pkt.get(key)
+
+        if "ct" in expr:
+            key = expr["ct"]["key"]
+            if expr["ct"].get("dir") and key in CT_TUPLE_FIELDS:
+                # Кортеж направления потока: исходное - первый пакет потока
+                original = pkt.get("ct_original") or pkt
+                if expr["ct"]["dir"] == "reply":
+                    original = {"saddr": original.get("daddr"), "daddr": original.get("saddr"),
+                                "sport": original.get("dport"), "dport": original.get("sport")}
+                value = original.get(CT_TUPLE_FIELDS[key])
+                return _normalize_scalar(value) if key in ("saddr", "daddr") else value
+            if key == "state":
+                return pkt.get("ct_state", "new")
+            if key == "mark":
+                return pkt.get("ct_mark", 0)
+            return pkt.get(f"ct_{key}")
+
+        for op in ("&", "|", "^"):
+            if op in expr:
+                values = [self._field(v, pkt) for v in expr[op]]
+                if not all(isinstance(v, int) for v in values):
+                    return None
+                result = values[0]
+                for value in values[1:]:
+                    result = {"&": result & value, "|": result | value, "^": result ^ value}[op]
+                return result
+
+        return None
+
+    def _right(self, value: Any, table: Tuple[str, str]) -> Any:
+        """Правая часть: скаляр, флаги, набор или интервал"""
+        if isinstance(value, str) and value.startswith("@"):
+            return self.sets.get((table[0], table[1], value[1:]))
+        if isinstance(value, dict) and "set" in value:
+            return NFTSet({"name": "anon", "elem": value["set"]})
+        if isinstance(value, list):
+            return NFTSet({"name": "anon", "elem": value})
+        if isinstance(value, dict) and "|" in value:
+            flags = 0
+            for flag in value["|"]:
+                flags |= TCP_FLAGS.get(flag, flag if isinstance(flag, int) else 0)
+            return flags
+        if isinstance(value, str) and value in TCP_FLAGS:
+            return TCP_FLAGS[value]
+        return value
+
+    def _match(self, match: Dict[str, Any], pkt: Dict[str, Any], table: Tuple[str, str]) -> bool:
+        left = self._field(match["left"], pkt)
+        if left is None:
+            return False
+
+        op = match.get("op", "==")
+        right = self._right(match["right"], table)
+
+        if isinstance(right, NFTSet):
+            values = left if isinstance(left, (list, set)) else [left]
+            found = any(right.contains(v) for v in values)
+            return not found if op == "!=" else found
+
+        low, high = _value_range(right)
+        if low is not None:
+            inside = isinstance(left, int) and low <= left <= high
+            return not inside if op == "!=" else inside
+
+        right = _normalize_scalar(right)
+        if op in ("==", "in"):
+            return left == right
+        if op == "!=":
+            return left != right
+        try:
+            return {"<": left < right, ">": left > right,
+                    "<=": left <= right, ">=": left >= right}[op]
+        except (KeyError, TypeError):
+            return False
+
+    def _mangle(self, mangle: Dict[str, Any], pkt: Dict[str, Any]):
+        """meta mark set / ct mark set"""
+        key = mangle["key"]
+        value = self._field(mangle["value"], pkt)
+        if "meta" in key and key["meta"]["key"] == "mark":
+            pkt["mark"] = value or 0
+        elif "ct" in key and key["ct"]["key"] == "mark" and pkt.get("ct_state") != "untracked":
+            pkt["ct_mark"] = value or 0
+
+    # ------------------------------------------------------------------
+    # Обход цепочек
+    # ------------------------------------------------------------------
+
+    def _run_chain(self, key: Tuple[str, str, str], pkt: Dict[str, Any],
+                   trace: Dict[str, Any], depth: int = 0) -> Optional[str]:
+        """Вердикт цепочки или None (продолжение / return)"""
+        if depth > MAX_JUMP_DEPTH or key not in self.chains:
+            return None
+
+        table = (key[0], key[1])
+        for rule in self.chains[key]["rules"]:
+            trace["evaluations"] += 1
+            matched = True
+
+            for expr in rule.get("expr", []):
+                name = next(iter(expr))
+                body = expr[name]
+
+                if name == "match":
+                    if not self._match(body, pkt, table):
+                        matched = False
+                        break
+                elif name == "mangle":
+                    self._mangle(body, pkt)
+                elif name == "notrack":
+                    pkt["ct_state"] = "untracked"
+                elif name in ("limit", "set", "meter"):
+                    # Срабатывание лимитов зависит от времени: считаем, что лимит не превышен
+                    if not _under_limit(name, body):
+                        matched = False
+                        break
+                elif name in TERMINAL_VERDICTS:
+                    trace["hit"] = f"{key[0]} {key[1]} {key[2]} #{rule.get('handle', '?')}"
+                    return name
+                elif name == "return":
+                    return None
+                elif name in ("jump", "goto"):
+                    target = (key[0], key[1], body["target"])
+                    verdict = self._run_chain(target, pkt, trace, depth + 1)
+                    if verdict or name == "goto":
+                        return verdict
+
+            if not matched:
+                continue
+
+        return None
+
+    def evaluate(self, pkt: Dict[str, Any]) -> Dict[str, Any]:
+        """Прогон пакета через все базовые цепочки по его пути"""
+        pkt = dict(pkt)
+        trace = {"evaluations": 0, "base_chains": 0, "hit": None, "verdict": "accept"}
+
+        for hook in HOOK_PATHS[pkt.get("direction", "input")]:
+            for chain in self.hooks.get(hook, []):
+                if hook == "ingress":
+                    if chain["family"] != "netdev" or pkt.get("iifname") not in chain["devices"]:
+                        continue
+                elif chain["family"] not in TABLE_FAMILIES[pkt["family"]]:
+                    continue
+
+                trace["base_chains"] += 1
+                verdict = self._run_chain(chain["key"], pkt, trace)
+                if verdict is None:
+                    verdict = chain["policy"]
+                    if verdict != "accept":
+                        trace["hit"] = f"{' '.join(chain['key'])} policy"
+
+                if verdict != "accept":
+                    trace["verdict"] = verdict
+                    return trace
+
+        trace["ct_mark"] = pkt.get("ct_mark", 0)
+        return trace
+
+    def replay(self, packets: Iterator[Dict[str, Any]],
+               on_trace: Optional[Callable[[Dict[str, Any], Dict[str, Any]], None]] = None) -> Dict[str, Any]:
+        """
+        Прогон набора пакетов и сводная статистика
+
+        Args:
+            packets: Пакеты в порядке прихода (ct mark переносится по потокам)
+            on_trace: Вызывается для каждого пакета с (пакет, trace)
+        """
+        evaluations: List[int] = []
+        base_chains = 0
+        hits: Dict[str, int] = {}
+        verdicts: Dict[str, int] = {}
+
+        # ct mark и кортеж исходного направления хранятся по потоку, как в conntrack
+        flows: Dict[Tuple, int] = {}
+        originals: Dict[Tuple, Dict[str, Any]] = {}
+
+        for pkt in packets:
+            flow = _flow_key(pkt)
+            original = originals.setdefault(flow, {k: pkt.get(k) for k in ("saddr", "daddr", "sport", "dport")})
+            pkt = dict(pkt, ct_original=original)
+            if flow in flows:
+                pkt["ct_mark"] = flows[flow]
+            trace = self.evaluate(pkt)
+            if pkt.get("ct_state") != "untracked" and "ct_mark" in trace:
+                flows[flow] = trace["ct_mark"]
+            if on_trace:
+                on_trace(pkt, trace)
+            evaluations.append(trace["evaluations"])
+            base_chains += trace["base_chains"]
+            hit = trace["hit"] or "no terminal rule"
+            hits[hit] = hits.get(hit, 0) + 1
+            verdicts[trace["verdict"]] = verdicts.get(trace["verdict"], 0) + 1
+
+        count = len(evaluations)
+        ordered = sorted(evaluations)
+
+        def percentile(p: float) -> int:
+            return ordered[min(count - 1, int(p * count))] if count else 0
+
+        return {
+            "packets": count,
+            "mean_evaluations": round(sum(evaluations) / count, 3) if count else 0.0,
+            "p50_evaluations": percentile(0.50),
+            "p99_evaluations": percentile(0.99),
+            "max_evaluations": ordered[-1] if count else 0,
+            "mean_base_chains": round(base_chains / count, 3) if count else 0.0,
+            "verdicts": verdicts,
+            "hits": dict(sorted(hits.items(), key=lambda item: -item[1])),
+            "sets": {f"{k[1]}.{k[2]}": len(v) for k, v in self.sets.items()}
+        }
+
+
+def _under_limit(name: str, body: Dict[str, Any]) -> bool:
+    """
+    Совпадение limit/set/meter при непревышенном лимите.
+    "limit rate N" совпадает, пока поток укладывается в лимит,
+    "limit rate over N" (inv) - только при превышении.
+    """
+    if name == "limit":
+        return not body.get("inv", False)
+    stmts = body.get("stmt", [])
+    if isinstance(stmts, dict):
+        stmts = [stmts]
+    return all(not stmt["limit"].get("inv", False) for stmt in stmts if "limit" in stmt)
+
+
+def _flow_key(pkt: Dict[str, Any]) -> Tuple:
+    """Ключ потока, одинаковый для обоих направлений"""
+    ends = sorted([(pkt.get("saddr"), pkt.get("sport")), (pkt.get("daddr"), pkt.get("dport"))],
+                  key=str)
+    return (pkt.get("family"), pkt.get("l4proto"), *ends)
+
+
+# ============================================================================
+# ИСТОЧНИКИ ПАКЕТОВ
+# ============================================================================
+
+def synthetic_packets(count: int, seed: int = 1, flows: int = 1000) -> Iterator[Dict[str, Any]]:
+    """Синтетическая смесь: HTTPS, DNS, VPN транспорт, торренты, сканы"""
+    rng = random.Random(seed)
+    profiles = [
+        (40, lambda: {"direction": "output", "l4proto": "tcp", "dport": 443,
+                      "sport": rng.randint(32768, 60999), "ct_state": "established"}),
+        (25, lambda: {"direction": "input", "l4proto": "tcp", "sport": 443,
+                      "dport": rng.randint(32768, 60999), "ct_state": "established", "tcp_flags": 0x10}),
+        (10, lambda: {"direction": "output", "l4proto": "udp", "dport": 53,
+                      "daddr": "127.0.0.1", "oifname": "lo", "ct_state": "new"}),
+        (10, lambda: {"direction": "output", "l4proto": "udp", "dport": 51820,
+                      "sport": 51820, "ct_state": "established"}),
+        (8, lambda: {"direction": "forward", "l4proto": rng.choice(["tcp", "udp"]),
+                     "dport": rng.randint(6881, 6889), "ct_state": "established",
+                     "oifname": "wg0"}),
+        (5, lambda: {"direction": "input", "l4proto": "tcp", "dport": rng.randint(1, 1024),
+                     "ct_state": "new", "tcp_flags": TCP_FLAGS["syn"]}),
+        (2, lambda: {"direction": "input", "l4proto": "icmp", "icmp_type": "echo-request",
+                     "ct_state": "new"})
+    ]
+    weights = [w for w, _ in profiles]
+
+    # Пакеты распределяются по ограниченному числу потоков
+    pool = []
+    for _ in range(max(flows, 1)):
+        pkt = rng.choices(profiles, weights)[0][1]()
+        pkt.setdefault("family", "ip")
+        pkt.setdefault("saddr", str(ipaddress.IPv4Address(rng.randint(0x01000000, 0xDFFFFFFF))))
+        pkt.setdefault("daddr", str(ipaddress.IPv4Address(rng.randint(0x01000000, 0xDFFFFFFF))))
+        pkt.setdefault("iifname", "eth0" if pkt["direction"] != "output" else "")
+        pkt.setdefault("oifname", "eth0" if pkt["direction"] != "input" else "")
+        pool.append(pkt)
+
+    for _ in range(count):
+        pkt = dict(rng.choice(pool))
+        pkt["length"] = rng.choice([60, 576, 1400])
+        yield pkt
+
+
+def pcap_packets(path: str, direction: str = "input", local_addrs: List[str] = None) -> Iterator[Dict[str, Any]]:
+    """
+    Пакеты из pcap (классический формат, Ethernet / raw IP / Linux SLL).
+    Если заданы local_addrs, направление определяется по адресам.
+    """
+    local = {str(ipaddress.ip_address(a)) for a in local_addrs or []}
+
+    with open(path, 'rb') as f:
+        header = f.read(24)
+        if len(header) < 24:
+            return
+        magic = struct.unpack("<I", header[:4])[0]
+        if magic in (0xa1b2c3d4, 0xa1b23c4d):
+            endian = "<"
+        elif magic in (0xd4c3b2a1, 0x4d3cb2a1):
+            endian = ">"
+        else:
+            raise ValueError("Неподдерживаемый формат pcap (нужен классический pcap)")
+        linktype = struct.unpack(endian + "I", header[20:24])[0]
+
+        while True:
+            record = f.read(16)
+            if len(record) < 16:
+                break
+            incl_len, orig_len = struct.unpack(endian + "II", record[8:16])
+            frame = f.read(incl_len)
+            if len(frame) < incl_len:
+                # Файл оборван на середине записи
+                break
+
+            try:
+                if linktype == 1:          # Ethernet
+                    ethertype, offset = struct.unpack("!H", frame[12:14])[0], 14
+                    if ethertype == 0x8100:
+                        ethertype, offset = struct.unpack("!H", frame[16:18])[0], 18
+                elif linktype == 113:      # Linux cooked
+                    ethertype, offset = struct.unpack("!H", frame[14:16])[0], 16
+                elif linktype in (12, 101):  # Raw IP
+                    ethertype = 0x0800 if frame and frame[0] >> 4 == 4 else 0x86dd
+                    offset = 0
+                else:
+                    raise ValueError(f"Неподдерживаемый linktype: {linktype}")
+
+                pkt = _parse_ip(frame[offset:], ethertype)
+            except struct.error:
+                # Кадр обрезан snaplen короче заголовков: пропускаем
+                continue
+            if pkt is None:
+                continue
+            pkt["length"] = orig_len - offset
+            if local:
+                if pkt["saddr"] in local:
+                    pkt["direction"] = "output"
+                elif pkt["daddr"] in local:
+                    pkt["direction"] = "input"
+                else:
+                    pkt["direction"] = "forward"
+            else:
+                pkt["direction"] = direction
+            pkt.setdefault("ct_state", "established" if pkt.get("tcp_flags", 0x10) & 0x10 else "new")
+            yield pkt
+
+
+def _parse_ip(data: bytes, ethertype: int) -> Optional[Dict[str, Any]]:
+    """Разбор IPv4/IPv6 и заголовка TCP/UDP"""
+    if ethertype == 0x0800 and len(data) >= 20:
+        ihl = (data[0] & 0x0f) * 4
+        proto = data[9]
+        pkt = {"family": "ip", "ttl": data[8],
+               "saddr": str(ipaddress.IPv4Address(data[12:16])),
+               "daddr": str(ipaddress.IPv4Address(data[16:20]))}
+        l4 = data[ihl:]
+    elif ethertype == 0x86dd and len(data) >= 40:
+        proto = data[6]
+        pkt = {"family": "ip6", "hoplimit": data[7],
+               "saddr": str(ipaddress.IPv6Address(data[8:24])),
+               "daddr": str(ipaddress.IPv6Address(data[24:40]))}
+        l4 = data[40:]
+    else:
+        return None
+
+    names = {v: k for k, v in L4_PROTOCOLS.items() if k != "icmpv6"}
+    pkt["l4proto"] = names.get(proto, proto)
+    if proto in (6, 17) and len(l4) >= 4:
+        pkt["sport"], pkt["dport"] = struct.unpack("!HH", l4[:4])
+        if proto == 6 and len(l4) >= 14:
+            pkt["tcp_flags"] = l4[13]
+    return pkt
+
+
+# ============================================================================
+# ТЕСТИРОВАНИЕ
+# ============================================================================
+
+def _export_fixture(nft_path: Path) -> Optional[Dict[str, Any]]:
+    """JSON фикстуры от настоящего nft в отдельном namespace (если nft доступен)"""
+    if not shutil.which("nft") or not shutil.which("unshare"):
+        return None
+    result = subprocess.run(
+        ["unshare", "--user", "--map-root-user", "--net",
+         "sh", "-c", 'nft -f "$0" && nft -j list ruleset', str(nft_path)],
+        capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        logger.warning(f"⚠️ nft не загрузил {nft_path.name}: {result.stderr.strip()}")
+        return None
+    return json.loads(result.stdout)
+
+
+def _truncated_pcap() -> bytes:
+    """pcap из целого UDP кадра, кадра короче Ethernet заголовка и оборванной записи"""
+    ip = bytes([0x45, 0, 0, 28, 0, 0, 0, 0, 64, 17, 0, 0,
+                192, 0, 2, 1, 10, 0, 0, 2]) + struct.pack("!HHHH", 53000, 53, 8, 0)
+    frame = b"\x00" * 12 + struct.pack("!H", 0x0800) + ip
+    data = struct.pack("<IHHiIII", 0xa1b2c3d4, 2, 4, 0, 0, 65535, 1)
+    data += struct.pack("<IIII", 0, 0, len(frame), len(frame)) + frame
+    data += struct.pack("<IIII", 0, 0, 10, len(frame)) + frame[:10]
+    data += struct.pack("<IIII", 0, 0, len(frame), len(frame)) + frame[:20]
+    return data
+
+
+def test_nfteval(fixture_dir: Path = FIXTURE_DIR) -> bool:
+    """Проверка вердиктов, хитов и ct mark на фикстуре и разбора обрезанного pcap"""
+    cases = json.loads((fixture_dir / "packets.json").read_text())
+    rulesets = {"ruleset.json": json.loads((fixture_dir / "ruleset.json").read_text())}
+    exported = _export_fixture(fixture_dir / "ruleset.nft")
+    if exported is not None:
+        rulesets["nft -j"] = exported
+    else:
+        logger.info("ℹ️ nft недоступен: проверяется только ruleset.json")
+
+    failures = 0
+    for source, ruleset in rulesets.items():
+        traces: List[Dict[str, Any]] = []
+        RulesetEvaluator(ruleset).replay((case["packet"] for case in cases),
+                                         lambda pkt, trace: traces.append(trace))
+        for case, trace in zip(cases, traces):
+            for key, expected in case["expect"].items():
+                if trace.get(key) != expected:
+                    failures += 1
+                    print(f"❌ {source} {case['name']}: {key} = {trace.get(key)}, ожидалось {expected}")
+
+    with tempfile.NamedTemporaryFile(suffix=".pcap") as f:
+        f.write(_truncated_pcap())
+        f.flush()
+        parsed = list(pcap_packets(f.name))
+    if len(parsed) != 1 or parsed[0].get("dport") != 53:
+        failures += 1
+        print(f"❌ pcap: разобрано {len(parsed)} пакетов, ожидался 1")
+
+    checks = len(rulesets) * sum(len(case["expect"]) for case in cases) + 1
+    print(f"{'✅' if not failures else '❌'} nfteval: {checks - failures}/{checks} проверок")
+    return failures == 0
+
+
+# ============================================================================
+# CLI
+# ============================================================================
+
+def main():
+    """Точка входа"""
+    import argparse
+
+    parser = argparse.ArgumentParser(description="SENTINEL OS KVM - оценка стоимости nftables ruleset")
+    parser.add_argument('ruleset', nargs='?', help='Ruleset в JSON (nft -j list ruleset)')
+    parser.add_argument('--synthetic', type=int, default=10000, help='Количество синтетических пакетов')
+    parser.add_argument('--seed', type=int, default=1, help='Seed генератора')
+    parser.add_argument('--flows', type=int, default=1000, help='Количество синтетических потоков')
+    parser.add_argument('--pcap', help='Пакеты из pcap вместо синтетики')
+    parser.add_argument('--direction', choices=list(HOOK_PATHS), default='input', help='Направление pcap пакетов')
+    parser.add_argument('--local', action='append', default=[], help='Локальный адрес (для направления pcap)')
+    parser.add_argument('--per-packet', action='store_true', help='Вывод правила для каждого пакета')
+    parser.add_argument('--max-mean', type=float, help='Бюджет среднего числа вычислений (CI)')
+    parser.add_argument('--max-p99', type=float, help='Бюджет p99 вычислений (CI)')
+    parser.add_argument('--test', action='store_true', help='Проверка на фикстуре fixtures/nfteval')
+
+    args = parser.parse_args()
+
+    if args.test:
+        sys.exit(0 if test_nfteval() else 1)
+    if not args.ruleset:
+        parser.error("нужен ruleset (или --test)")
+
+    evaluator = RulesetEvaluator.from_file(args.ruleset)
+    if args.pcap:
+        packets = pcap_packets(args.pcap, args.direction, args.local)
+    else:
+        packets = synthetic_packets(args.synthetic, args.seed, args.flows)
+
+    on_trace = None
+    if args.per_packet:
+        # Тот же проход, что и отчет: ct mark переносится по потокам
+        def on_trace(pkt: Dict[str, Any], trace: Dict[str, Any]):
+            print(json.dumps({"packet": pkt, **trace}, default=str))
+
+    report = evaluator.replay(packets, on_trace)
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+
+    failed = False
+    if args.max_mean is not None and report["mean_evaluations"] > args.max_mean:
+        logger.error(f"❌ Среднее {report['mean_evaluations']} > бюджета {args.max_mean}")
+        failed = True
+    if args.max_p99 is not None and report["p99_evaluations"] > args.max_p99:
+        logger.error(f"❌ p99 {report['p99_evaluations']} > бюджета {args.max_p99}")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -7,16 +7,299 @@ SENTINEL OS KVM - Парсер ключей и конфигураций
 Модуль парсинга с поддержкой KVM-оптимизаций и проверкой ресурсов
 """
 
+import os
 import re
+import sys
 import json
 import base64
+import itertools
+import threading
 import urllib.parse
-import ipaddress
-import socket
-from typing import Dict, Any, List, Optional, Tuple
+from collections import deque, OrderedDict
+from typing import Dict, Any, List, Optional, Tuple, Callable, Iterable, Iterator, Union
 from datetime import datetime
 import hashlib
-import binascii
+
+# Обработчики протоколов: имя метода разрешается при первом использовании
+PROTOCOL_HANDLERS = {
+    "wireguard": "_parse_wireguard",
+    "amneziawg": "_parse_amneziawg",
+    "openvpn": "_parse_openvpn",
+    "xray": "_parse_xray",
+    "shadowsocks": "_parse_shadowsocks",
+    "trojan": "_parse_trojan",
+    "sing-box": "_parse_singbox",
+    "hysteria2": "_parse_hysteria2",
+    "tor": "_parse_tor",
+    "zapret": "_parse_dpi_bypass",
+    "byedpi": "_parse_dpi_bypass",
+    "goodbyedpi": "_parse_dpi_bypass"
+}
+DPI_PROTOCOLS = ("zapret", "byedpi", "goodbyedpi")
+
+# Пакетный разбор: пул процессов включается с POOL_THRESHOLD ключей,
+# ключи отправляются воркерам порциями по PARSE_CHUNK
+POOL_THRESHOLD = 2000
+PARSE_CHUNK = 256
+
+# Автоопределение по схеме URL: одна операция вместо цепочки startswith
+SCHEME_PROTOCOLS = {
+    "ss": "shadowsocks",
+    "trojan": "trojan",
+    "vless": "xray",
+    "vmess": "xray",
+    "wg": "wireguard",
+    "wireguard": "wireguard",
+    "amnezia": "amneziawg",
+    "hysteria": "hysteria2",
+    "hy2": "hysteria2"
+}
+
+# Версия формата результата: входит в ключ кэша, повышать при любом изменении разбора
+PARSER_VERSION = "2.1"
+
+# Кэш разборов: LRU в памяти и необязательный уровень на tmpfs
+PARSE_CACHE_SIZE = 4096
+PARSE_CACHE_DIR = "/var/run/sentinel/parse-cache"
+PARSE_CACHE_DISK_ENTRIES = 20000
+
+_UNSET = object()
+
+
+class ParseContext:
+    """
+    Ввод парсера, декодированный не более одного раза.
+    
+    Автоопределение и парсер протокола берут из контекста уже разобранные
+    JSON, URL (urlparse + parse_qs) и секции INI вместо повторного разбора
+    строки. Промежуточные формы вычисляются при первом обращении.
+    """
+    
+    __slots__ = ("data", "scheme", "_lower", "_json", "json_error", "_url", "_query", "_ini")
+    
+    def __init__(self, data: str):
+        self.data = data.strip()
+        scheme, sep, _ = self.data[:16].partition("://")
+        self.scheme = scheme.lower() if sep and scheme.isalnum() else None
+        self._lower = None
+        self._json = _UNSET
+        self.json_error: Optional[str] = None
+        self._url = None
+        self._query = None
+        self._ini = None
+    
+    @classmethod
+    def of(cls, data: Union[str, "ParseContext"]) -> "ParseContext":
+        """Контекст из строки (парсеры вызываются и напрямую со строкой)"""
+        return data if isinstance(data, ParseContext) else cls(data)
+    
+    @property
+    def lower(self) -> str:
+        if self._lower is None:
+            self._lower = self.data.lower()
+        return self._lower
+    
+    @property
+    def json(self) -> Optional[Any]:
+        """JSON-объект (None, если ввод не JSON)"""
+        if self._json is _UNSET:
+            self._json = None
+            if self.data.startswith("{"):
+                try:
+                    self._json = json.loads(self.data)
+                except ValueError as e:
+                    self.json_error = str(e)
+            else:
+                self.json_error = "Not a JSON object"
+        return self._json
+    
+    @property
+    def url(self) -> urllib.parse.ParseResult:
+        if self._url is None:
+            self._url = urllib.parse.urlparse(self.data)
+        return self._url
+    
+    @property
+    def query(self) -> Dict[str, List[str]]:
+        if self._query is None:
+            self._query = urllib.parse.parse_qs(self.url.query)
+        return self._query
+    
+    @property
+    def ini(self) -> List[Tuple[Optional[str], List[Tuple[str, str]]]]:
+        """Секции INI по порядку: [(имя, [(ключ, значение), ...]), ...]"""
+        if self._ini is None:
+            self._ini = [(None, [])]
+            for line in self.data.split('\n'):
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                if line.startswith('[') and line.endswith(']'):
+                    self._ini.append((line[1:-1], []))
+                elif '=' in line:
+                    key, value = line.split('=', 1)
+                    self._ini[-1][1].append((key.strip(), value.strip()))
+        return self._ini
+
+
+class ParseCache:
+    """
+    Кэш результатов parse() по ключу (протокол, SHA-256 данных, версия парсера).
+    
+    В памяти - LRU на OrderedDict с ограничением числа записей; результат
+    хранится сериализованным, поэтому каждое попадание возвращает независимую
+    копию. Необязательный дисковый уровень (disk_dir) переживает перезапуск
+    процесса: каждый вызов CLI из LuCI - новый процесс.
+    """
+    
+    def __init__(self, max_entries: int = PARSE_CACHE_SIZE, disk_dir: Optional[str] = None,
+                 disk_entries: int = PARSE_CACHE_DISK_ENTRIES, salt: str = ""):
+        self.max_entries = max(int(max_entries), 1)
+        self.disk_dir = os.path.join(disk_dir, PARSER_VERSION) if disk_dir else None
+        self.disk_entries = int(disk_entries)
+        self.salt = salt
+        self._entries: "OrderedDict[Tuple[str, str, str], str]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk_count = None
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    def key(self, protocol: str, data: str) -> Tuple[str, str, str]:
+        """Ключ записи; salt отделяет парсеры с разными kvm_resources"""
+        digest = hashlib.sha256(data.encode("utf-8", "surrogatepass")).hexdigest()
+        return (protocol or "auto", digest, PARSER_VERSION + self.salt)
+    
+    def get(self, key: Tuple[str, str, str]) -> Optional[Dict[str, Any]]:
+        """Результат из кэша (None - промах)"""
+        with self._lock:
+            text = self._entries.get(key)
+            if text is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return json.loads(text)
+        
+        text = self._disk_read(key)
+        if text is None:
+            self.misses += 1
+            return None
+        self.disk_hits += 1
+        self._remember(key, text)
+        return json.loads(text)
+    
+    def put(self, key: Tuple[str, str, str], result: Dict[str, Any]):
+        """Сохранение результата в память и на диск"""
+        try:
+            text = json.dumps(result, ensure_ascii=False)
+        except (TypeError, ValueError):
+            return
+        self._remember(key, text)
+        self._disk_write(key, text)
+    
+    def _remember(self, key: Tuple[str, str, str], text: str):
+        with self._lock:
+            self._entries[key] = text
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+    
+    def clear(self):
+        """Очистка памяти и дискового уровня"""
+        with self._lock:
+            self._entries.clear()
+        if self.disk_dir and os.path.isdir(self.disk_dir):
+            for entry in os.scandir(self.disk_dir):
+                try:
+                    os.unlink(entry.path)
+                except OSError:
+                    pass
+            self._disk_count = 0
+    
+    def stats(self) -> Dict[str, Any]:
+        """Метрики попаданий и промахов"""
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            "version": PARSER_VERSION,
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": round((self.hits + self.disk_hits) / lookups, 3) if lookups else 0.0,
+            "disk_dir": self.disk_dir
+        }
+    
+    # ------------------------------------------------------------------
+    # Дисковый уровень
+    # ------------------------------------------------------------------
+    
+    def _disk_path(self, key: Tuple[str, str, str]) -> str:
+        name = hashlib.sha256("\0".join(key).encode()).hexdigest()
+        return os.path.join(self.disk_dir, name + ".json")
+    
+    def _disk_read(self, key: Tuple[str, str, str]) -> Optional[str]:
+        if not self.disk_dir:
+            return None
+        path = self._disk_path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                text = f.read()
+            # mtime - время последнего использования для вытеснения
+            os.utime(path)
+            return text
+        except OSError:
+            return None
+    
+    def _disk_write(self, key: Tuple[str, str, str], text: str):
+        if not self.disk_dir:
+            return
+        path = self._disk_path(key)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        try:
+            if self._disk_count is None:
+                # В результатах uuid, пароли и ключи: каталоги 0700, файлы 0600
+                os.makedirs(os.path.dirname(self.disk_dir), 0o700, exist_ok=True)
+                os.makedirs(self.disk_dir, 0o700, exist_ok=True)
+                os.chmod(os.path.dirname(self.disk_dir), 0o700)
+                os.chmod(self.disk_dir, 0o700)
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(text)
+            os.replace(tmp, path)
+        except OSError:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+            return
+        
+        if self._disk_count is None:
+            self._disk_count = sum(1 for _ in os.scandir(self.disk_dir))
+        else:
+            self._disk_count += 1
+        if self._disk_count > self.disk_entries:
+            self._disk_prune()
+    
+    def _disk_prune(self):
+        """Вытеснение самых старых файлов до 90% лимита"""
+        entries = []
+        for entry in os.scandir(self.disk_dir):
+            try:
+                entries.append((entry.stat().st_mtime, entry.path))
+            except OSError:
+                pass
+        entries.sort()
+        excess = len(entries) - int(self.disk_entries * 0.9)
+        for _, path in entries[:max(excess, 0)]:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+        self._disk_count = len(entries) - max(excess, 0)
+
 
 class KVMProtocolParser:
     """
@@ -24,7 +307,8 @@ class KVMProtocolParser:
     Поддерживает автоопределение и валидацию конфигураций.
     """
     
-    def __init__(self, kvm_resources: Dict[str, Any] = None):
+    def __init__(self, kvm_resources: Dict[str, Any] = None,
+                 cache: Union[ParseCache, bool, None] = True):
         self.kvm_resources = kvm_resources or {
             "cpu_count": 4,
             "memory_mb": 2048,
@@ -36,6 +320,27 @@ class KVMProtocolParser:
             "shadowsocks", "trojan", "sing-box", "hysteria2",
             "tor", "zapret", "byedpi", "goodbyedpi"
         ]
+        self._handlers: Dict[str, Callable[[ParseContext], Dict[str, Any]]] = {}
+        
+        # Результат зависит от kvm_resources: отпечаток ресурсов входит в ключ кэша
+        if cache is True:
+            cache = ParseCache()
+        self.cache: Optional[ParseCache] = cache or None
+        if self.cache is not None and not self.cache.salt:
+            resources = json.dumps(self.kvm_resources, sort_keys=True, default=str)
+            self.cache.salt = ":" + hashlib.sha256(resources.encode()).hexdigest()[:16]
+    
+    def _get_handler(self, protocol: str) -> Callable[[ParseContext], Dict[str, Any]]:
+        """Парсер протокола (разрешается и кэшируется при первом вызове)"""
+        handler = self._handlers.get(protocol)
+        if handler is None:
+            method = getattr(self, PROTOCOL_HANDLERS.get(protocol, "_parse_generic"))
+            if protocol in DPI_PROTOCOLS:
+                handler = lambda ctx: method(protocol, ctx.data)
+            else:
+                handler = method
+            self._handlers[protocol] = handler
+        return handler
     
     def parse(self, protocol: str, data: str) -> Dict[str, Any]:
         """
@@ -48,6 +353,21 @@ class KVMProtocolParser:
         Returns:
             Dict с распарсенными данными и KVM-оптимизациями
         """
+        key = None
+        if self.cache is not None and isinstance(data, str):
+            key = self.cache.key(protocol, data)
+            cached = self.cache.get(key)
+            if cached is not None:
+                cached["timestamp"] = datetime.now().isoformat()
+                return cached
+        
+        result = self._parse_uncached(protocol, data)
+        if key is not None:
+            self.cache.put(key, result)
+        return result
+    
+    def _parse_uncached(self, protocol: str, data: str) -> Dict[str, Any]:
+        """Разбор без обращения к кэшу"""
         result = {
             "timestamp": datetime.now().isoformat(),
             "protocol": protocol,
@@ -57,9 +377,11 @@ class KVMProtocolParser:
             "errors": []
         }
         
+        ctx = ParseContext(data)
+        
         # Автоопределение протокола
         if protocol == "auto" or not protocol:
-            protocol = self._detect_protocol(data)
+            protocol = self._detect_protocol(ctx)
             result["protocol"] = protocol
             result["auto_detected"] = True
         
@@ -69,28 +391,7 @@ class KVMProtocolParser:
         
         # Выбор парсера
         try:
-            if protocol == "wireguard":
-                parsed = self._parse_wireguard(data)
-            elif protocol == "amneziawg":
-                parsed = self._parse_amneziawg(data)
-            elif protocol == "openvpn":
-                parsed = self._parse_openvpn(data)
-            elif protocol == "xray":
-                parsed = self._parse_xray(data)
-            elif protocol == "shadowsocks":
-                parsed = self._parse_shadowsocks(data)
-            elif protocol == "trojan":
-                parsed = self._parse_trojan(data)
-            elif protocol == "sing-box":
-                parsed = self._parse_singbox(data)
-            elif protocol == "hysteria2":
-                parsed = self._parse_hysteria2(data)
-            elif protocol == "tor":
-                parsed = self._parse_tor(data)
-            elif protocol in ["zapret", "byedpi", "goodbyedpi"]:
-                parsed = self._parse_dpi_bypass(protocol, data)
-            else:
-                parsed = self._parse_generic(data)
+            parsed = self._get_handler(protocol)(ctx)
             
             result.update(parsed)
             result["parsed"] = True
@@ -107,23 +408,99 @@ class KVMProtocolParser:
         
         return result
     
-    def _detect_protocol(self, data: str) -> str:
+    def parse_many(self, items: Iterable[Union[str, Tuple[str, str]]], protocol: str = "auto",
+                   backend: str = "auto", workers: Optional[int] = None,
+                   chunk_size: int = PARSE_CHUNK) -> Iterator[Dict[str, Any]]:
+        """
+        Потоковый разбор множества ключей с сохранением порядка входа.
+        
+        Args:
+            items: Строки ключей или пары (протокол, данные)
+            protocol: Протокол для строк без явного протокола
+            backend: "inline", "process" или "auto" (пул с POOL_THRESHOLD ключей)
+            workers: Число процессов пула (по умолчанию по числу CPU)
+            chunk_size: Ключей в одной порции для воркера
+            
+        Returns:
+            Генератор результатов parse() в порядке входа
+        """
+        items = iter(items)
+        normalize = lambda item: item if isinstance(item, tuple) else (protocol, item)
+        
+        if backend == "auto":
+            head = list(itertools.islice(items, POOL_THRESHOLD))
+            large = len(head) == POOL_THRESHOLD and (os.cpu_count() or 1) > 1
+            backend = "process" if large else "inline"
+            items = itertools.chain(head, items)
+        
+        # Воркеры forkserver импортируют модуль заново по имени: нужен sentinel_parser_kvm
+        # (sentinel_modules), а не __main__ или модуль вне sys.modules
+        if backend == "process" and (__name__ == "__main__" or sys.modules.get(__name__) is None):
+            backend = "inline"
+        
+        if backend == "inline":
+            for item in items:
+                yield self.parse(*normalize(item))
+            return
+        
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        
+        # fork из многопоточного оркестратора копирует удерживаемые другими потоками
+        # блокировки (logging, кэш): воркеры стартуют из однопоточного forkserver
+        context = multiprocessing.get_context("forkserver")
+        context.set_forkserver_preload(["sentinel_modules", __name__])
+        workers = workers or os.cpu_count() or 1
+        pool = ProcessPoolExecutor(workers, mp_context=context,
+                                   initializer=_init_worker, initargs=(self.kvm_resources,))
+        pending = deque()
+        try:
+            chunks = iter(lambda: [normalize(item) for item in itertools.islice(items, chunk_size)], [])
+            for chunk in chunks:
+                # Попадания кэша разрешаются здесь, воркерам уходят только промахи
+                results, misses = self._lookup_chunk(chunk)
+                future = pool.submit(_parse_chunk, [chunk[i] for i in misses]) if misses else None
+                pending.append((chunk, results, misses, future))
+                # Не больше двух порций на воркер в полете: память не растет с размером подписки
+                if len(pending) >= workers * 2:
+                    yield from self._complete_chunk(*pending.popleft())
+            while pending:
+                yield from self._complete_chunk(*pending.popleft())
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+    
+    def _lookup_chunk(self, chunk: List[Tuple[str, str]]) -> Tuple[List[Any], List[int]]:
+        """Результаты порции из кэша и индексы промахов"""
+        if self.cache is None:
+            return [None] * len(chunk), list(range(len(chunk)))
+        results, misses = [], []
+        for i, (protocol, data) in enumerate(chunk):
+            cached = self.cache.get(self.cache.key(protocol, data)) if isinstance(data, str) else None
+            if cached is not None:
+                cached["timestamp"] = datetime.now().isoformat()
+            else:
+                misses.append(i)
+            results.append(cached)
+        return results, misses
+    
+    def _complete_chunk(self, chunk: List[Tuple[str, str]], results: List[Any],
+                        misses: List[int], future) -> List[Dict[str, Any]]:
+        """Слияние результатов воркера с попаданиями кэша"""
+        if future is not None:
+            for i, parsed in zip(misses, future.result()):
+                results[i] = parsed
+                if self.cache is not None and isinstance(chunk[i][1], str):
+                    self.cache.put(self.cache.key(*chunk[i]), parsed)
+        return results
+    
+    def _detect_protocol(self, data: Union[str, ParseContext]) -> str:
         """Автоопределение протокола по содержимому"""
-        data = data.strip()
+        ctx = ParseContext.of(data)
         
         # URL схемы
-        if data.startswith("ss://"):
-            return "shadowsocks"
-        elif data.startswith("trojan://"):
-            return "trojan"
-        elif data.startswith("vless://") or data.startswith("vmess://"):
-            return "xray"
-        elif data.startswith("wg://") or data.startswith("wireguard://"):
-            return "wireguard"
-        elif data.startswith("amnezia://"):
-            return "amneziawg"
-        elif data.startswith("hysteria://") or data.startswith("hy2://"):
-            return "hysteria2"
+        if ctx.scheme is not None:
+            return SCHEME_PROTOCOLS.get(ctx.scheme, "unknown")
+        data = ctx.data
         
         # WireGuard конфиг
         if "[Interface]" in data and "[Peer]" in data:
@@ -132,28 +509,25 @@ class KVMProtocolParser:
             return "wireguard"
         
         # OpenVPN
-        if "client" in data.lower() and "dev tun" in data.lower():
+        if "client" in ctx.lower and "dev tun" in ctx.lower:
             return "openvpn"
         
-        # JSON конфиги
-        if data.strip().startswith("{"):
-            try:
-                json_data = json.loads(data)
-                if "outbounds" in json_data:
-                    return "sing-box"
-                elif "inbounds" in json_data:
-                    return "xray"
-            except:
-                pass
+        # JSON конфиги (разобранный объект остается в контексте для парсера)
+        if isinstance(ctx.json, dict):
+            if "outbounds" in ctx.json:
+                return "sing-box"
+            elif "inbounds" in ctx.json:
+                return "xray"
         
         # Tor
-        if "SOCKSPort" in data or "torrc" in data.lower():
+        if "SOCKSPort" in data or "torrc" in ctx.lower:
             return "tor"
         
         return "unknown"
     
-    def _parse_wireguard(self, data: str) -> Dict[str, Any]:
+    def _parse_wireguard(self, data: Union[str, ParseContext]) -> Dict[str, Any]:
         """Парсинг WireGuard с KVM-оптимизациями"""
+        ctx = ParseContext.of(data)
         result = {
             "type": "wireguard",
             "interface": {},
@@ -167,38 +541,15 @@ class KVMProtocolParser:
         }
         
         # URL формат
-        if data.startswith("wg://") or data.startswith("wireguard://"):
-            return self._parse_wireguard_url(data)
+        if ctx.scheme in ("wg", "wireguard"):
+            return self._parse_wireguard_url(ctx.data)
         
         # INI формат
-        current_section = None
-        current_peer = {}
-        
-        for line in data.split('\n'):
-            line = line.strip()
-            if not line or line.startswith('#'):
-                continue
-            
-            if line.startswith('[') and line.endswith(']'):
-                current_section = line[1:-1]
-                if current_section == "Peer":
-                    if current_peer:
-                        result["peers"].append(current_peer)
-                    current_peer = {}
-                continue
-            
-            if '=' in line:
-                key, value = line.split('=', 1)
-                key = key.strip().lower()
-                value = value.strip()
-                
-                if current_section == "Interface":
-                    result["interface"][key] = value
-                elif current_section == "Peer":
-                    current_peer[key] = value
-        
-        if current_peer:
-            result["peers"].append(current_peer)
+        for section, items in ctx.ini:
+            if section == "Interface":
+                result["interface"].update((key.lower(), value) for key, value in items)
+            elif section == "Peer" and items:
+                result["peers"].append({key.lower(): value for key, value in items})
         
         # Проверка на AmneziaWG параметры
         for param in ["jc", "jmin", "jmax", "s1", "s2", "h1", "h2", "h3", "h4"]:
@@ -250,7 +601,7 @@ class KVMProtocolParser:
         
         return result
     
-    def _parse_amneziawg(self, data: str) -> Dict[str, Any]:
+    def _parse_amneziawg(self, data: Union[str, ParseContext]) -> Dict[str, Any]:
         """Парсинг AmneziaWG с дополнительными параметрами"""
         result = self._parse_wireguard(data)
         result["type"] = "amneziawg"
@@ -270,8 +621,9 @@ class KVMProtocolParser:
         
         return result
     
-    def _parse_openvpn(self, data: str) -> Dict[str, Any]:
+    def _parse_openvpn(self, data: Union[str, ParseContext]) -> Dict[str, Any]:
         """Парсинг OpenVPN с поддержкой inline тегов"""
+        data = ParseContext.of(data).data
         result = {
             "type": "openvpn",
             "mode": "client",
@@ -345,8 +697,9 @@ class KVMProtocolParser:
         
         return result
     
-    def _parse_xray(self, data: str) -> Dict[str, Any]:
+    def _parse_xray(self, data: Union[str, ParseContext]) -> Dict[str, Any]:
         """Парсинг Xray конфигураций (VLESS, VMess, Trojan, Reality)"""
+        ctx = ParseContext.of(data)
         result = {
             "type": "xray",
             "protocol": None,
@@ -361,26 +714,23 @@ class KVMProtocolParser:
         }
         
         # JSON конфиг
-        if data.strip().startswith('{'):
-            try:
-                json_config = json.loads(data)
-                return self._parse_xray_json(json_config)
-            except:
-                pass
+        if isinstance(ctx.json, dict):
+            return self._parse_xray_json(ctx.json)
         
         # URL форматы
-        if data.startswith("vless://"):
-            return self._parse_vless_url(data)
-        elif data.startswith("vmess://"):
-            return self._parse_vmess_url(data)
-        elif data.startswith("trojan://"):
-            return self._parse_trojan_url(data)
+        if ctx.scheme == "vless":
+            return self._parse_vless_url(ctx)
+        elif ctx.scheme == "vmess":
+            return self._parse_vmess_url(ctx.data)
+        elif ctx.scheme == "trojan":
+            return self._parse_trojan_url(ctx)
         
         return result
     
-    def _parse_vless_url(self, url: str) -> Dict[str, Any]:
+    def _parse_vless_url(self, url: Union[str, ParseContext]) -> Dict[str, Any]:
         """Парсинг VLESS URL"""
-        parsed = urllib.parse.urlparse(url)
+        ctx = ParseContext.of(url)
+        parsed = ctx.url
         
         result = {
             "type": "xray",
@@ -402,7 +752,7 @@ class KVMProtocolParser:
         
         # Парсим параметры
         if parsed.query:
-            params = urllib.parse.parse_qs(parsed.query)
+            params = ctx.query
             
             if "type" in params:
                 result["stream_settings"]["network"] = params["type"][0]
@@ -467,9 +817,10 @@ class KVMProtocolParser:
                 "kvm_optimizations": {}
             }
     
-    def _parse_trojan_url(self, url: str) -> Dict[str, Any]:
+    def _parse_trojan_url(self, url: Union[str, ParseContext]) -> Dict[str, Any]:
         """Парсинг Trojan URL"""
-        parsed = urllib.parse.urlparse(url)
+        ctx = ParseContext.of(url)
+        parsed = ctx.url
         
         result = {
             "type": "trojan",
@@ -488,7 +839,7 @@ class KVMProtocolParser:
         }
         
         if parsed.query:
-            params = urllib.parse.parse_qs(parsed.query)
+            params = ctx.query
             if "sni" in params:
                 result["stream_settings"]["tls_settings"] = {
                     "server_name": params["sni"][0]
@@ -525,8 +876,9 @@ class KVMProtocolParser:
         
         return result
     
-    def _parse_shadowsocks(self, data: str) -> Dict[str, Any]:
+    def _parse_shadowsocks(self, data: Union[str, ParseContext]) -> Dict[str, Any]:
         """Парсинг Shadowsocks (ss://)"""
+        data = ParseContext.of(data).data
         result = {
             "type": "shadowsocks",
             "method": None,
@@ -577,31 +929,31 @@ class KVMProtocolParser:
         
         return result
     
-    def _parse_trojan(self, data: str) -> Dict[str, Any]:
+    def _parse_trojan(self, data: Union[str, ParseContext]) -> Dict[str, Any]:
         """Парсинг Trojan"""
-        if data.startswith("trojan://"):
-            return self._parse_trojan_url(data)
-        else:
-            try:
-                json_config = json.loads(data)
-                return {
-                    "type": "trojan",
-                    "protocol": "trojan",
-                    "config": json_config,
-                    "kvm_optimizations": {
-                        "tcp_fastopen": True,
-                        "multicore": True
-                    }
-                }
-            except:
-                return {
-                    "type": "trojan",
-                    "error": "Invalid format",
-                    "kvm_optimizations": {}
+        ctx = ParseContext.of(data)
+        if ctx.scheme == "trojan":
+            return self._parse_trojan_url(ctx)
+        elif ctx.json is not None:
+            return {
+                "type": "trojan",
+                "protocol": "trojan",
+                "config": ctx.json,
+                "kvm_optimizations": {
+                    "tcp_fastopen": True,
+                    "multicore": True
                 }
+            }
+        else:
+            return {
+                "type": "trojan",
+                "error": "Invalid format",
+                "kvm_optimizations": {}
+            }
     
-    def _parse_singbox(self, data: str) -> Dict[str, Any]:
+    def _parse_singbox(self, data: Union[str, ParseContext]) -> Dict[str, Any]:
         """Парсинг Sing-box конфигурации"""
+        ctx = ParseContext.of(data)
         result = {
             "type": "sing-box",
             "protocol": "sing-box",
@@ -614,7 +966,9 @@ class KVMProtocolParser:
         }
         
         try:
-            json_config = json.loads(data)
+            json_config = ctx.json
+            if json_config is None:
+                raise ValueError(ctx.json_error)
             result["config"] = json_config
             
             # Извлекаем основную информацию
@@ -639,8 +993,10 @@ class KVMProtocolParser:
         
         return result
     
-    def _parse_hysteria2(self, data: str) -> Dict[str, Any]:
+    def _parse_hysteria2(self, data: Union[str, ParseContext]) -> Dict[str, Any]:
         """Парсинг Hysteria2"""
+        ctx = ParseContext.of(data)
+        data = ctx.data
         result = {
             "type": "hysteria2",
             "protocol": "hysteria2",
@@ -652,7 +1008,7 @@ class KVMProtocolParser:
         }
         
         # URL формат
-        if data.startswith("hysteria://") or data.startswith("hy2://"):
+        if ctx.scheme in ("hysteria", "hy2"):
             data = re.sub(r'^(hysteria://|hy2://)', '', data)
             
             if '?' in data:
@@ -674,17 +1030,14 @@ class KVMProtocolParser:
                     result["down_mbps"] = int(params["down"][0])
         
         # JSON формат
-        else:
-            try:
-                json_config = json.loads(data)
-                result["config"] = json_config
-            except:
-                pass
+        elif ctx.json is not None:
+            result["config"] = ctx.json
         
         return result
     
-    def _parse_tor(self, data: str) -> Dict[str, Any]:
+    def _parse_tor(self, data: Union[str, ParseContext]) -> Dict[str, Any]:
         """Парсинг Tor конфигурации"""
+        data = ParseContext.of(data).data
         result = {
             "type": "tor",
             "protocol": "tor",
@@ -742,8 +1095,10 @@ class KVMProtocolParser:
         
         return result
     
-    def _parse_generic(self, data: str) -> Dict[str, Any]:
+    def _parse_generic(self, data: Union[str, ParseContext]) -> Dict[str, Any]:
         """Универсальный парсер для неизвестных форматов"""
+        ctx = ParseContext.of(data)
+        data = ctx.data
         result = {
             "type": "unknown",
             "raw_data": data[:500] + "..." if len(data) > 500 else data,
@@ -758,7 +1113,7 @@ class KVMProtocolParser:
         
         # Ищем порты
         port_pattern = r'\bport[=:\s]+(\d+)\b'
-        ports = re.findall(port_pattern, data.lower())
+        ports = re.findall(port_pattern, ctx.lower)
         if ports:
             result["detected"].append(f"Ports: {ports[:5]}")
         
@@ -841,6 +1196,25 @@ class KVMProtocolParser:
         return valid
 
 
+# ============================================================================
+# ВОРКЕРЫ ПУЛА
+# ============================================================================
+
+_WORKER_PARSER: Optional[KVMProtocolParser] = None
+
+
+def _init_worker(kvm_resources: Dict[str, Any]):
+    """Парсер процесса пула (создается один раз на воркер)"""
+    global _WORKER_PARSER
+    # Кэш ведет родительский процесс
+    _WORKER_PARSER = KVMProtocolParser(kvm_resources, cache=False)
+
+
+def _parse_chunk(chunk: List[Tuple[str, str]]) -> List[Dict[str, Any]]:
+    """Разбор порции ключей в воркере"""
+    return [_WORKER_PARSER.parse(protocol, data) for protocol, data in chunk]
+
+
 # ============================================================================
 # ТЕСТОВЫЙ МОДУЛЬ
 # ============================================================================
@@ -892,6 +1266,14 @@ MIIF...
         print("-" * 50)
         result = parser.parse(protocol, data)
         print(json.dumps(result, indent=2, ensure_ascii=False)[:1000])
+    
+    # Повторный разбор тех же ключей обслуживается кэшем
+    import time
+    start = time.perf_counter()
+    for protocol, data in test_cases:
+        parser.parse(protocol, data)
+    elapsed = (time.perf_counter() - start) / len(test_cases) * 1e6
+    print(f"\n📊 Повторный разбор: {elapsed:.1f} мкс на ключ, кэш: {parser.cache.stats()}")
 
 
 if __name__ == "__main__":
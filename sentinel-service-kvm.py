@@ -14,35 +14,52 @@ import time
 import signal
 import logging
 import subprocess
-import psutil
 import threading
 from pathlib import Path
 from typing import Dict, Any, List, Optional, Tuple
 from datetime import datetime
 import socket
-import fcntl
-import struct
 
-# Настройка логирования
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
+# Логирование настраивает процесс-владелец (setup_logging из sentinel-logging-kvm.py);
+# psutil импортируется в методах: импорт модуля не имеет побочных эффектов
 logger = logging.getLogger("sentinel-service-kvm")
 
+# Запуск служб по типу: метод разрешается при первом запуске службы этого типа
+SERVICE_STARTERS = {
+    "wireguard": "_start_wireguard",
+    "openvpn": "_start_openvpn",
+    "xray": "_start_xray",
+    "shadowsocks": "_start_shadowsocks",
+    "tor": "_start_tor",
+    "zapret": "_start_dpi_bypass",
+    "byedpi": "_start_dpi_bypass",
+    "goodbyedpi": "_start_dpi_bypass"
+}
+
+# Соседние модули sentinel-*.py загружает общий загрузчик из того же каталога
+_SENTINEL_DIR = str(Path(__file__).resolve().parent)
+if _SENTINEL_DIR not in sys.path:
+    sys.path.insert(0, _SENTINEL_DIR)
+from sentinel_modules import load_sentinel_module as _load_sentinel_module
+
+
 class KVMServiceManager:
     """
     Менеджер служб с поддержкой KVM-оптимизаций.
     Управляет запуском, остановкой и мониторингом всех протоколов.
     """
     
-    def __init__(self, kvm_resources: Dict[str, Any] = None):
+    def __init__(self, kvm_resources: Dict[str, Any] = None, config: Dict[str, Any] = None):
         self.kvm_resources = kvm_resources or self._detect_kvm_resources()
         self.services: Dict[str, Dict[str, Any]] = {}
-        self.cgroups_base = "/sys/fs/cgroup"
-        self.sentinel_cgroup = f"{self.cgroups_base}/sentinel"
+        cgroup = _load_sentinel_module("sentinel-cgroup-kvm.py")
+        self.cgroups = cgroup.CgroupManager(config)
+        kvm_config = (config or {}).get("kvm", {})
+        self.memory = cgroup.MemoryTuner(balloon=kvm_config.get("balloon_driver", True))
+        self.pressure = cgroup.PressureMonitor(self.cgroups, self.memory)
         self.running = False
         self.monitor_thread = None
+        self.interface_manager = None
         
         # Инициализация cgroups
         self._init_cgroups()
@@ -53,6 +70,7 @@ class KVMServiceManager:
     
     def _detect_kvm_resources(self) -> Dict[str, Any]:
         """Автоопределение ресурсов KVM"""
+        import psutil
         resources = {
             "cpu_count": psutil.cpu_count(),
             "cpu_freq": psutil.cpu_freq().current if psutil.cpu_freq() else 0,
@@ -75,20 +93,29 @@ class KVMServiceManager:
         except:
             return False
     
+    def _get_interface_manager(self):
+        """Менеджер интерфейсов (rtnetlink + SIOCETHTOOL)"""
+        if self.interface_manager is None:
+            self.interface_manager = _load_sentinel_module("sentinel-netlink-kvm.py").InterfaceManager()
+        return self.interface_manager
+    
+    def _get_virtio_net_devices(self) -> List[str]:
+        """Список сетевых интерфейсов с драйвером VirtIO"""
+        devices = []
+        for dev_path in sorted(Path("/sys/class/net").glob("*")):
+            driver_path = dev_path / "device" / "driver"
+            if driver_path.exists() and "virtio" in driver_path.resolve().name:
+                devices.append(dev_path.name)
+        return devices
+    
     def _check_virtio_net(self) -> bool:
         """Проверка наличия VirtIO сетевых устройств"""
-        for dev in ["eth0", "eth1", "ens3", "ens4"]:
-            path = f"/sys/class/net/{dev}/device/driver"
-            if os.path.exists(path):
-                driver = os.path.realpath(path).split('/')[-1]
-                if "virtio" in driver:
-                    return True
-        return False
+        return bool(self._get_virtio_net_devices())
     
     def _get_virtio_queues(self) -> int:
         """Получение количества очередей VirtIO"""
         try:
-            for dev in ["eth0", "eth1", "ens3", "ens4"]:
+            for dev in self._get_virtio_net_devices():
                 queues_path = f"/sys/class/net/{dev}/queues"
                 if os.path.exists(queues_path):
                     rx_queues = len(list(Path(queues_path).glob("rx-*")))
@@ -101,17 +128,8 @@ class KVMServiceManager:
     def _init_cgroups(self):
         """Инициализация cgroups для управления ресурсами"""
         try:
-            # Создаем cgroup для Sentinel
-            if not os.path.exists(self.sentinel_cgroup):
-                os.makedirs(f"{self.sentinel_cgroup}/memory", exist_ok=True)
-                os.makedirs(f"{self.sentinel_cgroup}/cpu", exist_ok=True)
-                os.makedirs(f"{self.sentinel_cgroup}/blkio", exist_ok=True)
-                
-                # Включаем контроль памяти
-                with open(f"{self.sentinel_cgroup}/memory/memory.use_hierarchy", "w") as f:
-                    f.write("1")
-                
-                logger.info("✅ cgroups инициализированы")
+            # cgroup v2: корневая группа Sentinel с общим бюджетом из секции resources
+            self.cgroups.setup()
         except Exception as e:
             logger.warning(f"⚠️ Не удалось инициализировать cgroups: {e}")
     
@@ -128,7 +146,7 @@ class KVMServiceManager:
             "cpu_usage": 0,
             "restart_count": 0,
             "last_error": None,
-            "cgroup": f"{self.sentinel_cgroup}/{name.replace('.', '_')}"
+            "cgroup": str(self.cgroups.path(name))
         }
         logger.info(f"📝 Зарегистрирована служба: {name} ({service_type})")
     
@@ -152,21 +170,10 @@ class KVMServiceManager:
             # Создаем cgroup для службы
             self._create_service_cgroup(name)
             
-            # Запуск в зависимости от типа
-            if service["type"] == "wireguard":
-                success = self._start_wireguard(name, service)
-            elif service["type"] == "openvpn":
-                success = self._start_openvpn(name, service)
-            elif service["type"] == "xray":
-                success = self._start_xray(name, service)
-            elif service["type"] == "shadowsocks":
-                success = self._start_shadowsocks(name, service)
-            elif service["type"] == "tor":
-                success = self._start_tor(name, service)
-            elif service["type"] in ["zapret", "byedpi", "goodbyedpi"]:
-                success = self._start_dpi_bypass(name, service)
-            else:
-                success = self._start_generic(name, service)
+            # Запуск в зависимости от типа; политика THP (config.thp) наследуется процессом службы
+            starter = getattr(self, SERVICE_STARTERS.get(service["type"], "_start_generic"))
+            with self.memory.thp_policy(service["config"].get("thp")):
+                success = starter(name, service)
             
             if success:
                 service["status"] = "running"
@@ -175,6 +182,7 @@ class KVMServiceManager:
                 
                 # Применяем лимиты ресурсов
                 self._apply_resource_limits(name)
+                self.pressure.register(name, service["type"])
                 
                 logger.info(f"✅ Служба {name} запущена")
                 return True
@@ -214,6 +222,7 @@ class KVMServiceManager:
                     os.kill(service["pid"], signal.SIGKILL)
             
             # Удаляем cgroup
+            self.pressure.unregister(name)
             self._remove_service_cgroup(name)
             
             service["status"] = "stopped"
@@ -248,8 +257,11 @@ class KVMServiceManager:
         # Включаем multiqueue для VirtIO
         if self.kvm_resources.get("virtio_net"):
             queues = self.kvm_resources.get("virtio_queues", 4)
-            subprocess.run(f"ethtool -L {config.get('interface', {}).get('device', 'wg0')} "
-                         f"combined {queues} 2>/dev/null", shell=True)
+            device = config.get('interface', {}).get('device', 'wg0')
+            try:
+                self._get_interface_manager().set_channels(device, combined=queues)
+            except Exception as e:
+                logger.warning(f"⚠️ Не удалось настроить очереди {device}: {e}")
         
         # Запускаем wg-quick
         result = subprocess.run(
@@ -448,6 +460,16 @@ class KVMServiceManager:
         """Проверка доступности ресурсов"""
         service = self.services[name]
         
+        # Решение по Pressure Stall Information: запуск откладывается под давлением
+        if self.pressure.available:
+            result = self.pressure.wait_for_admission(service["type"])
+            if result["decision"] != "admit":
+                logger.error(f"❌ Запуск {name} отклонен ({result['decision']}): {result['reason']}")
+                return False
+            return True
+        
+        # Без PSI: фиксированные пороги
+        
         # Проверка памяти
         if service["type"] in ["xray", "adguardhome", "hysteria2"]:
             if self.kvm_resources["memory_available_mb"] < 512:
@@ -456,6 +478,7 @@ class KVMServiceManager:
         
         # Проверка CPU для многопоточных служб
         if service["type"] in ["xray", "sing-box"]:
+            import psutil
             cpu_percent = psutil.cpu_percent()
             if cpu_percent > 80:
                 logger.warning(f"⚠️ Высокая загрузка CPU ({cpu_percent}%) для {name}")
@@ -464,21 +487,13 @@ class KVMServiceManager:
     
     def _create_service_cgroup(self, name: str):
         """Создание cgroup для службы"""
-        try:
-            cgroup_path = f"{self.sentinel_cgroup}/{name.replace('.', '_')}"
-            os.makedirs(cgroup_path, exist_ok=True)
-            self.services[name]["cgroup"] = cgroup_path
-        except Exception as e:
-            logger.warning(f"⚠️ Не удалось создать cgroup: {e}")
+        cgroup_path = self.cgroups.create(name)
+        if cgroup_path:
+            self.services[name]["cgroup"] = str(cgroup_path)
     
     def _remove_service_cgroup(self, name: str):
         """Удаление cgroup службы"""
-        try:
-            cgroup_path = self.services[name].get("cgroup")
-            if cgroup_path and os.path.exists(cgroup_path):
-                os.rmdir(cgroup_path)
-        except Exception as e:
-            logger.warning(f"⚠️ Не удалось удалить cgroup: {e}")
+        self.cgroups.remove(name)
     
     def _apply_resource_limits(self, name: str):
         """Применение лимитов ресурсов через cgroups"""
@@ -489,28 +504,14 @@ class KVMServiceManager:
             return
         
         try:
-            # Лимит памяти для ресурсоемких служб
-            if service["type"] in ["xray", "adguardhome", "hysteria2"]:
-                limit_mb = 512
-                with open(f"{cgroup_path}/memory.max", "w") as f:
-                    f.write(f"{limit_mb * 1024 * 1024}")
-                
-                logger.info(f"✅ Лимит памяти {limit_mb}MB для {name}")
-            
-            # Привязка CPU для Tor
-            if service["type"] == "tor":
-                with open(f"{cgroup_path}/cpu.max", "w") as f:
-                    f.write("50000 100000")  # 50% CPU
-            
-            # Добавляем PID в cgroup
-            with open(f"{cgroup_path}/cgroup.procs", "w") as f:
-                f.write(str(service["pid"]))
-                
+            # memory.high/max, swap, cpu.weight/max, io.weight из protocols.<тип|имя> в sentinel.yaml
+            service["limits"] = self.cgroups.setup_protocol(name, service["pid"], service["type"], name)
         except Exception as e:
             logger.warning(f"⚠️ Не удалось применить лимиты: {e}")
     
     def get_status(self) -> Dict[str, Any]:
         """Получение статуса всех служб"""
+        import psutil
         status = {
             "kvm": self.kvm_resources,
             "services": {},
@@ -520,6 +521,10 @@ class KVMServiceManager:
                 "uptime": time.time() - psutil.boot_time()
             }
         }
+        if self.pressure.available:
+            status["system"]["pressure"] = self.pressure.snapshot()
+            status["system"]["throttled"] = list(self.pressure.throttled)
+        status["system"]["balloon"] = self.memory.predict()
         
         for name, service in self.services.items():
             if service["pid"]:
@@ -549,6 +554,9 @@ class KVMServiceManager:
         self.monitor_thread = threading.Thread(target=self._monitor_loop)
         self.monitor_thread.daemon = True
         self.monitor_thread.start()
+        
+        # PSI триггеры: троттлинг низкоприоритетных служб при стойках
+        self.pressure.start_monitoring()
         logger.info("✅ Мониторинг запущен")
     
     def _monitor_loop(self):
@@ -568,6 +576,10 @@ class KVMServiceManager:
                             service["status"] = "error"
                             service["last_error"] = "Max restarts exceeded"
             
+            # Раздувание balloon: сжатие бюджета Sentinel до прихода OOM killer
+            if self.memory.balloon:
+                self.memory.protect(self.cgroups)
+            
             time.sleep(10)
     
     def _process_exists(self, pid: int) -> bool:
@@ -637,4 +649,5 @@ def test_service_manager():
 
 
 if __name__ == "__main__":
+    _load_sentinel_module("sentinel-logging-kvm.py").setup_logging("sentinel-service")
     test_service_manager()
\ No newline at end of file
@@ -0,0 +1,435 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+SENTINEL OS KVM - Subscription Ingestion
+========================================
+Загрузка подписок провайдеров (base64 со ссылками vless://, vmess://,
+ss://, trojan://...) поверх KVMProtocolParser: параллельная загрузка с
+условными запросами, декодирование, потоковый разбор, дедупликация
+конечных точек и каталог. При обновлении разбираются только новые или
+измененные строки.
+"""
+
+import os
+import sys
+import json
+import time
+import base64
+import hashlib
+import logging
+import binascii
+import urllib.request
+import urllib.error
+from pathlib import Path
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List, Optional, Tuple
+
+# Настройка логирования
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger("sentinel-subscription-kvm")
+
+CATALOG_VERSION = 1
+SUBSCRIPTIONS_DIR = Path("/etc/sentinel/subscriptions")
+CATALOG_FILE = SUBSCRIPTIONS_DIR / "catalog.json"
+MAIN_CONFIG = Path("/etc/sentinel/sentinel.yaml")
+
+FETCH_TIMEOUT = 15
+FETCH_WORKERS = 4
+MAX_BODY_BYTES = 16 * 1024 * 1024
+USER_AGENT = "sentinel-kvm/2.0"
+
+# Поля результата parse(), которые не сохраняются в каталоге
+VOLATILE_FIELDS = ("timestamp", "kvm_optimizations", "kvm_specific", "warnings", "errors", "auto_detected")
+
+
+# Соседние модули sentinel-*.py загружает общий загрузчик из того же каталога
+_SENTINEL_DIR = str(Path(__file__).resolve().parent)
+if _SENTINEL_DIR not in sys.path:
+    sys.path.insert(0, _SENTINEL_DIR)
+from sentinel_modules import load_sentinel_module as _load_sentinel_module
+
+
+# ============================================================================
+# ДЕКОДИРОВАНИЕ И КАНОНИЗАЦИЯ
+# ============================================================================
+
+def decode_subscription(body: bytes) -> List[str]:
+    """
+    Ссылки из тела подписки
+
+    Подписка - base64 (обычный или urlsafe, с padding или без) от списка
+    ссылок через перевод строки, либо сам список.
+    """
+    text = body.decode("utf-8", "replace").strip()
+    if "://" not in text:
+        compact = "".join(text.split())
+        compact += "=" * (-len(compact) % 4)
+        for decoder in (base64.b64decode, base64.urlsafe_b64decode):
+            try:
+                text = decoder(compact).decode("utf-8")
+                break
+            except (binascii.Error, ValueError):
+                continue
+
+    lines = []
+    for line in text.splitlines():
+        line = line.strip()
+        if line and not line.startswith("#") and "://" in line:
+            lines.append(line)
+    return lines
+
+
+def line_hash(line: str) -> str:
+    """Ключ строки подписки для инкрементального обновления"""
+    return hashlib.sha256(line.encode("utf-8")).hexdigest()[:32]
+
+
+def canonical_endpoint(parsed: Dict[str, Any]) -> Optional[str]:
+    """
+    Канонический идентификатор конечной точки
+
+    Одинаковый сервер, порт, протокол, учетные данные и транспорт дают один
+    идентификатор, даже если ссылки отличаются именем (#fragment) или
+    порядком параметров.
+    """
+    server = str(parsed.get("server") or "").strip().lower().rstrip(".")
+    if not server or not parsed.get("port"):
+        return None
+    stream = parsed.get("stream_settings") or {}
+    parts = [
+        parsed.get("protocol") or parsed.get("type") or "",
+        server,
+        str(parsed.get("port")),
+        str(parsed.get("uuid") or parsed.get("password") or ""),
+        str(parsed.get("method") or ""),
+        str(stream.get("network") or ""),
+        str(stream.get("security") or "")
+    ]
+    return hashlib.sha256("|".join(parts).encode("utf-8")).hexdigest()[:24]
+
+
+# ============================================================================
+# ЗАГРУЗКА
+# ============================================================================
+
+def fetch(source: Dict[str, Any], state: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Условная загрузка одной подписки
+
+    Args:
+        source: {"name", "url"}
+        state: Сохраненные etag/last_modified источника
+
+    Returns:
+        status ("ok", "not_modified", "error"), тело и новые валидаторы
+    """
+    request = urllib.request.Request(source["url"], headers={"User-Agent": USER_AGENT})
+    if state.get("etag"):
+        request.add_header("If-None-Match", state["etag"])
+    if state.get("last_modified"):
+        request.add_header("If-Modified-Since", state["last_modified"])
+
+    started = time.perf_counter()
+    result = {"name": source["name"], "status": "error", "body": None,
+              "etag": state.get("etag"), "last_modified": state.get("last_modified")}
+    try:
+        with urllib.request.urlopen(request, timeout=source.get("timeout", FETCH_TIMEOUT)) as response:
+            body = response.read(MAX_BODY_BYTES + 1)
+            if len(body) > MAX_BODY_BYTES:
+                raise ValueError(f"подписка больше {MAX_BODY_BYTES} байт")
+            result.update(status="ok", body=body,
+                          etag=response.headers.get("ETag"),
+                          last_modified=response.headers.get("Last-Modified"))
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            result["status"] = "not_modified"
+        else:
+            result["error"] = f"HTTP {e.code}"
+    except (urllib.error.URLError, OSError, ValueError) as e:
+        result["error"] = str(e)
+    result["fetch_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    return result
+
+
+# ============================================================================
+# КОНВЕЙЕР
+# ============================================================================
+
+class SubscriptionPipeline:
+    """
+    Конвейер подписок: загрузка -> декодирование -> разбор -> дедупликация -> каталог.
+
+    Каталог хранит для каждого источника валидаторы HTTP, хэш тела и
+    отображение "хэш строки -> конечная точка", поэтому при обновлении
+    304 и неизменное тело не разбираются вовсе, а из измененного тела
+    в парсер попадают только новые строки.
+    """
+
+    def __init__(self, sources: List[Dict[str, Any]], catalog_path: Path = CATALOG_FILE,
+                 parser=None, workers: int = FETCH_WORKERS):
+        self.sources = sources
+        self.catalog_path = Path(catalog_path)
+        self.parser = parser or _load_sentinel_module("sentinel-parser-kvm.py").KVMProtocolParser()
+        self.workers = workers
+        self.catalog = self.load()
+
+    def load(self) -> Dict[str, Any]:
+        """Загрузка каталога"""
+        try:
+            catalog = json.loads(self.catalog_path.read_text())
+            if catalog.get("version") == CATALOG_VERSION:
+                return catalog
+        except (OSError, ValueError):
+            pass
+        return {"version": CATALOG_VERSION, "updated": None, "sources": {}, "entries": {}}
+
+    def save(self):
+        """Атомарная запись каталога"""
+        self.catalog_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.catalog_path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(self.catalog, indent=2, ensure_ascii=False))
+        tmp.replace(self.catalog_path)
+
+    def refresh(self) -> Dict[str, Any]:
+        """
+        Обновление всех источников
+
+        Returns:
+            Статистика: загрузки, разобранные/переиспользованные строки,
+            дубликаты, удаленные точки и время этапов
+        """
+        stats = {"fetched": 0, "not_modified": 0, "unchanged": 0, "errors": [],
+                 "lines": 0, "parsed": 0, "reused": 0, "invalid": 0,
+                 "duplicates": 0, "added": 0, "removed": 0, "timings_ms": {}}
+        sources_state = self.catalog["sources"]
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            results = list(pool.map(lambda s: fetch(s, sources_state.get(s["name"], {})), self.sources))
+        stats["timings_ms"]["fetch"] = round((time.perf_counter() - started) * 1000, 1)
+
+        # Строки, которые нужно разобрать: (источник, хэш, строка)
+        started = time.perf_counter()
+        pending: List[Tuple[str, str, str]] = []
+        new_lines: Dict[str, Dict[str, Optional[str]]] = {}
+        # Состояние измененных источников фиксируется только после разбора
+        new_states: Dict[str, Dict[str, Any]] = {}
+        for source, result in zip(self.sources, results):
+            name = source["name"]
+            previous = sources_state.get(name, {})
+            if result["status"] == "error":
+                stats["errors"].append(f"{name}: {result.get('error')}")
+                logger.warning(f"⚠️ Подписка {name}: {result.get('error')}")
+                continue
+            if result["status"] == "not_modified":
+                stats["not_modified"] += 1
+                continue
+
+            stats["fetched"] += 1
+            body_hash = hashlib.sha256(result["body"]).hexdigest()
+            state = {"url": source["url"], "etag": result["etag"],
+                     "last_modified": result["last_modified"], "body_hash": body_hash,
+                     "fetched": datetime.now().isoformat(), "lines": previous.get("lines", {})}
+            if body_hash == previous.get("body_hash"):
+                sources_state[name] = state
+                stats["unchanged"] += 1
+                continue
+            new_states[name] = state
+
+            known = previous.get("lines", {})
+            lines = {}
+            for line in decode_subscription(result["body"]):
+                digest = line_hash(line)
+                if digest in lines:
+                    continue
+                if digest in known:
+                    lines[digest] = known[digest]
+                    stats["reused"] += 1
+                else:
+                    lines[digest] = None
+                    pending.append((name, digest, line))
+            stats["lines"] += len(lines)
+            new_lines[name] = lines
+        stats["timings_ms"]["decode"] = round((time.perf_counter() - started) * 1000, 1)
+
+        # Потоковый разбор только новых строк
+        started = time.perf_counter()
+        entries = self.catalog["entries"]
+        parsed_stream = self.parser.parse_many(line for _, _, line in pending)
+        for (name, digest, line), parsed in zip(pending, parsed_stream):
+            stats["parsed"] += 1
+            endpoint = canonical_endpoint(parsed) if parsed.get("parsed") else None
+            if endpoint is None:
+                stats["invalid"] += 1
+                continue
+            new_lines[name][digest] = endpoint
+            if endpoint in entries:
+                stats["duplicates"] += 1
+                continue
+            entries[endpoint] = {
+                "key": line,
+                "config": {k: v for k, v in parsed.items() if k not in VOLATILE_FIELDS},
+                "added": datetime.now().isoformat()
+            }
+            stats["added"] += 1
+        stats["timings_ms"]["parse"] = round((time.perf_counter() - started) * 1000, 1)
+
+        for name, lines in new_lines.items():
+            valid = {digest: endpoint for digest, endpoint in lines.items() if endpoint is not None}
+            if not valid:
+                # Страница ошибки или captive portal с кодом 200: не пустая подписка.
+                # Прежние строки, хэш и валидаторы остаются, тело будет разобрано снова.
+                stats["errors"].append(f"{name}: ответ не содержит ни одной ссылки")
+                logger.warning(f"⚠️ Подписка {name}: ответ не содержит ни одной ссылки, "
+                               f"сохранен предыдущий список")
+                continue
+            new_states[name]["lines"] = valid
+            sources_state[name] = new_states[name]
+
+        # Источники, удаленные из конфигурации, и точки без источников
+        configured = {source["name"] for source in self.sources}
+        for name in list(sources_state):
+            if name not in configured:
+                del sources_state[name]
+        referenced: Dict[str, List[str]] = {}
+        for name, state in sources_state.items():
+            for endpoint in state["lines"].values():
+                referenced.setdefault(endpoint, [])
+                if name not in referenced[endpoint]:
+                    referenced[endpoint].append(name)
+        for endpoint in list(entries):
+            if endpoint in referenced:
+                entries[endpoint]["sources"] = referenced[endpoint]
+            else:
+                del entries[endpoint]
+                stats["removed"] += 1
+
+        self.catalog["updated"] = datetime.now().isoformat()
+        self.save()
+        stats["endpoints"] = len(entries)
+        logger.info(f"✅ Подписки: {stats['endpoints']} точек (новых {stats['added']}, "
+                    f"разобрано {stats['parsed']}, переиспользовано {stats['reused']}, "
+                    f"дубликатов {stats['duplicates']}, удалено {stats['removed']})")
+        return stats
+
+
+def load_sources(config: Dict[str, Any] = None) -> List[Dict[str, Any]]:
+    """Источники из секции subscriptions sentinel.yaml"""
+    if config is None:
+        try:
+            import yaml
+            with open(MAIN_CONFIG, "r") as f:
+                config = yaml.safe_load(f) or {}
+        except (OSError, ImportError):
+            config = {}
+    return [source for source in config.get("subscriptions") or []
+            if source.get("url") and source.get("enabled", True)]
+
+
+# ============================================================================
+# ТЕСТИРОВАНИЕ
+# ============================================================================
+
+def test_subscription():
+    """Тестирование конвейера на локальном HTTP-сервере"""
+    import shutil
+    import tempfile
+    import threading
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+    print("=" * 60)
+    print("ТЕСТИРОВАНИЕ ПОДПИСОК")
+    print("=" * 60)
+
+    feeds = {
+        "/a": [f"trojan://secret{i}@node{i}.example.net:443?sni=node{i}.example.net#a-{i}" for i in range(300)],
+        "/b": [f"trojan://secret{i}@NODE{i}.example.net:443?type=tcp&sni=node{i}.example.net#b-{i}"
+               for i in range(250, 400)]
+    }
+    requests_seen = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            feed = feeds[self.path]
+            body = feed if isinstance(feed, bytes) else base64.b64encode("\n".join(feed).encode())
+            etag = '"' + hashlib.md5(body).hexdigest() + '"'
+            requests_seen.append((self.path, self.headers.get("If-None-Match") == etag))
+            if self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{server.server_address[1]}"
+    tmp = Path(tempfile.mkdtemp(prefix="sentinel-subscriptions-"))
+    sources = [{"name": "a", "url": base + "/a"}, {"name": "b", "url": base + "/b"}]
+
+    try:
+        pipeline = SubscriptionPipeline(sources, tmp / "catalog.json")
+        print(f"📥 Первая загрузка: {json.dumps(pipeline.refresh(), ensure_ascii=False)}")
+        print(f"🔄 Без изменений: {json.dumps(pipeline.refresh(), ensure_ascii=False)}")
+
+        feeds["/b"] = feeds["/b"][:-10] + ["trojan://fresh@new.example.net:8443#new"]
+        pipeline = SubscriptionPipeline(sources, tmp / "catalog.json")
+        print(f"🔄 Изменена подписка b: {json.dumps(pipeline.refresh(), ensure_ascii=False)}")
+        print(f"📊 Запросов с If-None-Match, ответ 304: {sum(1 for _, hit in requests_seen if hit)}")
+
+        # Страница ошибки провайдера с кодом 200 не должна очищать источник
+        endpoints = len(pipeline.catalog["entries"])
+        good_a = feeds["/a"]
+        feeds["/a"] = b"<html>502 Bad Gateway</html>"
+        for attempt in (1, 2):
+            # Повторно то же тело: снова ошибка, а не "без изменений"
+            result = pipeline.refresh()
+            kept = result["endpoints"] == endpoints and result["removed"] == 0 and len(result["errors"]) == 1
+            print(f"{'✅' if kept else '❌'} Ответ без ссылок ({attempt}): {json.dumps(result, ensure_ascii=False)}")
+        feeds["/a"] = good_a
+        result = pipeline.refresh()
+        recovered = result["endpoints"] == endpoints and not result["errors"]
+        print(f"{'✅' if recovered else '❌'} Восстановление источника: {json.dumps(result, ensure_ascii=False)}")
+    finally:
+        server.shutdown()
+        shutil.rmtree(tmp)
+
+
+def main():
+    """Точка входа"""
+    import argparse
+
+    parser = argparse.ArgumentParser(description="SENTINEL OS KVM - загрузка подписок")
+    parser.add_argument("command", choices=["refresh", "list", "test"])
+    parser.add_argument("--catalog", default=str(CATALOG_FILE), help="Файл каталога")
+    args = parser.parse_args()
+
+    if args.command == "test":
+        test_subscription()
+        return 0
+
+    pipeline = SubscriptionPipeline(load_sources(), Path(args.catalog))
+    if args.command == "refresh":
+        result = pipeline.refresh()
+    else:
+        result = [{"id": endpoint, "name": entry["config"].get("name"),
+                   "protocol": entry["config"].get("protocol"), "server": entry["config"].get("server"),
+                   "port": entry["config"].get("port"), "sources": entry.get("sources", [])}
+                  for endpoint, entry in pipeline.catalog["entries"].items()]
+    print(json.dumps(result, indent=2, ensure_ascii=False))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
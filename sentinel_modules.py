@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+SENTINEL OS KVM - Module Loader
+===============================
+Общий загрузчик соседних модулей sentinel-*-kvm.py.
+Имена файлов с дефисом не импортируются обычным import, поэтому модуль
+ставит finder в sys.meta_path: имя sentinel_<x>_kvm разрешается в файл
+sentinel-<x>-kvm.py из этого каталога. Так модули одинаково доступны
+через load_sentinel_module, import и pickle (воркеры пула процессов
+forkserver/spawn импортируют модуль заново по имени).
+"""
+
+import sys
+import importlib
+import importlib.abc
+import importlib.util
+from pathlib import Path
+from types import ModuleType
+from typing import Optional, Sequence
+
+SENTINEL_DIR = Path(__file__).resolve().parent
+
+
+class SentinelModuleFinder(importlib.abc.MetaPathFinder):
+    """sentinel_<x>_kvm -> sentinel-<x>-kvm.py в каталоге Sentinel"""
+
+    def find_spec(self, fullname: str, path: Optional[Sequence[str]] = None, target=None):
+        if path is not None or not fullname.startswith("sentinel_") or not fullname.endswith("_kvm"):
+            return None
+        filename = SENTINEL_DIR / (fullname.replace("_", "-") + ".py")
+        if not filename.exists():
+            return None
+        return importlib.util.spec_from_file_location(fullname, filename)
+
+
+if not any(isinstance(finder, SentinelModuleFinder) for finder in sys.meta_path):
+    sys.meta_path.append(SentinelModuleFinder())
+
+
+def load_sentinel_module(filename: str) -> ModuleType:
+    """
+    Загрузка соседнего модуля sentinel-*.py (имена с дефисом)
+
+    Модуль регистрируется в sys.modules под именем с подчеркиваниями
+    (нужно pickle) и загружается один раз под блокировкой импорта.
+    """
+    return importlib.import_module(filename[:-3].replace("-", "_"))